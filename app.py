@@ -1,52 +1,152 @@
-from flask import Flask, render_template, request, jsonify, send_file
-from backend.fits_handler import state
-from backend.plotter import create_plot
-from backend.moments.handler import handle_moment_calculation
+import io
+import threading
+import time
+from flask import Flask, Response, g, render_template, request, jsonify, send_file, stream_with_context
+from backend.fits_handler import apply_mask, datasets
+from backend.sessions import sessions
+from backend.plotter import create_plot, configure_tex_cache, usetex_available
+from backend.moments import calculator
+from backend.moments.handler import handle_moment_calculation, render_moment_image
+from backend.moments.store import moment_store, restore_moments
+from backend import limits, preview, statistics
+from backend.limits import channel_limits, precompute_state_limits
+from backend.preview import render_preview, resolve_render_mode, interactive_format
+from backend.render_cache import render_cache, render_key, render_tags
+from backend.prefetch import prefetcher
+from backend.render_scheduler import render_scheduler, Superseded
+from backend.render_pool import render_pool
+from backend.channel_map import panel_channels, render_channel_map
+from backend.movie import MOVIE_FORMATS, MOVIE_MAX_FRAMES, movie_stream, render_frames
+from backend.pv import compute_pv, render_pv
+from backend import pyramid, spectra
+from backend.spectra import extract_spectrum, start_spectral_cache
+from backend.pyramid import pyramids, pyramid_factors, choose_factor, parse_region, view_slice
+from backend.moments.calculator import get_spectral_axis
 import numpy as np
 
-from backend.args import parse_arguments
+from backend.args import parse_arguments, plot_config
 
 app = Flask(__name__)
 
 # Parse command line arguments
 args = parse_arguments()
 
-# Pre-load file if specified
+# Every browser session gets its own state; identical files are opened once and shared.
+# Memory-mapped loading is the default; --no-memmap reads cubes fully into RAM
+sessions.configure(memory_limit_mb=args.session_memory_mb, max_sessions=args.max_sessions,
+                   use_memmap=not args.no_memmap, use_moment_index=args.moment_index)
+
+# Moment maps stream channel blocks through this working-set budget
+calculator.MOMENT_MEMORY_BUDGET = int(args.moment_memory_mb * 1024 * 1024)
+calculator.set_kernel_threads(args.moment_threads)
+print(f"INFO: Moment kernel: {calculator.describe_kernel()}")
+
+# Moment maps are kept on disk and found again after a restart (0 MB disables)
+moment_store.configure(directory=args.moment_store_dir, max_bytes=int(args.moment_store_mb * 1024 * 1024))
+
+# Bounded LRU cache of encoded images
+render_cache.configure(max_bytes=int(args.render_cache_mb * 1024 * 1024), max_entries=args.render_cache_entries)
+
+# Neighbouring channels are rendered in the background while the user browses
+prefetcher.configure(depth=args.prefetch_depth, workers=args.prefetch_workers)
+sessions.on_evict(prefetcher.discard)
+
+# Interactive views use the fast preview renderer; exports always use matplotlib
+preview.RENDER_MODE = args.render_mode
+preview.PREVIEW_FORMAT = args.preview_format
+
+# Automatic colour limits are computed once per channel or moment map from a pixel sample
+limits.ZSCALE_SAMPLES = args.zscale_samples
+
+# Cube statistics (ranges, percentiles, noise) are cached on disk and survive restarts
+statistics.STATS_CACHE_DIR = args.stats_cache_dir
+
+# Spectral-major cube copies make every spectrum one contiguous read
+if args.spectral_cache_dir:
+    spectra.SPECTRAL_CACHE_DIR = args.spectral_cache_dir
+spectra.SPECTRAL_CACHE_MAX_BYTES = int(args.spectral_cache_mb * 1024 * 1024)
+
+# Large images are shown from block-averaged overview levels until zoomed in
+if args.pyramid_dir:
+    pyramid.PYRAMID_DIR = args.pyramid_dir
+# Levels of a cube or mask are dropped with its last session, not only under LRU pressure
+datasets.on_close(pyramids.discard)
+
+# LaTeX output of exports is cached on disk and survives restarts
+if args.tex_cache_dir:
+    configure_tex_cache(args.tex_cache_dir)
+
+# Pre-load file if specified. New sessions start with the same cube and mask; this
+# state keeps them open so they are shared instead of re-opened per session
 if args.file:
     print(f"Loading initial file: {args.file}")
-    state.load_fits_from_path(args.file)
+    if args.mask:
+        print(f"Loading initial mask: {args.mask}")
+sessions.configure(initial_file=args.file, initial_mask=args.mask)
+startup_state = sessions.new_state()
+
+# Matplotlib figures can be rendered by worker processes, forked here before any server thread exists
+render_pool.configure(args.render_processes)
+render_pool.start()
+
+# Initial state from CLI
+initial_config = plot_config(args)
+initial_config['filename'] = startup_state.filename if startup_state.filename else ''
+initial_config['mask_filename'] = startup_state.mask_filename if startup_state.mask_filename else ''
+
+SESSION_COOKIE = 'cubefig_session'
+
+@app.before_request
+def _open_session():
+    if request.endpoint == 'static':
+        return
+    session_id = request.cookies.get(SESSION_COOKIE)
+    g.new_session = not session_id
+    g.session_id = session_id or sessions.new_id()
+    g.state = sessions.acquire(g.session_id)
+
+@app.after_request
+def _set_session_cookie(response):
+    if g.get('new_session'):
+        response.set_cookie(SESSION_COOKIE, g.session_id, httponly=True, samesite='Lax')
+    return response
+
+@app.teardown_request
+def _close_session(exc):
+    if 'session_id' in g:
+        sessions.release(g.session_id)
+
+def _precompute_limits(state):
+    """With --precompute-limits, computes the colour limits of every channel of a newly loaded cube or mask in the background."""
+    if not args.precompute_limits or state.data is None:
+        return
+
+    def run():
+        try:
+            t = time.perf_counter()
+            precompute_state_limits(state)
+            print(f"INFO: Colour limits of {state.data.shape[0]} channels precomputed in {time.perf_counter() - t:.2f} s")
+        except Exception as e:
+            print(f"Warning: Precomputing colour limits failed: {e}")
+    threading.Thread(target=run, daemon=True).start()
 
-if args.mask:
-    print(f"Loading initial mask: {args.mask}")
+def _build_spectral_cache(state):
+    """With --spectral-cache, gives a newly loaded cube its spectral-major copy (built in the background)."""
+    if not args.spectral_cache or state.dataset is None:
+        return
     try:
-        state.load_mask_from_path(args.mask)
+        start_spectral_cache(state.dataset)
     except Exception as e:
-        print(f"Error loading initial mask: {e}")
+        print(f"Warning: Could not start the spectral cache: {e}")
 
-# Initial state from CLI
-initial_config = {
-    'title': args.title,
-    'grid': args.show_grid,
-    'showBeam': args.show_beam,
-    'showCenter': args.show_center,
-    'centerX': args.center_coords[0] if args.center_coords and len(args.center_coords) > 0 else '',
-    'centerY': args.center_coords[1] if args.center_coords and len(args.center_coords) > 1 else '',
-    'showPhysical': args.show_physical,
-    'distanceVal': args.target_distance if args.target_distance is not None else '',
-    'distanceUnit': args.offset_unit,
-    'filename': state.filename if state.filename else '',
-    'mask_filename': state.mask_filename if state.mask_filename else '',
-    'normGlobal': args.normalize,
-    'cbarUnit': args.cbar_unit,
-    'showOffset': args.show_offset,
-    'offsetAngleUnit': args.offset_angle_unit,
-    'startChan': args.start_chan if args.start_chan is not None else '',
-    'endChan': args.end_chan if args.end_chan is not None else '',
-    'vmin': args.vmin if args.vmin is not None else '',
-    'vmax': args.vmax if args.vmax is not None else '',
-    'figWidth': args.fig_width,
-    'figHeight': args.fig_height
-}
+def _precompute_pyramid(state):
+    """With --precompute-pyramid, fills every overview level of a newly loaded cube or mask in the background."""
+    if not args.precompute_pyramid or state.data is None:
+        return
+    try:
+        pyramids.precompute(state)
+    except Exception as e:
+        print(f"Warning: Could not start the overview pyramid: {e}")
 
 @app.route('/')
 def index():
@@ -54,6 +154,7 @@ def index():
 
 @app.route('/status')
 def get_status():
+    state = g.state
     if state.data is not None:
         return jsonify({
             'is_loaded': True,
@@ -61,12 +162,64 @@ def get_status():
             'mask_filename': state.mask_filename,
             'file_path': state.file_path,
             'mask_path': state.mask_path,
-            'channels': state.data.shape[0]
+            'channels': state.data.shape[0],
+            'moment_kernel': calculator.kernel_info()
         })
-    return jsonify({'is_loaded': False})
+    return jsonify({'is_loaded': False, 'moment_kernel': calculator.kernel_info()})
+
+@app.route('/statistics', methods=['GET'])
+def get_statistics():
+    """Cube statistics (computed once, then read from its cache file) for normalisation and QA."""
+    state = g.state
+    if state.data is None:
+        return jsonify({'error': 'No data loaded'}), 400
+
+    stats = state.statistics
+    counts, edges = stats.histogram()
+    # NaN (channels without finite pixels) is not valid JSON
+    as_list = lambda a: [float(v) if np.isfinite(v) else None for v in a]
+    return jsonify(dict(stats.summary(),
+                        channel_min=as_list(stats.channel_min),
+                        channel_max=as_list(stats.channel_max),
+                        channel_median=as_list(stats.channel_median),
+                        channel_noise=as_list(stats.channel_noise),
+                        histogram={'counts': counts.tolist(), 'edges': as_list(edges)}))
+
+@app.route('/spectrum', methods=['GET'])
+def get_spectrum():
+    """
+    Spectrum of a pixel, box, circle or the mask footprint (see backend.spectra).
+    GET, so hovering can ask for one per mouse move.
+    """
+    state = g.state
+    if state.data is None:
+        return jsonify({'error': 'No data loaded'}), 400
+
+    req_data = _query_params()
+    try:
+        t = time.perf_counter()
+        values, n_pixels, source = extract_spectrum(state, req_data)
+        elapsed_ms = (time.perf_counter() - t) * 1000
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    spectral, spectral_unit = get_spectral_axis(state.wcs, 0, state.data.shape[0])
+    # NaN (channels without finite pixels) is not valid JSON
+    as_list = lambda a: [float(v) if np.isfinite(v) else None for v in a]
+    return jsonify({
+        'spectral': as_list(spectral),
+        'spectral_unit': spectral_unit,
+        'values': as_list(values),
+        'unit': state.unit,
+        'aperture': req_data.get('aperture') or 'pixel',
+        'n_pixels': n_pixels,
+        'source': source,
+        'elapsed_ms': round(elapsed_ms, 3)
+    })
 
 @app.route('/load_from_path', methods=['POST'])
 def load_from_path_route():
+    state = g.state
     req_data = request.get_json()
     file_path = req_data.get('file_path')
     mask_path = req_data.get('mask_path')
@@ -96,6 +249,22 @@ def load_from_path_route():
              # Just warn, don't fail the whole load
             print(f"Warning: Failed to load mask from path {target_mask_path}: {mask_result['error']}")
 
+    _precompute_limits(state)
+    _build_spectral_cache(state)
+    _precompute_pyramid(state)
+
+    # A restored workspace brings back its moment maps from the moment store, without recomputing
+    restored = []
+    moment_params = req_data.get('momentParams')
+    if req_data.get('moments') and moment_params:
+        try:
+            restored = restore_moments(state, moment_params.get('startChan', 0), moment_params.get('endChan', 0),
+                                       moment_params.get('invertMask', False), req_data['moments'],
+                                       level=int(moment_params.get('level') or 1))
+            print(f"INFO: Restored moments {restored} of {len(req_data['moments'])} from the moment store")
+        except (TypeError, ValueError) as e:
+            print(f"Warning: Could not restore moments: {e}")
+
     # Refresh status to get updated paths/filenames
     return jsonify({
         'success': True,
@@ -103,11 +272,13 @@ def load_from_path_route():
         'file_path': state.file_path,
         'mask_filename': state.mask_filename,
         'mask_path': state.mask_path,
-        'channels': state.data.shape[0] if state.data is not None else 0
+        'channels': state.data.shape[0] if state.data is not None else 0,
+        'moments': restored
     })
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    state = g.state
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
     
@@ -118,11 +289,15 @@ def upload_file():
     result = state.load_fits(file)
     if "error" in result:
         return jsonify(result), 500
-        
+
+    _precompute_limits(state)
+    _build_spectral_cache(state)
+    _precompute_pyramid(state)
     return jsonify(result)
 
 @app.route('/upload_mask', methods=['POST'])
 def upload_mask():
+    state = g.state
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
     
@@ -133,17 +308,19 @@ def upload_mask():
     result = state.load_mask(file)
     if "error" in result:
         return jsonify(result), 500
-        
+
+    _precompute_limits(state)
+    _precompute_pyramid(state)
     return jsonify(result)
 
-@app.route('/render', methods=['POST'])
-def render_channel():
-    if state.data is None:
-        return jsonify({'error': 'No data loaded'}), 400
-        
-    req_data = request.get_json()
-    channel_idx = int(req_data.get('channel', 0))
-    
+def _render_channel_image(state, channel_idx, req_data, fmt='png', mode='export', checkpoint=None):
+    """
+    Renders one (masked) cube channel of a session's state with the visual
+    parameters of a request and returns the encoded image bytes.
+    mode 'preview' uses the fast interactive renderer, 'publication' the matplotlib
+    figure with mathtext labels and 'export' the matplotlib figure typeset with LaTeX.
+    checkpoint() is called between stages and may raise Superseded to abandon the render.
+    """
     # Get Title, Grid, and Beam from request
     title = req_data.get('title', '')
     grid = req_data.get('grid', False)
@@ -151,70 +328,247 @@ def render_channel():
     show_center = req_data.get('showCenter', False)
     center_x = req_data.get('centerX')
     center_y = req_data.get('centerY')
-    show_physical = req_data.get('showPhysical', False)
-    distance_val = req_data.get('distanceVal')
-    distance_unit = req_data.get('distanceUnit', 'Mpc')
-    norm_global = req_data.get('normGlobal', False)
     user_vmin = req_data.get('vmin')
     user_vmax = req_data.get('vmax')
     cbar_unit = req_data.get('cbarUnit', 'None')
-    show_offset = req_data.get('showOffset', False)
-    offset_angle_unit = req_data.get('offsetAngleUnit', 'arcsec')
-    fig_width = float(req_data.get('figWidth', 8))
-    fig_height = float(req_data.get('figHeight', 8))
 
     invert_mask = req_data.get('invertMask', False)
+
+    if mode != 'preview' and render_pool.enabled:
+        # The worker reads the slice and mask from its own mapping of the files
+        if checkpoint is not None:
+            checkpoint()
+        image = render_pool.render_channel(state, channel_idx, invert_mask,
+                                           _channel_plot_kwargs(state, channel_idx, req_data, fmt, mode))
+        if image is not None:
+            return image
     
+    if mode == 'preview':
+        # The overview level and zoom window chosen by _resolve_view (full resolution, whole image by default)
+        factor = int(req_data.get('pyramidLevel') or 1)
+        region = parse_region(req_data.get('viewRegion'), state.data.shape[1:])
+        image_slice, origin = view_slice(state, channel_idx, invert_mask, factor, region)
+        if checkpoint is not None:
+            checkpoint()
+        return render_preview(image_slice, state.wcs, state.unit,
+                              title=title, grid=grid, beam=state.beam,
+                              show_beam=show_beam, show_center=show_center,
+                              center_x=center_x, center_y=center_y,
+                              **_normalisation(state, req_data, channel_idx),
+                              user_vmin=user_vmin, user_vmax=user_vmax,
+                              cbar_unit=cbar_unit, fmt=fmt, factor=factor, origin=origin)
+
     image_slice = state.get_slice(channel_idx)
     
     # Apply mask if it exists
     if state.mask is not None:
-        mask_slice = state.mask[channel_idx, :, :]
-        # Decide which pixels to keep
-        if invert_mask:
-            # Keep where mask <= 0 or NaN (treating NaN as 0/masked in original)
-            keep = np.logical_or(mask_slice <= 0, np.isnan(mask_slice))
-        else:
-            # Keep where mask > 0 and not NaN
-            keep = np.where(mask_slice > 0, True, False)
-        
-        image_slice = np.where(keep, image_slice, np.nan)
+        image_slice = apply_mask(image_slice, state.mask[channel_idx, :, :], invert_mask)
         print(f"DEBUG: Mask applied to channel {channel_idx} (Invert={invert_mask}). Finite values remaining: {np.sum(np.isfinite(image_slice))}")
 
+    # Reading the slice may have taken a while; drawing it is only worth it if someone still wants it
+    if checkpoint is not None:
+        checkpoint()
+
+    buf = create_plot(image_slice, state.wcs, return_base64=False,
+                      **_channel_plot_kwargs(state, channel_idx, req_data, fmt, mode))
+    return buf.getvalue()
+
+def _normalisation(state, req_data, channel_idx=None):
+    """
+    Cube-wide colour limits of a request, from the cube's cached statistics: its full
+    range with 'normGlobal', or the central 'clipPercent' % of its values (which wins).
+    Otherwise the limits of a single channel are its cached ZScale limits.
+    """
+    clip = req_data.get('clipPercent')
+    if clip not in (None, ''):
+        try:
+            global_min, global_max = state.clip_range(clip)
+            return dict(norm_global=True, global_min=global_min, global_max=global_max)
+        except ValueError:
+            pass # Invalid percentile: ignored like an invalid manual limit
+    if req_data.get('normGlobal', False):
+        return dict(norm_global=True, global_min=state.global_min, global_max=state.global_max)
+    norm = dict(norm_global=False, global_min=None, global_max=None)
+    if channel_idx is not None:
+        norm['auto_limits'] = channel_limits(state, channel_idx, req_data.get('invertMask', False))
+    return norm
+
+def _channel_plot_kwargs(state, channel_idx, req_data, fmt, mode):
+    """create_plot arguments for a cube channel, apart from the image and WCS."""
     # Pass title, grid, beam, center, and physical axes to plotter
-    img_base64 = create_plot(image_slice, state.wcs, state.unit, 
-                             title=title, grid=grid, beam=state.beam, 
-                             show_beam=show_beam, show_center=show_center,
-                             center_x=center_x, center_y=center_y,
-                             show_physical=show_physical, distance_val=distance_val,
-                             distance_unit=distance_unit,
-                             norm_global=norm_global, 
-                             global_min=state.global_min, 
-                             global_max=state.global_max,
-                             user_vmin=user_vmin,
-                             user_vmax=user_vmax,
-                             cbar_unit=cbar_unit,
-                             show_offset=show_offset,
-                             offset_angle_unit=offset_angle_unit,
-                             fig_width=fig_width,
-                             fig_height=fig_height,
-                             cbar_label="Specific Intensity")
-    
-    return jsonify({'image': img_base64})
+    return dict(unit_label=state.unit,
+                title=req_data.get('title', ''), grid=req_data.get('grid', False), beam=state.beam,
+                show_beam=req_data.get('showBeam', False), show_center=req_data.get('showCenter', False),
+                center_x=req_data.get('centerX'), center_y=req_data.get('centerY'),
+                show_physical=req_data.get('showPhysical', False), distance_val=req_data.get('distanceVal'),
+                distance_unit=req_data.get('distanceUnit', 'Mpc'),
+                **_normalisation(state, req_data, channel_idx),
+                user_vmin=req_data.get('vmin'),
+                user_vmax=req_data.get('vmax'),
+                cbar_unit=req_data.get('cbarUnit', 'None'),
+                show_offset=req_data.get('showOffset', False),
+                offset_angle_unit=req_data.get('offsetAngleUnit', 'arcsec'),
+                fig_width=float(req_data.get('figWidth', 8)),
+                fig_height=float(req_data.get('figHeight', 8)),
+                cbar_label="Specific Intensity",
+                fmt=fmt,
+                text_profile='export' if mode == 'export' else 'interactive')
+
+def _resolve_view(state, req_data, mode):
+    """
+    Preview requests get the overview level ('pyramidLevel') that matches the screen
+    pixels of the view ('viewWidth', 'viewHeight') and the zoom window ('viewRegion',
+    'x0,y0,x1,y1' in cube pixels); both become part of the render key. Other modes
+    always draw the full-resolution image.
+    """
+    requested_region = req_data.get('viewRegion')
+    req_data = {k: v for k, v in req_data.items() if k not in ('pyramidLevel', 'viewRegion')}
+    if mode != 'preview':
+        return req_data
+    shape = state.data.shape[1:]
+    region = parse_region(requested_region, shape)
+    region_shape = (region[3] - region[1], region[2] - region[0]) if region else shape
+    try:
+        view_shape = (int(float(req_data.get('viewHeight') or 0)), int(float(req_data.get('viewWidth') or 0)))
+    except ValueError:
+        view_shape = None
+    factor = choose_factor(pyramid_factors(shape), region_shape, view_shape)
+    if factor > 1:
+        req_data['pyramidLevel'] = factor
+    if region:
+        req_data['viewRegion'] = ','.join(str(v) for v in region)
+    return req_data
+
+def _channel_key(state, channel_idx, req_data, fmt='png', mode='export'):
+    invert_mask = req_data.get('invertMask', False)
+    return render_key('channel', channel_idx, state, req_data, invert_mask, fmt=fmt, mode=mode)
+
+def _cached_channel_image(state, channel_idx, req_data, fmt='png', mode='export', checkpoint=None):
+    """Channel render served from the render cache when possible."""
+    # Key, tags and pixels all come from the same cube and mask, even if another is loaded meanwhile
+    view = state.snapshot()
+    key = _channel_key(view, channel_idx, req_data, fmt=fmt, mode=mode)
+    image = render_cache.get(key)
+    if image is None:
+        image = _render_channel_image(view, channel_idx, req_data, fmt=fmt, mode=mode, checkpoint=checkpoint)
+        render_cache.put(key, image, render_tags('channel', channel_idx, view))
+    return image
+
+def _schedule_prefetch(state, channel_idx, req_data, fmt, mode):
+    """Queues background renders of the channels around channel_idx, in the session's own window."""
+    # The renders run later: they draw the cube and mask loaded now, under keys and tags of those
+    view = state.snapshot()
+    prefetcher.schedule(
+        state, channel_idx, view.data.shape[0],
+        params_key=_channel_key(view, None, req_data, fmt=fmt, mode=mode),
+        key_fn=lambda c: _channel_key(view, c, req_data, fmt=fmt, mode=mode),
+        render_fn=lambda c: (_render_channel_image(view, c, req_data, fmt=fmt, mode=mode), render_tags('channel', c, view))
+    )
+
+def _query_params():
+    """Render parameters from the query string of a GET request ('true'/'false' become booleans)."""
+    return {k: {'true': True, 'false': False}.get(v, v) for k, v in request.args.items()}
+
+def _image_response(image, key, fmt, mode):
+    """
+    Raw image bytes with the render key as strong ETag. Browsers revalidate on every
+    use (no-cache) and get a 304 while the frame is unchanged.
+    """
+    if image is None:
+        response = Response(status=304)
+    else:
+        response = Response(image, mimetype=f'image/{fmt}')
+    response.set_etag(key)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Render-Mode'] = mode
+    return response
+
+def _client_has(key):
+    # The key hashes every input of the image, so a matching ETag means nothing to send
+    return key in request.if_none_match
+
+def _render_slot(view):
+    """Scheduler slot of the requesting client's view, or None for clients without an id."""
+    client_id = request.headers.get('X-Client-Id')
+    return (client_id, view) if client_id else None
+
+def _run_scheduled(slot, ticket, render_fn):
+    """
+    Runs render_fn(checkpoint) once the slot is free. Returns None if a newer
+    request for the same view superseded this one before or during the render.
+    """
+    if slot is None:
+        return render_fn(None)
+    if not render_scheduler.acquire(slot, ticket):
+        return None
+    try:
+        return render_fn(lambda: render_scheduler.check(slot, ticket))
+    except Superseded:
+        return None
+    finally:
+        render_scheduler.release(slot)
+
+def _superseded_response():
+    # The client already asked for a newer frame of this view
+    return Response(status=204)
+
+@app.route('/render', methods=['GET'])
+def render_channel():
+    state = g.state
+    if state.data is None:
+        return jsonify({'error': 'No data loaded'}), 400
+        
+    req_data = _query_params()
+    channel_idx = int(req_data.get('channel', 0))
+
+    mode = resolve_render_mode(req_data)
+    fmt = interactive_format(mode)
+    # The ETag and the image describe the same cube even if another is loaded meanwhile
+    view = state.snapshot()
+    try:
+        req_data = _resolve_view(view, req_data, mode)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    key = _channel_key(view, channel_idx, req_data, fmt=fmt, mode=mode)
+
+    # Latest wins: this request supersedes older ones for the same view
+    slot = _render_slot('cube')
+    ticket = render_scheduler.submit(slot) if slot else None
+
+    if _client_has(key):
+        image = None
+    else:
+        # Reuse the encoded image if this exact frame was rendered (or prefetched) before
+        image = _run_scheduled(slot, ticket, lambda checkpoint: _cached_channel_image(
+            view, channel_idx, req_data, fmt=fmt, mode=mode, checkpoint=checkpoint))
+        if image is None:
+            return _superseded_response()
+
+    # Render the neighbours while the user looks at this frame
+    _schedule_prefetch(state, channel_idx, req_data, fmt, mode)
+
+    return _image_response(image, key, fmt, mode)
 
 @app.route('/calculate_moments', methods=['POST'])
 def calculate_moments():
+    state = g.state
     req_data = request.get_json()
-    images = handle_moment_calculation(state, req_data)
+    try:
+        keys = handle_moment_calculation(state, req_data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    if images is None:
+    if keys is None:
         return jsonify({'error': 'No file loaded'}), 400
             
-    return jsonify({'images': images})
+    # Images are fetched from /render_moment, where they are already cached
+    level = max((state.moment_data[m]['level'] for m in keys), default=1)
+    return jsonify({'moments': list(keys), 'etags': keys, 'level': level})
 
-@app.route('/render_moment', methods=['POST'])
+@app.route('/render_moment', methods=['GET'])
 def render_moment():
-    req_data = request.get_json()
+    state = g.state
+    req_data = _query_params()
     mom_type = req_data.get('momentType')
     
     if state.data is None:
@@ -223,163 +577,235 @@ def render_moment():
     if mom_type not in state.moment_data:
         return jsonify({'error': 'Moment not calculated yet'}), 400
         
-    mom_info = state.moment_data[mom_type]
-    mom_data = mom_info['data']
-    raw_unit = mom_info['unit']
-    mom_unit = raw_unit # Guaranteed to be clean now
-
-    cbar_label = "Intensity"
-    if mom_type == '1':
-        cbar_label = "Velocity Field"
-    elif mom_type == '2':
-        cbar_label = "Velocity Dispersion"
-    
-    # Visualization params
-    title = req_data.get('title', '')
-    grid = req_data.get('grid', False)
-    show_beam = req_data.get('showBeam', False)
-    show_center = req_data.get('showCenter', False)
-    center_x = req_data.get('centerX')
-    center_y = req_data.get('centerY')
-    show_physical = req_data.get('showPhysical', False)
-    distance_val = req_data.get('distanceVal')
-    distance_unit = req_data.get('distanceUnit', 'Mpc')
-    cbar_unit = req_data.get('cbarUnit', 'None')
-    show_offset = req_data.get('showOffset', False)
-    offset_angle_unit = req_data.get('offsetAngleUnit', 'arcsec')
-    fig_width = float(req_data.get('figWidth', 8))
-    fig_height = float(req_data.get('figHeight', 8))
+    mode = resolve_render_mode(req_data)
+    fmt = interactive_format(mode)
 
-    user_vmin = req_data.get('vmin')
-    user_vmax = req_data.get('vmax')
-    
-    mom_title = f"{title}\nMoment {mom_type}" if title else f"Moment {mom_type}"
-    
-    img_base64 = create_plot(
-        mom_data, state.wcs, raw_unit,
-        title=mom_title, grid=grid, beam=state.beam,
-        show_beam=show_beam, show_center=show_center,
-        center_x=center_x, center_y=center_y,
-        show_physical=show_physical, distance_val=distance_val,
-        distance_unit=distance_unit,
-        cbar_unit=cbar_unit,
-        show_offset=show_offset,
-        offset_angle_unit=offset_angle_unit,
-        fig_width=fig_width,
-        fig_height=fig_height,
-        cbar_label=cbar_label,
-        user_vmin=user_vmin,
-        user_vmax=user_vmax
-    )
+    key = render_key('moment', mom_type, state, req_data, fmt=fmt, mode=mode)
+    slot = _render_slot(f'mom{mom_type}')
+    ticket = render_scheduler.submit(slot) if slot else None
+    if _client_has(key):
+        return _image_response(None, key, fmt, mode)
+
+    def render(checkpoint):
+        image = render_cache.get(key)
+        if image is None:
+            image = render_moment_image(state, mom_type, req_data, mode=mode, fmt=fmt)
+            render_cache.put(key, image, render_tags('moment', mom_type, state))
+        return image
+
+    image = _run_scheduled(slot, ticket, render)
+    if image is None:
+        return _superseded_response()
     
-    return jsonify({'image': img_base64})
+    return _image_response(image, key, fmt, mode)
+
+def _render_pv_image(state, req_data, fmt='png', mode='export'):
+    """Renders the session's PV slice with the visual parameters of a request; returns the encoded bytes."""
+    pv = state.pv_data
+    return render_pv(pv['data'], pv['offsets'], pv['spectral'], pv['spectral_unit'], state.unit,
+                     title=req_data.get('title', ''), grid=req_data.get('grid', False),
+                     **_normalisation(state, req_data),
+                     user_vmin=req_data.get('vmin'), user_vmax=req_data.get('vmax'),
+                     cbar_unit=req_data.get('cbarUnit', 'None'),
+                     offset_unit=pv['offset_unit'], offset_angle_unit=req_data.get('offsetAngleUnit', 'arcsec'),
+                     fig_width=float(req_data.get('figWidth', 8)), fig_height=float(req_data.get('figHeight', 8)),
+                     fmt=fmt, text_profile='export' if mode == 'export' else 'interactive')
+
+def _cached_pv_image(state, req_data, fmt='png', mode='export'):
+    key = render_key('pv', None, state, req_data, fmt=fmt, mode=mode)
+    image = render_cache.get(key)
+    if image is None:
+        image = _render_pv_image(state, req_data, fmt=fmt, mode=mode)
+        render_cache.put(key, image, render_tags('pv', None, state))
+    return key, image
+
+@app.route('/calculate_pv', methods=['POST'])
+def calculate_pv():
+    state = g.state
+    if state.data is None:
+        return jsonify({'error': 'No file loaded'}), 400
+
+    req_data = request.get_json()
+    try:
+        t = time.perf_counter()
+        pv = compute_pv(state, req_data)
+        print(f"INFO: PV slice {pv['data'].shape} extracted in {time.perf_counter() - t:.3f} s")
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    state.set_pv(pv)
+    # The PV tab has no preview renderer: interactive views use the publication figure
+    key, _ = _cached_pv_image(state, req_data, mode='publication')
+    x1, y1, x2, y2 = pv['path'][:4]
+    return jsonify({'success': True, 'etag': key, 'shape': list(pv['data'].shape),
+                    'path': {'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2}})
+
+@app.route('/render_pv', methods=['GET'])
+def render_pv_route():
+    state = g.state
+    if state.data is None:
+        return jsonify({'error': 'No file loaded'}), 400
+    if state.pv_data is None:
+        return jsonify({'error': 'PV slice not calculated yet'}), 400
+
+    req_data = _query_params()
+    mode = 'publication'
+    key = render_key('pv', None, state, req_data, fmt='png', mode=mode)
+    slot = _render_slot('pv')
+    ticket = render_scheduler.submit(slot) if slot else None
+    if _client_has(key):
+        return _image_response(None, key, 'png', mode)
+
+    image = _run_scheduled(slot, ticket, lambda checkpoint: _cached_pv_image(state, req_data, mode=mode)[1])
+    if image is None:
+        return _superseded_response()
+    return _image_response(image, key, 'png', mode)
 
 @app.route('/export', methods=['POST'])
 def export_plot():
+    state = g.state
     if state.data is None:
         return jsonify({'error': 'No data loaded'}), 400
         
     req_data = request.get_json()
     export_fmt = req_data.get('format', 'png')
     
-    # Common visualisation params
-    title = req_data.get('title', '')
-    grid = req_data.get('grid', False)
-    show_beam = req_data.get('showBeam', False)
-    show_center = req_data.get('showCenter', False)
-    center_x = req_data.get('centerX')
-    center_y = req_data.get('centerY')
-    show_physical = req_data.get('showPhysical', False)
-    distance_val = req_data.get('distanceVal')
-    distance_unit = req_data.get('distanceUnit', 'Mpc')
-    cbar_unit = req_data.get('cbarUnit', 'None')
-    show_offset = req_data.get('showOffset', False)
-    offset_angle_unit = req_data.get('offsetAngleUnit', 'arcsec')
-    fig_width = float(req_data.get('figWidth', 8))
-    fig_height = float(req_data.get('figHeight', 8))
-    user_vmin = req_data.get('vmin')
-    user_vmax = req_data.get('vmax')
-    
+    # Exports always go through the matplotlib figure, typeset with LaTeX when available
     # Check if Moment or Cube
-    if 'momentType' in req_data:
+    if req_data.get('pv'):
+        # --- PV SLICE EXPORT ---
+        if state.pv_data is None:
+            return jsonify({'error': 'PV slice not calculated'}), 400
+        _, image = _cached_pv_image(state, req_data, fmt=export_fmt, mode='export')
+
+    elif 'momentType' in req_data:
         # --- MOMENT EXPORT ---
         mom_type = req_data.get('momentType')
         if mom_type not in state.moment_data:
             return jsonify({'error': 'Moment not calculated'}), 400
             
-        mom_info = state.moment_data[mom_type]
-        plot_data = mom_info['data']
-        unit = mom_info['unit']
-        
-        final_title = f"{title}\nMoment {mom_type}" if title else f"Moment {mom_type}"
-        cbar_label = "Intensity"
-        if mom_type == '1': cbar_label = "Velocity Field"
-        elif mom_type == '2': cbar_label = "Velocity Dispersion"
-        
-        buf = create_plot(
-            plot_data, state.wcs, unit,
-            title=final_title, grid=grid, beam=state.beam,
-            show_beam=show_beam, show_center=show_center,
-            center_x=center_x, center_y=center_y,
-            show_physical=show_physical, distance_val=distance_val,
-            distance_unit=distance_unit,
-            cbar_unit=cbar_unit,
-            show_offset=show_offset,
-            offset_angle_unit=offset_angle_unit,
-            fig_width=fig_width,
-            fig_height=fig_height,
-            cbar_label=cbar_label,
-            user_vmin=user_vmin,
-            user_vmax=user_vmax,
-            fmt=export_fmt,
-            return_base64=False
-        )
+        key = render_key('moment', mom_type, state, req_data, fmt=export_fmt, mode='export')
+        image = render_cache.get(key)
+        if image is None:
+            image = render_moment_image(state, mom_type, req_data, mode='export', fmt=export_fmt)
+            render_cache.put(key, image, render_tags('moment', mom_type, state))
         
     else:
         # --- CUBE EXPORT ---
         channel_idx = int(req_data.get('channel', 0))
-        norm_global = req_data.get('normGlobal', False)
-        invert_mask = req_data.get('invertMask', False)
-        
-        image_slice = state.get_slice(channel_idx)
-        
-        # Apply mask logic (duplicated from /render)
-        if state.mask is not None:
-            mask_slice = state.mask[channel_idx, :, :]
-            if invert_mask:
-                keep = np.logical_or(mask_slice <= 0, np.isnan(mask_slice))
-            else:
-                keep = np.where(mask_slice > 0, True, False)
-            image_slice = np.where(keep, image_slice, np.nan)
-
-        buf = create_plot(
-            image_slice, state.wcs, state.unit, 
-            title=title, grid=grid, beam=state.beam, 
-            show_beam=show_beam, show_center=show_center,
-            center_x=center_x, center_y=center_y,
-            show_physical=show_physical, distance_val=distance_val,
-            distance_unit=distance_unit,
-            norm_global=norm_global, 
-            global_min=state.global_min, 
-            global_max=state.global_max,
-            user_vmin=user_vmin,
-            user_vmax=user_vmax,
-            cbar_unit=cbar_unit,
-            show_offset=show_offset,
-            offset_angle_unit=offset_angle_unit,
-            fig_width=fig_width,
-            fig_height=fig_height,
-            cbar_label="Specific Intensity",
-            fmt=export_fmt,
-            return_base64=False
-        )
+        image = _cached_channel_image(state, channel_idx, req_data, fmt=export_fmt, mode='export')
 
     return send_file(
-        buf, 
+        io.BytesIO(image), 
         mimetype=f'image/{export_fmt}', 
         as_attachment=True, 
         download_name=f'plot.{export_fmt}'
     )
 
+@app.route('/export_channel_map', methods=['POST'])
+def export_channel_map():
+    state = g.state
+    if state.data is None:
+        return jsonify({'error': 'No data loaded'}), 400
+
+    req_data = request.get_json()
+    export_fmt = req_data.get('format', 'png')
+    invert_mask = req_data.get('invertMask', False)
+    n_channels = state.data.shape[0]
+
+    try:
+        start = int(req_data.get('startChan') or 0)
+        end_chan = req_data.get('endChan')
+        end = int(end_chan) if end_chan not in (None, '') else n_channels - 1
+        stride = int(req_data.get('stride') or 1)
+        binning = int(req_data.get('binning') or 1)
+        columns = int(req_data['columns']) if req_data.get('columns') else None
+        channels = panel_channels(start, end, stride, binning, n_channels)
+
+        layout = [start, end, stride, binning, columns]
+        key = render_key('channel_map', layout, state, req_data, invert_mask, fmt=export_fmt, mode='export')
+        image = render_cache.get(key)
+        if image is None:
+            image = render_channel_map(
+                state.data, state.wcs, state.unit, channels,
+                mask=state.mask, invert_mask=invert_mask,
+                title=req_data.get('title', ''), grid=req_data.get('grid', False),
+                beam=state.beam, show_beam=req_data.get('showBeam', False),
+                **_normalisation(state, req_data),
+                user_vmin=req_data.get('vmin'), user_vmax=req_data.get('vmax'),
+                cbar_unit=req_data.get('cbarUnit', 'None'),
+                fig_width=float(req_data.get('figWidth', 8)), columns=columns,
+                fmt=export_fmt)
+            render_cache.put(key, image, render_tags('channel_map', None, state))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return send_file(
+        io.BytesIO(image),
+        mimetype=f'image/{export_fmt}',
+        as_attachment=True,
+        download_name=f'channel_map.{export_fmt}'
+    )
+
+@app.route('/export_movie', methods=['POST'])
+def export_movie():
+    state = g.state
+    if state.data is None:
+        return jsonify({'error': 'No data loaded'}), 400
+
+    req_data = request.get_json()
+    movie_fmt = req_data.get('format', 'gif')
+    n_channels = state.data.shape[0]
+    # Figures with coordinate axes unless the preview renderer is asked for explicitly
+    mode = req_data.get('renderMode')
+    if mode not in ('preview', 'publication', 'export'):
+        mode = 'publication'
+
+    try:
+        start = int(req_data.get('startChan') or 0)
+        end_chan = req_data.get('endChan')
+        end = int(end_chan) if end_chan not in (None, '') else n_channels - 1
+        stride = max(1, int(req_data.get('stride') or 1))
+        channels = range(max(0, start), min(end, n_channels - 1) + 1, stride)
+        if len(channels) == 0:
+            raise ValueError("No channels in the requested range.")
+        if len(channels) > MOVIE_MAX_FRAMES:
+            raise ValueError(f"Movie would have {len(channels)} frames (at most {MOVIE_MAX_FRAMES}); increase the stride.")
+        # Preview frames follow the same overview level and zoom window as the viewer
+        req_data = _resolve_view(state, req_data, mode)
+        # Frames are drawn while streaming: all of them come from the cube loaded now
+        view = state.snapshot()
+
+        def frame(c):
+            # Frames already rendered for the viewer are reused, new ones are not cached
+            image = render_cache.get(_channel_key(view, c, req_data, fmt='png', mode=mode))
+            return image if image is not None else _render_channel_image(view, c, req_data, fmt='png', mode=mode)
+
+        chunks = movie_stream(render_frames(frame, channels), movie_fmt, req_data.get('fps') or 10)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    print(f"INFO: Streaming {movie_fmt} movie of {len(channels)} channels ({mode})")
+    # The request context (and with it the session) stays open until the last chunk is sent
+    return Response(stream_with_context(chunks), mimetype=MOVIE_FORMATS[movie_fmt],
+                    headers={'Content-Disposition': f'attachment; filename=channel_movie.{movie_fmt}'})
+
+def _warm_export_renderer():
+    """Typesets the default export figure once, so LaTeX output for its labels is cached."""
+    try:
+        _cached_channel_image(startup_state, 0, initial_config, mode='export')
+        print("INFO: Export renderer warmed up")
+    except Exception as e:
+        print(f"Warning: Export renderer warm-up failed: {e}")
+
+# Limits of the preloaded cube are ready before anyone asks for them
+_precompute_limits(startup_state)
+_build_spectral_cache(startup_state)
+_precompute_pyramid(startup_state)
+
+# The first export after startup should not pay for running LaTeX on every label
+if startup_state.data is not None and usetex_available():
+    threading.Thread(target=_warm_export_renderer, daemon=True).start()
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
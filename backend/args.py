@@ -7,7 +7,70 @@ def parse_arguments():
     # File loading
     parser.add_argument('--file', type=str, help='Path to FITS file to load')
     parser.add_argument('--mask', type=str, help='Path to mask file')
+    parser.add_argument('--no-memmap', action='store_true', help='Read cubes fully into memory instead of memory-mapping them')
     
+    _add_plot_arguments(parser)
+
+    # Performance
+    parser.add_argument('--moment-index', action='store_true', help='Precompute spectral prefix sums so moments of any channel range are instant')
+    parser.add_argument('--moment-memory-mb', type=float, default=256, help='Memory budget per streamed block of channels during moment calculation (MB)')
+    parser.add_argument('--moment-threads', type=int, default=0, help='Threads of the C moment kernel (0 uses OMP_NUM_THREADS or every core)')
+    parser.add_argument('--moment-store-dir', type=str, help='Directory where computed moment maps are kept across restarts (default: a temporary directory)')
+    parser.add_argument('--moment-store-mb', type=float, default=2048, help='Disk space for stored moment maps; least recently used maps are deleted above it (0 disables)')
+    parser.add_argument('--render-cache-mb', type=float, default=256, help='Memory limit of the rendered image cache (MB)')
+    parser.add_argument('--render-cache-entries', type=int, default=512, help='Maximum number of cached rendered images')
+    parser.add_argument('--prefetch-depth', type=int, default=2, help='Channels on each side of the current one to render in the background (0 disables)')
+    parser.add_argument('--prefetch-workers', type=int, default=2, help='Worker threads used for background channel renders')
+    parser.add_argument('--render-mode', type=str, default='preview', choices=['preview', 'publication'], help='Renderer for interactive views (exports always use the publication figure)')
+    parser.add_argument('--tex-cache-dir', type=str, help="Directory for cached LaTeX output (default: matplotlib's cache directory)")
+    parser.add_argument('--preview-format', type=str, default='png', choices=['png', 'webp'], help='Image format of preview frames')
+    parser.add_argument('--session-memory-mb', type=float, default=2048, help='Memory ceiling for moment maps and indexes of all sessions; idle sessions are evicted above it (0 disables)')
+    parser.add_argument('--max-sessions', type=int, default=64, help='Maximum number of browser sessions kept; the least recently used idle ones are evicted')
+    parser.add_argument('--render-processes', type=int, default=0, help='Worker processes rendering matplotlib figures in parallel (0 renders in the server process)')
+    parser.add_argument('--zscale-samples', type=int, default=1000, help='Pixels sampled per map for automatic (ZScale) colour limits')
+    parser.add_argument('--precompute-limits', action='store_true', help='Compute the automatic colour limits of every channel in the background after a cube is loaded')
+    parser.add_argument('--spectral-cache', action='store_true', help='Build a spectral-major (y, x, v) copy of each loaded cube in the background for fast spectrum extraction')
+    parser.add_argument('--spectral-cache-dir', type=str, help='Directory for spectral-major cube copies (default: a temporary directory)')
+    parser.add_argument('--spectral-cache-mb', type=float, default=8192, help='Disk space for spectral-major cube copies; least recently used copies not in use are deleted above it (0 for no limit)')
+    parser.add_argument('--precompute-pyramid', action='store_true', help='Fill the downsampled overview levels of large cubes in the background after loading (otherwise each channel is filled when first viewed)')
+    parser.add_argument('--pyramid-dir', type=str, help='Directory for overview pyramid levels (default: a temporary directory)')
+    parser.add_argument('--stats-cache-dir', type=str, help="Directory for cached cube statistics (default: a '.stats.npz' file next to each cube)")
+
+    args, unknown = parser.parse_known_args()
+    return args
+
+def parse_batch_arguments():
+    """Parses command line arguments of the headless batch pipeline (batch.py)."""
+    parser = argparse.ArgumentParser(description='CubeFig2 - Batch moment maps for many cubes')
+
+    # Inputs
+    parser.add_argument('cubes', nargs='*', help='FITS cubes or glob patterns (quote globs to expand them here)')
+    parser.add_argument('--list', type=str, help="Text file with one 'cube [mask]' per line")
+    parser.add_argument('--mask', type=str, help='Mask applied to every cube')
+    parser.add_argument('--mask-pattern', type=str, help="Per-cube mask path, e.g. '{dir}/{stem}_mask.fits'")
+    parser.add_argument('--invert-mask', action='store_true', help='Keep pixels outside the mask instead')
+
+    # Outputs
+    parser.add_argument('--config', type=str, help='JSON file of plot options, keyed like the UI (overrides the flags below)')
+    parser.add_argument('--output-dir', type=str, default='cubefig_batch', help='Directory for maps, progress file and timing report')
+    parser.add_argument('--moments', nargs='+', default=['0', '1', '2'], choices=['0', '1', '2', '8', '9', 'skew', 'kurt'],
+                        help='Moments to compute: 0/1/2, 8 (peak intensity), 9 (velocity at peak), skew, kurt (excess kurtosis)')
+    parser.add_argument('--formats', nargs='+', default=['png'], choices=['png', 'pdf', 'svg', 'eps'], help='Figure formats to export')
+    parser.add_argument('--save-fits', action='store_true', help='Also write each moment map as a FITS image')
+
+    # Execution
+    parser.add_argument('--processes', type=int, default=0, help='Cubes processed in parallel (0 uses every core)')
+    parser.add_argument('--force', action='store_true', help='Redo cubes the progress file already lists as done')
+    parser.add_argument('--moment-memory-mb', type=float, default=256, help='Memory budget per streamed block of channels during moment calculation (MB)')
+    parser.add_argument('--moment-threads', type=int, default=0, help='Threads of the C moment kernel per process (0: one when cubes run in parallel, else OMP_NUM_THREADS or every core)')
+    parser.add_argument('--tex-cache-dir', type=str, help="Directory for cached LaTeX output (default: matplotlib's cache directory)")
+
+    _add_plot_arguments(parser)
+
+    return parser.parse_args()
+
+def _add_plot_arguments(parser):
+    """Plot options shared by the web app (UI defaults) and the batch pipeline."""
     # Plot configuration
     parser.add_argument('--title', type=str, default='', help='Default plot title')
     parser.add_argument('--show-grid', '--grid', action='store_true', dest='show_grid', help='Enable grid by default')
@@ -23,6 +86,7 @@ def parse_arguments():
     # Coordinates & Display
     parser.add_argument('--cbar-unit', type=str, default='None', choices=['None', 'milli', 'micro', 'nano'], help='Colorbar unit scale')
     parser.add_argument('--normalize', action='store_true', help='Use global normalization')
+    parser.add_argument('--clip-percent', type=float, help='Normalize to the central percentage of all cube values (e.g. 99.5)')
     parser.add_argument('--show-offset', action='store_true', help='Show coordinate offsets from center')
     parser.add_argument('--offset-angle-unit', type=str, default='arcsec', choices=['arcsec', 'milliarcsec'], help='Angle offset unit')
     
@@ -35,6 +99,28 @@ def parse_arguments():
     # Figure dimensions
     parser.add_argument('--fig-width', type=float, default=8, help='Figure width')
     parser.add_argument('--fig-height', type=float, default=8, help='Figure height')
-    
-    args, unknown = parser.parse_known_args()
-    return args
+
+def plot_config(args):
+    """Plot options of parsed arguments, keyed like the UI's request parameters."""
+    return {
+        'title': args.title,
+        'grid': args.show_grid,
+        'showBeam': args.show_beam,
+        'showCenter': args.show_center,
+        'centerX': args.center_coords[0] if args.center_coords and len(args.center_coords) > 0 else '',
+        'centerY': args.center_coords[1] if args.center_coords and len(args.center_coords) > 1 else '',
+        'showPhysical': args.show_physical,
+        'distanceVal': args.target_distance if args.target_distance is not None else '',
+        'distanceUnit': args.offset_unit,
+        'normGlobal': args.normalize,
+        'clipPercent': args.clip_percent if args.clip_percent is not None else '',
+        'cbarUnit': args.cbar_unit,
+        'showOffset': args.show_offset,
+        'offsetAngleUnit': args.offset_angle_unit,
+        'startChan': args.start_chan if args.start_chan is not None else '',
+        'endChan': args.end_chan if args.end_chan is not None else '',
+        'vmin': args.vmin if args.vmin is not None else '',
+        'vmax': args.vmax if args.vmax is not None else '',
+        'figWidth': args.fig_width,
+        'figHeight': args.fig_height
+    }
@@ -0,0 +1,242 @@
+import csv
+import glob
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from astropy.io import fits
+
+from .args import parse_batch_arguments, plot_config
+from .fits_handler import FitsState
+from .moments import calculator
+from .moments.calculator import compute_moments
+from .moments.handler import render_moment_image
+from .plotter import configure_tex_cache, usetex_available
+
+# Written to the output directory
+PROGRESS_FILE = 'batch_progress.jsonl'
+REPORT_FILE = 'batch_timing.csv'
+
+STAGES = ('load', 'mask', 'moments', 'plot')
+
+def collect_cubes(args):
+    """
+    (cube, mask) pairs from the positional paths/globs and the --list file, in order.
+    A mask on a --list line wins over --mask-pattern, which wins over --mask.
+    """
+    entries = []
+    for pattern in args.cubes:
+        matches = sorted(glob.glob(pattern))
+        if not matches and not glob.has_magic(pattern):
+            matches = [pattern] # Reported as a failed cube rather than dropped silently
+        entries.extend((path, None) for path in matches)
+
+    if args.list:
+        with open(args.list) as f:
+            for line in f:
+                parts = line.split()
+                if parts and not parts[0].startswith('#'):
+                    entries.append((parts[0], parts[1] if len(parts) > 1 else None))
+
+    jobs, seen = [], set()
+    for cube, mask in entries:
+        if cube in seen:
+            continue
+        seen.add(cube)
+        if mask is None and args.mask_pattern:
+            stem = os.path.splitext(os.path.basename(cube))[0]
+            mask = args.mask_pattern.format(dir=os.path.dirname(cube) or '.', stem=stem)
+        elif mask is None:
+            mask = args.mask
+        jobs.append((cube, mask))
+    return jobs
+
+def load_config(args):
+    """Plot options from the flags, overridden by the --config JSON file (UI keys)."""
+    config = plot_config(args)
+    config['invertMask'] = args.invert_mask
+    if args.config:
+        with open(args.config) as f:
+            config.update(json.load(f))
+    return config
+
+def job_id(cube, mask, settings):
+    """Identifies one cube's work: its files (path, size, mtime) and every option used."""
+    def stamp(path):
+        if not path or not os.path.exists(path):
+            return [path]
+        st = os.stat(path)
+        return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+    payload = json.dumps([stamp(cube), stamp(mask), settings], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+def load_progress(path):
+    """Records of cubes finished by earlier runs, by job id."""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # Line cut short by an interrupted run
+            if record.get('status') == 'done':
+                done[record['id']] = record
+    return done
+
+def _init_worker(moment_memory_budget, moment_threads, tex_cache_dir):
+    calculator.MOMENT_MEMORY_BUDGET = moment_memory_budget
+    calculator.set_kernel_threads(moment_threads)
+    if tex_cache_dir:
+        configure_tex_cache(tex_cache_dir)
+
+def _channel_range(config, n_channels):
+    start = config.get('startChan')
+    end = config.get('endChan')
+    start = int(start) if start not in (None, '') else 0
+    end = int(end) if end not in (None, '') else n_channels - 1
+    return start, end
+
+def process_cube(job):
+    """
+    load -> mask -> compute_moments -> create_plot -> export for one cube.
+    Returns its progress record; failures are recorded, not raised.
+    """
+    record = {'id': job['id'], 'cube': job['cube'], 'mask': job['mask'], 'outputs': [], 'timings': {}}
+    timings = record['timings']
+    state = FitsState()
+    t_start = time.perf_counter()
+    try:
+        t = time.perf_counter()
+        result = state.load_fits_from_path(job['cube'])
+        if "error" in result:
+            raise ValueError(f"Could not load cube: {result['error']}")
+        timings['load'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        if job['mask']:
+            result = state.load_mask_from_path(job['mask'])
+            if "error" in result:
+                raise ValueError(f"Could not load mask: {result['error']}")
+        timings['mask'] = time.perf_counter() - t
+
+        config = job['config']
+        t = time.perf_counter()
+        start, end = _channel_range(config, state.data.shape[0])
+        results = compute_moments(state.data, state.wcs, state.unit, start, end, job['moments'],
+                                  mask=state.mask, invert_mask=config.get('invertMask', False))
+        timings['moments'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        stem = os.path.splitext(os.path.basename(job['cube']))[0]
+        # '{stem}' in the title becomes the cube's file name
+        config = dict(config, title=str(config.get('title', '')).replace('{stem}', stem))
+        for mom in job['moments']:
+            if mom not in results:
+                continue
+            state.set_moment(mom, results[mom], results.get(f"{mom}_unit", "Arbitrary Units"))
+            for fmt in job['formats']:
+                path = os.path.join(job['output_dir'], f"{stem}_mom{mom}.{fmt}")
+                with open(path, 'wb') as f:
+                    f.write(render_moment_image(state, mom, config, mode='export', fmt=fmt))
+                record['outputs'].append(path)
+            if job['save_fits']:
+                path = os.path.join(job['output_dir'], f"{stem}_mom{mom}.fits")
+                header = state.wcs.celestial.to_header()
+                header['BUNIT'] = results.get(f"{mom}_unit", '')
+                fits.PrimaryHDU(results[mom], header=header).writeto(path, overwrite=True)
+                record['outputs'].append(path)
+        timings['plot'] = time.perf_counter() - t
+
+        record['status'] = 'done'
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = str(e)
+    finally:
+        state.close()
+    timings['total'] = time.perf_counter() - t_start
+    return record
+
+def write_report(path, records):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['cube', 'status'] + [f'{s}_s' for s in STAGES] + ['total_s', 'error'])
+        for r in records:
+            t = r.get('timings', {})
+            writer.writerow([r['cube'], r['status']]
+                            + [f"{t[s]:.3f}" if s in t else '' for s in STAGES]
+                            + [f"{t['total']:.3f}" if 'total' in t else '', r.get('error', '')])
+
+def run(args):
+    jobs = collect_cubes(args)
+    if not jobs:
+        print("ERROR: No cubes given")
+        return 1
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    progress_path = os.path.join(args.output_dir, PROGRESS_FILE)
+    config = load_config(args)
+    settings = {'config': config, 'moments': args.moments, 'formats': args.formats, 'save_fits': args.save_fits}
+    finished = {} if args.force else load_progress(progress_path)
+
+    stems = [os.path.splitext(os.path.basename(cube))[0] for cube, _ in jobs]
+    if len(set(stems)) != len(stems):
+        print("Warning: Several cubes share a file name; their maps overwrite each other")
+
+    pending, records = [], []
+    for cube, mask in jobs:
+        jid = job_id(cube, mask, settings)
+        if jid in finished:
+            records.append(dict(finished[jid], status='skipped'))
+            continue
+        pending.append(dict(settings, id=jid, cube=cube, mask=mask, output_dir=args.output_dir))
+
+    processes = args.processes if args.processes > 0 else (os.cpu_count() or 1)
+    processes = min(processes, max(1, len(pending)))
+    print(f"INFO: {len(pending)} cubes to process ({len(records)} already done) with {processes} processes")
+
+    t_run = time.perf_counter()
+    with open(progress_path, 'a') as progress:
+        def finish(record):
+            # One line per finished cube, flushed at once, so an interrupted run resumes from here
+            progress.write(json.dumps(record) + '\n')
+            progress.flush()
+            records.append(record)
+            status = 'done' if record['status'] == 'done' else f"ERROR: {record.get('error')}"
+            print(f"INFO: [{len(records)}/{len(jobs)}] {record['cube']}: {status} ({record['timings']['total']:.1f} s)")
+
+        # Parallel cubes already use the cores, so each kernel gets one thread unless told otherwise
+        moment_threads = args.moment_threads or (1 if processes > 1 else 0)
+        init_args = (int(args.moment_memory_mb * 1024 * 1024), moment_threads, args.tex_cache_dir)
+        usetex_available() # Checked (and warned about) once, not per worker
+        if processes == 1:
+            _init_worker(*init_args)
+            for job in pending:
+                finish(process_cube(job))
+        else:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=init_args) as pool:
+                futures = [pool.submit(process_cube, job) for job in pending]
+                for future in as_completed(futures):
+                    finish(future.result())
+    elapsed = time.perf_counter() - t_run
+
+    report_path = os.path.join(args.output_dir, REPORT_FILE)
+    write_report(report_path, records)
+
+    ran = [r for r in records if r['status'] != 'skipped']
+    failed = [r for r in ran if r['status'] == 'error']
+    print(f"INFO: {len(ran) - len(failed)} done, {len(failed)} failed, {len(records) - len(ran)} skipped in {elapsed:.1f} s")
+    if ran:
+        for stage in STAGES + ('total',):
+            values = [r['timings'][stage] for r in ran if stage in r['timings']]
+            if values:
+                print(f"INFO:   {stage:8s} mean {sum(values) / len(values):7.2f} s   max {max(values):7.2f} s")
+    print(f"INFO: Timing report written to {report_path}")
+    return 1 if failed else 0
+
+def main():
+    return run(parse_batch_arguments())
@@ -0,0 +1,193 @@
+import io
+import math
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+
+from .beam_plotter import draw_beam
+from .moments.calculator import get_spectral_axis
+from .plotter import (_plot_lock, TEXT_PROFILES, SAVE_DPI, resolve_text_profile,
+                      get_unit_scale, get_display_limits)
+
+# Upper bound on panels in one figure
+CHANNEL_MAP_MAX_PANELS = 256
+
+# Threads preparing and rasterising panels
+CHANNEL_MAP_WORKERS = min(8, os.cpu_count() or 1)
+
+# Raw channels (float32) held at once per worker while panels are prepared
+CHANNEL_MAP_MEMORY_BUDGET = 128 * 1024 * 1024
+
+CMAP = 'viridis'
+
+def panel_channels(start, end, stride=1, binning=1, n_channels=None):
+    """
+    Channel indices of each panel as an (n_panels, binning) array: panel i averages
+    channels start + i*stride .. + binning - 1. Panels whose bin runs past end are dropped.
+    """
+    stride = max(1, int(stride))
+    binning = max(1, int(binning))
+    start = max(0, int(start))
+    if n_channels is not None:
+        end = min(int(end), n_channels - 1)
+    first = np.arange(start, end - binning + 2, stride)
+    return first[:, None] + np.arange(binning)[None, :]
+
+def _downsample_factor(shape, panel_pixels):
+    # Integer block size bringing a panel close to its size on the page, never below it
+    return max(1, int(min(shape) // max(1, panel_pixels)))
+
+def _prepare_chunk(data, mask, invert_mask, channels, factor):
+    """
+    Vectorized over a chunk of panels: gathers their channels, applies the mask,
+    averages each bin and block-averages the result by factor.
+    Returns a float32 array (k, ceil(H/factor), ceil(W/factor)).
+    """
+    k, binning = channels.shape
+    flat = channels.ravel()
+    raw = np.asarray(data[flat], dtype=np.float32)
+    if mask is not None:
+        planes = mask[flat] if mask.ndim == 3 else mask[None, :, :]
+        keep = np.logical_or(planes <= 0, np.isnan(planes)) if invert_mask else planes > 0
+        raw = np.where(keep, raw, np.float32(np.nan))
+    h, w = raw.shape[1:]
+
+    with warnings.catch_warnings():
+        # Fully blank pixels average to NaN on purpose
+        warnings.simplefilter('ignore', RuntimeWarning)
+        panels = np.nanmean(raw.reshape(k, binning, h, w), axis=1)
+        if factor > 1:
+            ph, pw = -(-h // factor) * factor, -(-w // factor) * factor
+            if (ph, pw) != (h, w):
+                padded = np.full((k, ph, pw), np.nan, dtype=np.float32)
+                padded[:, :h, :w] = panels
+                panels = padded
+            panels = np.nanmean(panels.reshape(k, ph // factor, factor, pw // factor, factor), axis=(2, 4))
+    return panels.astype(np.float32, copy=False)
+
+def _rasterise(panels, norm, cmap):
+    # Colormap lookup straight to RGBA bytes; NaN becomes transparent
+    return cmap(norm(panels), bytes=True)
+
+def _grid_shape(n_panels, columns=None):
+    ncols = int(columns) if columns else math.ceil(math.sqrt(n_panels))
+    ncols = max(1, min(ncols, n_panels))
+    return math.ceil(n_panels / ncols), ncols
+
+def render_channel_map(data, wcs, unit_label, channels, mask=None, invert_mask=False,
+                       title="", grid=False, beam=None, show_beam=False,
+                       norm_global=False, global_min=None, global_max=None,
+                       user_vmin=None, user_vmax=None, cbar_unit='None',
+                       fig_width=8, columns=None, cbar_label="Specific Intensity",
+                       fmt='png', text_profile='export'):
+    """
+    One figure with a grid of channel panels (channels from panel_channels), sharing
+    a single WCS axis setup, colour normalisation and colorbar. Returns the encoded bytes.
+    Panels are prepared and colour-mapped in parallel, then placed as RGBA images.
+    """
+    n_panels = len(channels)
+    if n_panels == 0:
+        raise ValueError("No channels in the requested range.")
+    if n_panels > CHANNEL_MAP_MAX_PANELS:
+        raise ValueError(f"Channel map would have {n_panels} panels (at most {CHANNEL_MAP_MAX_PANELS}); increase the stride.")
+
+    nrows, ncols = _grid_shape(n_panels, columns)
+    h, w = data.shape[1:]
+    fig_width = float(fig_width)
+    # Fixed margins (inches) instead of a tight bounding box, which would draw the figure twice
+    left, right, bottom, top, gap = 0.9, 1.1, 0.6, (0.5 if title else 0.15), 0.1
+    panel_w = max(0.2, (fig_width - left - right - gap * (ncols - 1)) / ncols)
+    panel_h = panel_w * h / w
+    step_x, step_y = panel_w + gap, panel_h + gap
+    fig_height = nrows * step_y - gap + bottom + top
+    factor = _downsample_factor((h, w), panel_w * SAVE_DPI)
+
+    # --- PANEL DATA (parallel, vectorized per chunk) ---
+    per_chunk = max(1, CHANNEL_MAP_MEMORY_BUDGET // max(1, channels.shape[1] * h * w * 4))
+    chunks = [channels[i:i + per_chunk] for i in range(0, n_panels, per_chunk)]
+    with ThreadPoolExecutor(max_workers=CHANNEL_MAP_WORKERS) as pool:
+        panels = np.concatenate(list(pool.map(
+            lambda c: _prepare_chunk(data, mask, invert_mask, c, factor), chunks)))
+
+        # --- SHARED NORMALISATION ---
+        scale_factor, unit_prefix = get_unit_scale(cbar_unit)
+        vmin, vmax = get_display_limits(panels, norm_global, global_min, global_max,
+                                        user_vmin, user_vmax, scale_factor=scale_factor)
+        norm = Normalize(vmin=vmin / scale_factor, vmax=vmax / scale_factor, clip=True)
+        cmap = matplotlib.colormaps[CMAP]
+
+        # --- RASTERISATION (parallel) ---
+        rgba = np.concatenate(list(pool.map(
+            lambda p: _rasterise(p, norm, cmap), np.array_split(panels, min(n_panels, CHANNEL_MAP_WORKERS)))))
+
+    v, v_unit = get_spectral_axis(wcs, 0, data.shape[0])
+    velocities = v[channels].mean(axis=1)
+
+    # --- FIGURE ---
+    text_profile = resolve_text_profile(text_profile)
+    wcs_2d = wcs.celestial
+    with _plot_lock, plt.rc_context(TEXT_PROFILES[text_profile]):
+        fig = plt.figure(figsize=(fig_width, fig_height))
+        try:
+            extent = (-0.5, rgba.shape[2] * factor - 0.5, -0.5, rgba.shape[1] * factor - 0.5)
+            for i in range(n_panels):
+                row, col = divmod(i, ncols)
+                bottom_row = i + ncols >= n_panels
+                left_col = col == 0
+                rect = ((left + col * step_x) / fig_width, (bottom + (nrows - 1 - row) * step_y) / fig_height,
+                        panel_w / fig_width, panel_h / fig_height)
+
+                # Coordinate axes (the expensive part to draw) only where they are labelled,
+                # or everywhere when grid lines are requested
+                if grid or bottom_row or left_col:
+                    ax = fig.add_axes(rect, projection=wcs_2d)
+                    ax.tick_params(direction='in', color='white')
+                    # Few, small ticks so labels of neighbouring panels do not run into each other
+                    for coord in (ax.coords[0], ax.coords[1]):
+                        coord.set_ticks(number=3)
+                        coord.set_ticklabel(size=7)
+                    ax.coords[0].set_ticklabel_visible(bottom_row)
+                    ax.coords[1].set_ticklabel_visible(left_col)
+                    ax.coords[0].set_axislabel('Right Ascension [J2000]' if bottom_row and left_col else '')
+                    ax.coords[1].set_axislabel('Declination [J2000]' if bottom_row and left_col else '')
+                    if grid:
+                        ax.coords.grid(True, ls='dotted', color='white', alpha=0.6)
+                else:
+                    ax = fig.add_axes(rect)
+                    ax.set_xticks([])
+                    ax.set_yticks([])
+
+                ax.imshow(rgba[i], origin='lower', extent=extent, interpolation='nearest')
+                ax.set_xlim(-0.5, w - 0.5)
+                ax.set_ylim(-0.5, h - 0.5)
+
+                ax.text(0.04, 0.96, f"{velocities[i]:.1f} {v_unit}", transform=ax.transAxes,
+                        ha='left', va='top', fontsize=8,
+                        bbox={'facecolor': 'white', 'alpha': 0.7, 'edgecolor': 'none', 'pad': 1.5})
+                if show_beam and bottom_row and left_col:
+                    draw_beam(ax, wcs_2d, beam, (h, w))
+
+            if title:
+                fig.suptitle(title, fontsize=14, y=1 - 0.1 / fig_height, va='top')
+
+            final_unit_label = f"{unit_prefix}{unit_label}"
+            if not (final_unit_label.startswith('[') and final_unit_label.endswith(']')):
+                final_unit_label = f"[{final_unit_label}]"
+            grid_top = bottom + nrows * step_y - gap
+            cax = fig.add_axes(((left + ncols * step_x) / fig_width, bottom / fig_height,
+                                0.15 / fig_width, (grid_top - bottom) / fig_height))
+            sm = ScalarMappable(norm=Normalize(vmin=vmin, vmax=vmax), cmap=cmap)
+            cbar = fig.colorbar(sm, cax=cax)
+            cbar.set_label(f'{cbar_label} {final_unit_label}', rotation=270, labelpad=20)
+
+            buf = io.BytesIO()
+            fig.savefig(buf, format=fmt, dpi=SAVE_DPI)
+            return buf.getvalue()
+        finally:
+            plt.close(fig)
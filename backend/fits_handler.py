@@ -1,12 +1,167 @@
+import hashlib
 import io
+import mmap
 import os
+import shutil
+import tempfile
+import threading
 import numpy as np
 from astropy.io import fits
 from astropy.wcs import WCS
+from .render_cache import new_token, render_cache
+from .statistics import cube_statistics
+
+# Uploaded files are spooled here so they can be memory-mapped like local files
+UPLOAD_DIR = os.path.join(tempfile.gettempdir(), 'cubefig_uploads')
+UPLOAD_COPY_BUFFER = 16 * 1024 * 1024
+
+# Content fingerprints hash the header, the file's stat and this many evenly spaced blocks of the file
+FINGERPRINT_BLOCKS = 64
+FINGERPRINT_BLOCK_BYTES = 64 * 1024
+
+class Dataset:
+    """
+    One opened FITS file, shared read-only by every session that loads it.
+    Holds the HDU list, the squeezed data array and statistics derived from it.
+    """
+
+    def __init__(self, key, hdul, data, header, spool_path=None):
+        self.key = key
+        self.hdul = hdul
+        self.data = data
+        self.header = header
+        self.spool_path = spool_path # Uploaded file owned by this dataset
+        self.token = new_token() # Identity used to key rendered images
+        self.refs = 0
+        self._wcs = None
+        self._statistics = None
+        self._fingerprint = None
+        self.spectral = None # Spectral-major copy (backend.spectra.SpectralCube), when requested
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock() # Held for a whole pass over the cube; kept apart from _lock
+
+    @property
+    def wcs(self):
+        # Shared, so figure templates keyed by WCS identity are shared between sessions too
+        with self._lock:
+            if self._wcs is None:
+                self._wcs = WCS(self.header)
+            return self._wcs
+
+    @property
+    def fingerprint(self):
+        """
+        Hash of the file (header, shape, size, modification time, inode and sampled data
+        blocks), stable across restarts. Computed once, reading a few MB.
+        The sampled blocks alone would miss pixels rewritten between them under the same
+        header and size, so the file's mtime and inode are part of it: a touched or copied
+        file gets a new fingerprint (and recomputes its stored maps) rather than risk
+        serving stale ones, which hashing the whole cube would avoid at the cost of a full read.
+        """
+        with self._lock:
+            if self._fingerprint is None:
+                self._fingerprint = _content_fingerprint(self.key[0], self.header, self.data)
+            return self._fingerprint
+
+    @property
+    def statistics(self):
+        """
+        CubeStatistics of the data, computed on first use (one streamed pass) or read
+        from the cube's statistics cache file. Spooled uploads are not cached on disk.
+        """
+        with self._stats_lock:
+            if self._statistics is None:
+                self._statistics = cube_statistics(self.key, self.data, persist=self.spool_path is None)
+            return self._statistics
+
+    @property
+    def global_range(self):
+        """(min, max) of the finite values; (None, None) if there are none."""
+        stats = self.statistics
+        return stats.min, stats.max
+
+    def resident_bytes(self):
+        """Memory held by the data array; mapped arrays live in the page cache instead."""
+        return 0 if _is_mapped(self.data) else self.data.nbytes
+
+    def close(self):
+        render_cache.invalidate(self.token)
+        if self.spectral is not None:
+            self.spectral.close()
+        _close_hdul(self.hdul)
+        _remove_file(self.spool_path)
+
+class DatasetPool:
+    """
+    Opened FITS files keyed by (path, size, mtime, memmap), reference counted.
+    Sessions that load the same unchanged file share one Dataset.
+    """
+
+    def __init__(self):
+        self._datasets = {}
+        self._lock = threading.Lock()
+        self._close_listeners = []
+
+    def on_close(self, fn):
+        """Registers fn(dataset), called after a dataset's last reference is released and it is closed."""
+        self._close_listeners.append(fn)
+
+    def open(self, path, memmap=True, spool_path=None):
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime_ns, bool(memmap))
+        with self._lock:
+            dataset = self._datasets.get(key)
+            if dataset is None:
+                dataset = self._open(key, path, memmap, spool_path)
+                self._datasets[key] = dataset
+            else:
+                print(f"DEBUG: Sharing already opened {os.path.basename(path)}")
+            dataset.refs += 1
+            return dataset
+
+    def _open(self, key, path, memmap, spool_path):
+        hdul = fits.open(path, memmap=memmap)
+        try:
+            data = hdul[0].data
+            header = hdul[0].header
+            # If primary is empty (common in some standards), check extension 1
+            if data is None and len(hdul) > 1:
+                data = hdul[1].data
+                header = hdul[1].header
+            if data is None:
+                raise ValueError('File contains no image data.')
+            return Dataset(key, hdul, np.squeeze(data), header, spool_path)
+        except Exception:
+            _close_hdul(hdul)
+            raise
+
+    def release(self, dataset):
+        """Drops one reference; the file is closed when no session uses it any more."""
+        if dataset is None:
+            return
+        with self._lock:
+            dataset.refs -= 1
+            if dataset.refs > 0:
+                return
+            if self._datasets.get(dataset.key) is dataset:
+                del self._datasets[dataset.key]
+        dataset.close()
+        for fn in self._close_listeners:
+            fn(dataset)
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(d.resident_bytes() for d in self._datasets.values())
+
+# Shared by all sessions
+datasets = DatasetPool()
 
-# Global state storage
-# In a real multi-user web app, this would be replaced by a Redis cache or session file
 class FitsState:
+    """
+    Everything one session has loaded: cube and mask (shared Datasets), moment maps
+    and the moment index. Sessions are created by backend.sessions.SessionRegistry.
+    """
     def __init__(self):
         self.data = None
         self.header = None
@@ -17,69 +172,131 @@ class FitsState:
         self.mask_filename = None
         self.mask_path = None # Store generic path
         self.unit = "Arbitrary Units"
-        self.global_min = None
-        self.global_max = None
-        self.moment_data = {} # {type: {'data': array, 'unit': label}}
+        self.beam = None
+        self.moment_data = {} # {type: {'data': array, 'unit': label, 'token': id, 'level': pyramid factor}}
+        self.pv_data = None # Last position-velocity slice (see backend.pv.compute_pv), with its token
+
+        # Identity tokens of the loaded cube and mask, used to key rendered images
+        self.data_token = None
+        self.mask_token = None
+
+        # Optional prefix-sum index for instant moments over any channel range
+        self.use_moment_index = False
+        self.moment_index = None
+
+        # Memory-mapped mode: data stays on disk and get_slice only pages in one channel
+        self.use_memmap = True
+        self.dataset = None
+        self.mask_dataset = None
 
     def load_fits(self, file_storage):
         """
         Reads from a Flask FileStorage object.
+        The upload is spooled to disk first so it can be mapped instead of held in memory.
         """
         try:
-            hdul = fits.open(file_storage.stream)
-            return self._process_hdul(hdul, file_storage.filename)
+            dataset = self._open_upload(file_storage)
         except Exception as e:
             return {"error": str(e)}
+        result = self._process_hdul(dataset, file_storage.filename)
+        if "success" in result:
+            self.file_path = None
+        return result
 
     def load_fits_from_path(self, path):
         """
         Reads from a local file path.
         """
         try:
-            hdul = fits.open(path)
-            self.file_path = os.path.abspath(path)
-            return self._process_hdul(hdul, os.path.basename(path))
+            dataset = datasets.open(path, memmap=self.use_memmap)
         except Exception as e:
             return {"error": str(e)}
+        result = self._process_hdul(dataset, os.path.basename(path))
+        if "success" in result:
+            self.file_path = os.path.abspath(path)
+        return result
 
     def load_mask(self, file_storage):
         """
         Reads mask from a Flask FileStorage object.
         """
         try:
-            hdul = fits.open(file_storage.stream)
-            return self._process_mask(hdul, file_storage.filename)
+            dataset = self._open_upload(file_storage)
         except Exception as e:
             return {"error": str(e)}
+        result = self._process_mask(dataset, file_storage.filename)
+        if "success" in result:
+            self.mask_path = None
+        return result
 
     def load_mask_from_path(self, path):
         """
         Reads mask from a local file path.
         """
         try:
-            hdul = fits.open(path)
-            self.mask_path = os.path.abspath(path)
-            return self._process_mask(hdul, os.path.basename(path))
+            dataset = datasets.open(path, memmap=self.use_memmap)
         except Exception as e:
             return {"error": str(e)}
+        result = self._process_mask(dataset, os.path.basename(path))
+        if "success" in result:
+            self.mask_path = os.path.abspath(path)
+        return result
 
-    def _process_mask(self, hdul, filename):
+    def _open_upload(self, file_storage):
+        # The spooled copy belongs to the dataset and is removed when it is closed
+        path = self._spool_upload(file_storage)
+        try:
+            return datasets.open(path, memmap=self.use_memmap, spool_path=path)
+        except Exception:
+            _remove_file(path)
+            raise
+
+    def _spool_upload(self, file_storage):
+        """
+        Copies an uploaded file to disk in large blocks and returns its path.
+        """
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        suffix = '_' + os.path.basename(file_storage.filename or 'upload.fits')
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=UPLOAD_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(file_storage.stream, f, UPLOAD_COPY_BUFFER)
+        except Exception:
+            _remove_file(path)
+            raise
+        return path
+
+    @property
+    def global_min(self):
+        return self.dataset.global_range[0] if self.dataset is not None else None
+
+    @property
+    def global_max(self):
+        return self.dataset.global_range[1] if self.dataset is not None else None
+
+    @property
+    def statistics(self):
+        return self.dataset.statistics if self.dataset is not None else None
+
+    def clip_range(self, percent):
+        """Limits of the central `percent` % of the cube's values (see CubeStatistics.clip_range)."""
+        if self.dataset is None:
+            return None, None
+        return self.dataset.statistics.clip_range(percent)
+
+    def _process_mask(self, dataset, filename):
         try:
             if self.data is None:
                 raise ValueError("Load a data cube before loading a mask.")
 
-            mask_data = hdul[0].data
-            if mask_data is None and len(hdul) > 1:
-                mask_data = hdul[1].data
-
-            mask_data = np.squeeze(mask_data)
+            mask_data = dataset.data
 
             # Support 2D mask for 3D cube (broadcast spatially)
             if mask_data.ndim == 2:
                 if mask_data.shape != self.data.shape[-2:]:
                     raise ValueError(f"2D Mask shape {mask_data.shape} does not match data spatial shape {self.data.shape[-2:]}.")
-                # Broadcast up to 3D
-                mask_data = np.repeat(mask_data[np.newaxis, :, :], self.data.shape[0], axis=0)
+                # Broadcast up to 3D as a read-only view (no per-channel copies)
+                mask_data = np.broadcast_to(mask_data[np.newaxis, :, :], self.data.shape)
             elif mask_data.ndim == 3:
                 if mask_data.shape != self.data.shape:
                     raise ValueError(f"3D Mask shape {mask_data.shape} does not match data shape {self.data.shape}.")
@@ -88,46 +305,40 @@ class FitsState:
 
             self.mask = mask_data
             self.mask_filename = filename
-            
+            self.moment_index = None
+            datasets.release(self.mask_dataset)
+            self.mask_dataset = dataset
+            self.mask_token = dataset.token
+
+            # Full-mask statistics are skipped: they would page in the whole mapped file
             print(f"DEBUG: Mask processed from {filename}")
             print(f"DEBUG: Final Mask shape: {self.mask.shape}")
-            finite_mask = self.mask[np.isfinite(self.mask)]
-            if finite_mask.size > 0:
-                print(f"DEBUG: Mask Min/Max/Mean: {np.min(finite_mask)} / {np.max(finite_mask)} / {np.mean(finite_mask)}")
-                print(f"DEBUG: Non-zero mask pixels: {np.count_nonzero(self.mask)}")
-            else:
-                print("DEBUG: Mask is entirely NaN!")
 
             return {"success": True, "filename": filename}
         except Exception as e:
+            datasets.release(dataset)
             return {"error": str(e)}
 
-    def _process_hdul(self, hdul, filename):
+    def _process_hdul(self, dataset, filename):
         try:
-            self.moment_data = {}
-            data = hdul[0].data
-            header = hdul[0].header
-            
-            # If primary is empty (common in some standards), check extension 1
-            if data is None and len(hdul) > 1:
-                data = hdul[1].data
-                header = hdul[1].header
-
-            # Ensure data shape is correct
-            data = np.squeeze(data)
+            data = dataset.data
+            header = dataset.header
             
             if data.ndim < 3:
                 raise ValueError('File is not a 3D Data Cube (Channels, Y, X).')
 
             # Store in state
+            self._clear_moments()
+            datasets.release(self.dataset)
+            self.dataset = dataset
             self.data = data
             self.header = header
-            self.wcs = WCS(header)
+            self.wcs = dataset.wcs
             self.filename = filename
-            
-            # Calculate global min/max for normalization
-            self.global_min = float(np.nanmin(data))
-            self.global_max = float(np.nanmax(data))
+            self.data_token = dataset.token
+
+            # A mask belongs to the cube it was loaded for
+            self._clear_mask()
             
             # Extract Unit
             self.unit = header.get('BUNIT', 'Arbitrary Units').strip()
@@ -142,12 +353,131 @@ class FitsState:
             return {"success": True, "channels": data.shape[0], "filename": self.filename}
 
         except Exception as e:
+            datasets.release(dataset)
             return {"error": str(e)}
 
+    def _clear_moments(self):
+        for info in self.moment_data.values():
+            render_cache.invalidate(info['token'])
+        self.moment_data = {}
+        self.moment_index = None
+        self._clear_pv()
+
+    def _clear_pv(self):
+        if self.pv_data is not None:
+            render_cache.invalidate(self.pv_data['token'])
+        self.pv_data = None
+
+    def _clear_mask(self):
+        datasets.release(self.mask_dataset)
+        self.mask_dataset = None
+        self.mask = None
+        self.mask_token = None
+        self.mask_filename = None
+        self.mask_path = None
+        self.moment_index = None
+
+    def close(self):
+        """Releases everything this session holds."""
+        self._clear_moments()
+        self._clear_mask()
+        datasets.release(self.dataset)
+        self.dataset = None
+        self.data = None
+        self.header = None
+        self.wcs = None
+
+    def snapshot(self):
+        """
+        Read-only copy of the loaded cube and mask (datasets, arrays and tokens) for work
+        that finishes later, so a cube or mask loaded meanwhile cannot mix into it.
+        The copy holds no references of its own and is never closed.
+        """
+        view = FitsState()
+        for name in ('data', 'header', 'wcs', 'filename', 'unit', 'beam', 'dataset', 'data_token',
+                     'mask', 'mask_filename', 'mask_dataset', 'mask_token', 'use_memmap'):
+            setattr(view, name, getattr(self, name))
+        return view
+
+    def memory_bytes(self):
+        """Memory owned by this session alone (moment maps and an in-RAM moment index)."""
+        total = sum(info['data'].nbytes for info in self.moment_data.values())
+        if self.pv_data is not None:
+            total += self.pv_data['data'].nbytes
+        index = self.moment_index
+        if index is not None and not _is_mapped(index.prefix):
+            total += index.prefix.nbytes
+        return total
+
+    def set_moment(self, mom, data, unit, level=1):
+        """
+        Stores a computed moment map, dropping renders of the map it replaces.
+        level is the overview pyramid factor a quick-look map was computed at.
+        """
+        old = self.moment_data.get(mom)
+        if old is not None:
+            render_cache.invalidate(old['token'])
+        self.moment_data[mom] = {'data': data, 'unit': unit, 'token': new_token(), 'level': int(level)}
+
+    def set_pv(self, pv):
+        """Stores an extracted position-velocity slice, dropping renders of the previous one."""
+        self._clear_pv()
+        self.pv_data = dict(pv, token=new_token())
+
     def get_slice(self, channel_index):
         if self.data is None:
             return None
         return self.data[channel_index, :, :]
 
-# Initialize a global instance
-state = FitsState()
\ No newline at end of file
+def keep_mask(mask, invert=False):
+    """
+    Boolean array of the pixels a mask keeps: mask > 0, or mask <= 0 / NaN when inverted.
+    """
+    if invert:
+        # Keep where mask <= 0 or NaN (treating NaN as 0/masked in original)
+        return np.logical_or(mask <= 0, np.isnan(mask))
+    # Keep where mask > 0 and not NaN
+    return mask > 0
+
+def apply_mask(image, mask, invert=False):
+    """
+    Returns a copy of image with pixels outside the mask (see keep_mask) set to NaN.
+    """
+    return np.where(keep_mask(mask, invert), image, np.nan)
+
+def _content_fingerprint(path, header, data):
+    digest = hashlib.sha256()
+    digest.update(header.tostring().encode('ascii', 'replace'))
+    digest.update(repr((data.shape, data.dtype.str)).encode())
+    st = os.stat(path)
+    size = st.st_size
+    digest.update(repr((size, st.st_mtime_ns, st.st_ino)).encode())
+    with open(path, 'rb') as f:
+        step = max(FINGERPRINT_BLOCK_BYTES, size // FINGERPRINT_BLOCKS)
+        for offset in range(0, size, step):
+            f.seek(offset)
+            digest.update(f.read(FINGERPRINT_BLOCK_BYTES))
+    return digest.hexdigest()
+
+def _is_mapped(arr):
+    # Walks the view chain down to the buffer that owns the memory
+    while arr is not None:
+        if isinstance(arr, (np.memmap, mmap.mmap)):
+            return True
+        arr = getattr(arr, 'base', None)
+    return False
+
+def _close_hdul(hdul):
+    # Mapped arrays still referenced elsewhere stay valid; astropy keeps the mmap alive
+    if hdul is not None:
+        try:
+            hdul.close()
+        except Exception as e:
+            print(f"Warning: Could not close FITS file: {e}")
+
+def _remove_file(path):
+    if path and os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Warning: Could not remove spooled upload {path}: {e}")
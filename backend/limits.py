@@ -0,0 +1,221 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from .fits_handler import keep_mask
+
+# Pixels sampled per map for automatic (ZScale) colour limits; astropy's default
+ZSCALE_SAMPLES = 1000
+
+# Cached automatic limits (one pair per channel or moment map and mask state)
+AUTO_LIMITS_ENTRIES = 8192
+
+# Channels sampled at once when limits are precomputed for a whole cube (float32 bytes)
+PRECOMPUTE_CHUNK_BYTES = 64 * 1024 * 1024
+
+# ZScale parameters (astropy.visualization.ZScaleInterval defaults)
+ZSCALE_CONTRAST = 0.25
+ZSCALE_MAX_REJECT = 0.5
+ZSCALE_MIN_NPIXELS = 5
+ZSCALE_KREJ = 2.5
+ZSCALE_MAX_ITERATIONS = 5
+
+def sample_rows(block, mask=None, invert_mask=False, n_samples=None):
+    """
+    Deterministic ZScale samples of each row of a 2D array (one flattened map per row):
+    every stride-th pixel, with masked-out and non-finite pixels dropped.
+    Returns (samples, counts): rows sorted ascending with NaN padding at the end, and
+    the number of valid samples per row. Rows left with fewer than half the samples
+    (mostly blank or masked maps) are resampled over their valid pixels only.
+    """
+    n_samples = n_samples or ZSCALE_SAMPLES
+    size = block.shape[1]
+    stride = int(max(1.0, size / n_samples))
+    idx = np.arange(0, size, stride)[:n_samples]
+
+    samples = np.array(block[:, idx], dtype=np.float64)
+    if mask is not None:
+        samples[~keep_mask(mask[:, idx], invert_mask)] = np.nan
+    counts = np.isfinite(samples).sum(axis=1)
+
+    if stride > 1:
+        for r in np.flatnonzero(counts < len(idx) // 2):
+            row = np.asarray(block[r], dtype=np.float64)
+            valid = np.isfinite(row)
+            if mask is not None:
+                valid &= keep_mask(mask[r], invert_mask)
+            values = row[valid]
+            # Same sampling as astropy's ZScaleInterval: stride over the valid values
+            values = values[::int(max(1.0, values.size / n_samples))][:n_samples]
+            samples[r] = np.nan
+            samples[r, :values.size] = values
+            counts[r] = values.size
+
+    samples.sort(axis=1) # NaN sorts last
+    return samples, counts
+
+def zscale_rows(samples, counts):
+    """
+    ZScale limits of many sample rows at once (the IRAF algorithm as implemented by
+    astropy's ZScaleInterval.get_limits, vectorized over rows).
+    samples and counts as returned by sample_rows. Returns (vmin, vmax) arrays, NaN for empty rows.
+    """
+    n_rows, width = samples.shape
+    x = np.arange(width, dtype=np.float64)
+    valid = x[None, :] < counts[:, None]
+    has_data = counts > 0
+    last_index = np.maximum(counts - 1, 0)
+    rows = np.arange(n_rows)
+
+    vmin = np.where(has_data, samples[:, 0], np.nan)
+    vmax = np.where(has_data, samples[rows, last_index], np.nan)
+    minpix = np.maximum(ZSCALE_MIN_NPIXELS, (counts * ZSCALE_MAX_REJECT).astype(int))
+    ngrow = np.maximum(1, (counts * 0.01).astype(int))
+    y = np.where(valid, samples, 0.0)
+
+    bad = np.zeros((n_rows, width), dtype=bool)
+    ngood = counts.copy()
+    last_ngood = counts + 1
+    slope = np.full(n_rows, np.nan)
+    active = np.ones(n_rows, dtype=bool)
+
+    for _ in range(ZSCALE_MAX_ITERATIONS):
+        active &= (ngood < last_ngood) & (ngood >= minpix)
+        if not active.any():
+            break
+
+        # Least-squares line through the good samples of each row
+        w = (valid & ~bad).astype(np.float64)
+        s, sx, sy = w.sum(1), (w * x).sum(1), (w * y).sum(1)
+        sxx, sxy = (w * x * x).sum(1), (w * x * y).sum(1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fit_slope = (s * sxy - sx * sy) / (s * sxx - sx * sx)
+            fit_intercept = (sy - fit_slope * sx) / s
+            flat = y - (fit_slope[:, None] * x + fit_intercept[:, None])
+            mean = (w * flat).sum(1) / s
+            std = np.sqrt((w * (flat - mean[:, None]) ** 2).sum(1) / s)
+        threshold = ZSCALE_KREJ * std
+
+        rejected = bad | (valid & ((flat < -threshold[:, None]) | (flat > threshold[:, None])))
+        grown = _dilate(rejected, ngrow, counts) & valid
+
+        upd = active[:, None]
+        bad = np.where(upd, grown, bad)
+        slope = np.where(active, fit_slope, slope)
+        last_ngood = np.where(active, ngood, last_ngood)
+        ngood = np.where(active, (valid & ~bad).sum(1), ngood)
+
+    use_fit = has_data & (ngood >= minpix) & np.isfinite(slope)
+    fitted = slope / ZSCALE_CONTRAST if ZSCALE_CONTRAST > 0 else slope
+    center = (counts - 1) // 2
+    median = 0.5 * (samples[rows, np.maximum(center, 0)] + samples[rows, np.maximum(counts // 2, 0)])
+    with np.errstate(invalid='ignore'):
+        vmin = np.where(use_fit, np.maximum(vmin, median - (center - 1) * fitted), vmin)
+        vmax = np.where(use_fit, np.minimum(vmax, median + (counts - center) * fitted), vmax)
+    return vmin, vmax
+
+def zscale_limits(data, mask=None, invert_mask=False, n_samples=None):
+    """ZScale (vmin, vmax) of one map (any shape) from a subsample, or None if it has no valid pixels."""
+    flat = np.asarray(data).reshape(1, -1)
+    flat_mask = np.asarray(mask).reshape(1, -1) if mask is not None else None
+    samples, counts = sample_rows(flat, flat_mask, invert_mask, n_samples)
+    if counts[0] == 0:
+        return None
+    vmin, vmax = zscale_rows(samples, counts)
+    return float(vmin[0]), float(vmax[0])
+
+def precompute_channel_limits(data, mask=None, invert_mask=False, n_samples=None, chunk_bytes=None):
+    """
+    ZScale limits of every channel of a cube, a block of channels at a time and
+    vectorized within each block. Returns an (n_channels, 2) array, NaN for blank channels.
+    """
+    n_channels = data.shape[0]
+    plane_size = int(np.prod(data.shape[1:]))
+    per_chunk = max(1, (chunk_bytes or PRECOMPUTE_CHUNK_BYTES) // max(1, plane_size * 4))
+    limits = np.full((n_channels, 2), np.nan)
+    for c0 in range(0, n_channels, per_chunk):
+        block = data[c0:c0 + per_chunk].reshape(-1, plane_size)
+        block_mask = mask[c0:c0 + per_chunk].reshape(-1, plane_size) if mask is not None else None
+        vmin, vmax = zscale_rows(*sample_rows(block, block_mask, invert_mask, n_samples))
+        limits[c0:c0 + len(block)] = np.stack([vmin, vmax], axis=1)
+    return limits
+
+class AutoLimitsCache:
+    """
+    Thread-safe LRU cache of automatic colour limits, in data units. Keys carry the
+    identity tokens of the cube, mask or moment map, so stale entries are never hit
+    and simply age out. Unit scaling is linear and applied after the lookup.
+    """
+
+    def __init__(self, max_entries=AUTO_LIMITS_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        # Computed outside the lock; two threads may occasionally both compute it
+        limits = compute()
+        self.put(key, limits)
+        return limits
+
+    def put(self, key, limits):
+        with self._lock:
+            self._entries[key] = limits
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+def channel_limits_key(state, channel, invert_mask):
+    has_mask = state.mask is not None
+    return ('channel', state.data_token, channel,
+            state.mask_token if has_mask else None, bool(invert_mask) if has_mask else False)
+
+def channel_limits(state, channel, invert_mask):
+    """Cached ZScale limits of a (masked) cube channel; only the sampled pixels are read."""
+    def compute():
+        mask = state.mask[channel] if state.mask is not None else None
+        return zscale_limits(state.data[channel], mask, invert_mask)
+    return auto_limits.get(channel_limits_key(state, channel, invert_mask), compute)
+
+def moment_limits(state, mom):
+    """Cached ZScale limits of a stored moment map."""
+    info = state.moment_data[mom]
+    return auto_limits.get(('moment', info['token']), lambda: zscale_limits(info['data']))
+
+def precompute_state_limits(state, invert_mask=False):
+    """Fills the cache with the limits of every channel of a session's cube and mask."""
+    if state.data is None:
+        return
+    # Keys before data: if the session loads another cube meanwhile, only dead keys get wrong limits
+    keys = [channel_limits_key(state, c, invert_mask) for c in range(state.data.shape[0])]
+    data, mask = state.data, state.mask
+    if data is None or data.shape[0] != len(keys):
+        return
+    limits = precompute_channel_limits(data, mask, invert_mask)
+    for key, (vmin, vmax) in zip(keys, limits):
+        auto_limits.put(key, (float(vmin), float(vmax)) if np.isfinite(vmin) else None)
+
+def _dilate(bad, ngrow, counts):
+    """
+    Per-row equivalent of np.convolve(bad, ones(ngrow), mode='same') on the first
+    counts[r] entries of each row: a pixel is bad if any pixel in its window is.
+    """
+    n_rows, width = bad.shape
+    csum = np.zeros((n_rows, width + 1), dtype=np.int64)
+    np.cumsum(bad, axis=1, out=csum[:, 1:])
+    i = np.arange(width)[None, :]
+    lo = np.clip(i - (ngrow // 2)[:, None], 0, None)
+    hi = np.minimum(i + ((ngrow - 1) // 2)[:, None], (counts - 1)[:, None])
+    hi = np.maximum(hi, lo - 1)
+    return (np.take_along_axis(csum, hi + 1, axis=1) - np.take_along_axis(csum, lo, axis=1)) > 0
+
+# Shared instance used by the routes
+auto_limits = AutoLimitsCache()
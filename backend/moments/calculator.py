@@ -1,101 +1,180 @@
 import numpy as np
 import ctypes
+import hashlib
 import os
-import sys
+
+from ..fits_handler import apply_mask
 
 # Load C library
 _lib = None
-_lib_path = os.path.join(os.path.dirname(__file__), 'cpp', 'moments.so')
+_cpp_dir = os.path.join(os.path.dirname(__file__), 'cpp')
+_lib_path = os.path.join(_cpp_dir, 'moments.so')
+_build_script = os.path.join(_cpp_dir, 'build.py')
 FORCE_PYTHON = False
 
+# Entry points of moments.c this module was written for (MOMENTS_ABI_VERSION there)
+KERNEL_ABI_VERSION = 3
+
+# Maps compute_moments can return, all from one sweep over the channel range: moments
+# 0/1/2, moments 8 (peak intensity) and 9 (velocity of the peak) as numbered by CASA's
+# immoments, and the skewness and excess kurtosis of the line profile
+MOMENTS = ('0', '1', '2', '8', '9', 'skew', 'kurt')
+
+# Highest power of the spectral coordinate each map needs summed (moments 8/9 track the peak instead)
+_MOMENT_POWERS = {'0': 0, '1': 1, '2': 2, 'skew': 3, 'kurt': 4}
+
+# Upper bound on the working set of one block of channels (bytes).
+# Channel ranges are streamed through this budget so peak memory does not grow with the range.
+MOMENT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Approximate bytes of temporaries per voxel while a block is processed
+# (masked and float64 copies, weighted product and peak search in the Python path;
+# the C kernel reads blocks in place)
+_BYTES_PER_VOXEL = 40
+
+# Element type codes understood by the C kernel (see the enum in moments.c)
+_DTYPE_CODES = {
+    ('f', 4): 0, ('f', 8): 1,
+    ('i', 1): 2, ('i', 2): 3, ('i', 4): 4, ('i', 8): 5,
+    ('u', 1): 6, ('u', 2): 7, ('u', 4): 8,
+    ('b', 1): 6,
+}
+
+def _bind(lib):
+    # void accumulate_moments_c(const char* data, int data_type, bool data_swap, int64_t data_stride_c, int64_t data_stride_y, int64_t data_stride_x,
+    #                           const char* mask, int mask_type, bool mask_swap, int64_t mask_stride_c, int64_t mask_stride_y, int64_t mask_stride_x,
+    #                           bool invert_mask, const double* u, int channels, int height, int width, int max_power, double* sums,
+    #                           double* peak, double* peak_u)
+    lib.accumulate_moments_c.argtypes = [
+        ctypes.c_void_p,               # data
+        ctypes.c_int,                  # data_type
+        ctypes.c_bool,                 # data_swap
+        ctypes.c_int64,                # data_stride_c
+        ctypes.c_int64,                # data_stride_y
+        ctypes.c_int64,                # data_stride_x
+        ctypes.c_void_p,               # mask (NULL for none)
+        ctypes.c_int,                  # mask_type
+        ctypes.c_bool,                 # mask_swap
+        ctypes.c_int64,                # mask_stride_c
+        ctypes.c_int64,                # mask_stride_y
+        ctypes.c_int64,                # mask_stride_x
+        ctypes.c_bool,                 # invert_mask
+        ctypes.POINTER(ctypes.c_double), # u (v - v_ref per channel)
+        ctypes.c_int,                  # channels
+        ctypes.c_int,                  # height
+        ctypes.c_int,                  # width
+        ctypes.c_int,                  # max_power
+        ctypes.POINTER(ctypes.c_double), # sums
+        ctypes.POINTER(ctypes.c_double), # peak (NULL unless tracked)
+        ctypes.POINTER(ctypes.c_double)  # peak_u
+    ]
+    lib.accumulate_moments_c.restype = None
+    # void finalize_moments_c(const double* sums, const double* peak, const double* peak_u, int height, int width, double dv, double v_ref,
+    #                         float* mom0_out, float* mom1_out, float* mom2_out, float* peak_out, float* vpeak_out, float* skew_out, float* kurt_out)
+    lib.finalize_moments_c.argtypes = [
+        ctypes.POINTER(ctypes.c_double), # sums
+        ctypes.POINTER(ctypes.c_double), # peak (NULL unless moment 8 or 9 is wanted)
+        ctypes.POINTER(ctypes.c_double), # peak_u
+        ctypes.c_int,                  # height
+        ctypes.c_int,                  # width
+        ctypes.c_double,               # dv
+        ctypes.c_double,               # v_ref
+        # One output per entry of MOMENTS, in that order (NULL to skip)
+        *[ctypes.POINTER(ctypes.c_float)] * len(MOMENTS)
+    ]
+    lib.finalize_moments_c.restype = None
+    lib.moments_has_openmp.restype = ctypes.c_bool
+    lib.moments_set_threads.argtypes = [ctypes.c_int]
+
+def _open_library():
+    """
+    Loads the kernel built by cpp/build.py (an explicit build step: importing this
+    module never runs a compiler). None, so the pure Python implementation is used,
+    if the library is missing, has another ABI or was built from another moments.c.
+    """
+    if not os.path.exists(_lib_path):
+        print(f"Warning: Moment kernel not built; run 'python {_build_script}' to use the C implementation")
+        return None
+
+    lib = ctypes.CDLL(_lib_path)
+    if lib.moments_abi_version() != KERNEL_ABI_VERSION:
+        print(f"Warning: Moment kernel has ABI version {lib.moments_abi_version()}, expected {KERNEL_ABI_VERSION}; "
+              f"rebuild it with 'python {_build_script}'")
+        return None
+
+    # Installs may ship the library without its source; then the ABI check has to do
+    source = os.path.join(_cpp_dir, 'moments.c')
+    if os.path.exists(source):
+        lib.moments_source_hash.restype = ctypes.c_char_p
+        with open(source, 'rb') as f:
+            expected = hashlib.sha256(f.read()).hexdigest()
+        if lib.moments_source_hash().decode() != expected:
+            print(f"Warning: Moment kernel is out of date with moments.c; rebuild it with 'python {_build_script}'")
+            return None
+
+    _bind(lib)
+    return lib
+
 try:
-    if os.path.exists(_lib_path) and not FORCE_PYTHON:
-        _lib = ctypes.CDLL(_lib_path)
-        # void calculate_moments_c(const float* data, const float* v, int channels, int height, int width, double dv, bool compute0, bool compute1, bool compute2, float* mom0_out, float* mom1_out, float* mom2_out)
-        _lib.calculate_moments_c.argtypes = [
-            ctypes.POINTER(ctypes.c_float), # data
-            ctypes.POINTER(ctypes.c_float), # v
-            ctypes.c_int,                  # channels
-            ctypes.c_int,                  # height
-            ctypes.c_int,                  # width
-            ctypes.c_double,               # dv
-            ctypes.c_bool,                 # compute0
-            ctypes.c_bool,                 # compute1
-            ctypes.c_bool,                 # compute2
-            ctypes.POINTER(ctypes.c_float), # mom0_out
-            ctypes.POINTER(ctypes.c_float), # mom1_out
-            ctypes.POINTER(ctypes.c_float)  # mom2_out
-        ]
-        _lib.calculate_moments_c.restype = None
+    if not FORCE_PYTHON:
+        _lib = _open_library()
 except Exception as e:
     print(f"Warning: Could not load C library for moments: {e}")
     _lib = None
 
-def compute_moments_python(subset, v, v_unit, bunit, requested_moments):
-    """Fallback pure python implementation"""
-    results = {}
-    dv = abs(v[1] - v[0]) if len(v) > 1 else 1.0
-    
-    # Calculate Moment 0 (Integrated Intensity)
-    sum_i = np.nansum(subset, axis=0)
-    if '0' in requested_moments:
-        results['0'] = sum_i * dv
-        results['0_unit'] = f"{bunit} {v_unit}"
-
-    # Calculate Moment 1 (Velocity Field)
-    sum_i_safe = np.where(sum_i == 0, np.nan, sum_i)
-    mom1 = np.nansum(subset * v[:, None, None], axis=0) / sum_i_safe
-    
-    if '1' in requested_moments:
-        results['1'] = mom1
-        results['1_unit'] = v_unit
-
-    # Calculate Moment 2 (Velocity Dispersion)
-    if '2' in requested_moments:
-        res_sq = (v[:, None, None] - mom1[None, :, :])**2
-        mom2 = np.sqrt(np.nansum(subset * res_sq, axis=0) / sum_i_safe)
-        results['2'] = mom2
-        results['2_unit'] = v_unit
+def kernel_info():
+    """Active moment implementation: {'backend': 'c' or 'python', 'openmp': bool, 'threads': int}."""
+    if _lib is None or FORCE_PYTHON:
+        return {'backend': 'python', 'openmp': False, 'threads': 1}
+    return {'backend': 'c', 'openmp': bool(_lib.moments_has_openmp()), 'threads': int(_lib.moments_get_threads())}
 
-    return results
+def describe_kernel():
+    """One-line description of kernel_info() for logs."""
+    info = kernel_info()
+    if info['backend'] == 'python':
+        return "pure Python"
+    threads = info['threads']
+    return f"C, {'OpenMP' if info['openmp'] else 'single-threaded'}, {threads} thread{'s' if threads != 1 else ''}"
+
+def set_kernel_threads(threads):
+    """Threads used by the C kernel; 0 keeps the OpenMP default (OMP_NUM_THREADS or one per core)."""
+    if _lib is not None and threads and threads > 0:
+        _lib.moments_set_threads(int(threads))
+
+def _float_ptr(arr):
+    return arr.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+def _double_ptr(arr):
+    return arr.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
 
-def compute_moments(data, wcs, bunit, start_chan, end_chan, requested_moments, mask=None, invert_mask=False):
+def channel_block_size(height, width, memory_budget=None):
+    """Number of channels that fit in one streamed block under the memory budget."""
+    budget = MOMENT_MEMORY_BUDGET if memory_budget is None else memory_budget
+    bytes_per_channel = max(1, height * width * _BYTES_PER_VOXEL)
+    return max(1, int(budget // bytes_per_channel))
+
+def iter_channel_blocks(data, start, end, block_size, mask=None, invert_mask=False):
     """
-    Calculates moments 0, 1, and 2 for the specified channel range.
-    Uses C accelerator if available.
+    Yields (offset, block) pairs covering data[start:end] one block of channels at a time,
+    with the mask applied. offset is relative to start.
     """
-    if data is None:
-        return {}
-
-    # Ensure range is valid
-    start = max(0, int(start_chan))
-    end = min(data.shape[0], int(end_chan) + 1)
-    
-    if start >= end:
-        return {}
+    for b0 in range(start, end, block_size):
+        b1 = min(end, b0 + block_size)
+        block = data[b0:b1, :, :]
+        if mask is not None:
+            block = apply_mask(block, mask[b0:b1, :, :], invert_mask)
+        yield b0 - start, block
 
-    subset = data[start:end, :, :]
-    
-    # Apply mask if it exists
-    if mask is not None:
-        mask_subset = mask[start:end, :, :]
-        if invert_mask:
-            keep = np.logical_or(mask_subset <= 0, np.isnan(mask_subset))
-        else:
-            keep = np.where(mask_subset > 0, True, False)
-        subset = np.where(keep, subset, np.nan)
-        
-        print(f"DEBUG: compute_moments - Invert={invert_mask}")
-        print(f"DEBUG: subset shape: {subset.shape}")
-        print(f"DEBUG: subset finite count: {np.sum(np.isfinite(subset))}")
-        print(f"DEBUG: subset min/max: {np.nanmin(subset)} / {np.nanmax(subset)}")
-    
-    # Get spectral axis
+def get_spectral_axis(wcs, start, end, dtype=np.float32):
+    """
+    Returns the spectral coordinate of channels [start, end) (float32 unless dtype says
+    otherwise) and its unit, preferring km/s and falling back to channel indices.
+    """
     try:
         spec_wcs = wcs.spectral
         pixel_coords = np.arange(start, end)
         world_coords = spec_wcs.pixel_to_world(pixel_coords)
-        
+
         if hasattr(world_coords, 'to'):
             try:
                 v = world_coords.to('km/s', equivalencies=None).value
@@ -111,58 +190,317 @@ def compute_moments(data, wcs, bunit, start_chan, end_chan, requested_moments, m
         v = np.arange(start, end)
         v_unit = 'pixels'
 
-    v = v.astype(np.float32)
+    return v.astype(dtype), v_unit
+
+def reference_velocity(v):
+    """Shift subtracted from the spectral coordinate before its powers are summed: the middle of the range."""
+    return 0.5 * (float(v[0]) + float(v[-1])) if len(v) else 0.0
+
+def moment_unit(mom, bunit, v_unit):
+    """Unit of a moment map."""
+    if mom == '0':
+        return f"{bunit} {v_unit}"
+    if mom == '8':
+        return bunit
+    if mom in ('skew', 'kurt'):
+        return ''
+    return v_unit
+
+def sweep_needs(requested_moments):
+    """(Largest power of u to sum, whether to track the peak) for the requested moments."""
+    max_power = max([_MOMENT_POWERS[m] for m in requested_moments if m in _MOMENT_POWERS], default=0)
+    return max_power, ('8' in requested_moments or '9' in requested_moments)
+
+def _new_sums(shape, max_power, track_peak):
+    # Running sums of I * u^k, and the running peak with the u of its channel (None unless tracked)
+    sums = np.zeros((max_power + 1,) + tuple(shape), dtype=np.float64)
+    if not track_peak:
+        return sums, None, None
+    return sums, np.full(shape, -np.inf), np.full(shape, np.nan)
+
+def accumulate_block_python(block, u_block, max_power, sums, peak=None, peak_u=None):
+    """
+    NumPy counterpart of accumulate_block_c for a block with the mask already applied
+    (excluded voxels NaN): sums[k] += I * u^k for k <= max_power, and the running
+    peak (first channel on ties) when peak and peak_u are given.
+    """
+    block = np.asarray(block, dtype=np.float64)
+    finite = ~np.isnan(block)
+    weighted = np.where(finite, block, 0.0)
+    u_block = np.asarray(u_block, dtype=np.float64)[:, None, None]
+    sums[0] += weighted.sum(axis=0)
+    for k in range(1, max_power + 1):
+        weighted *= u_block
+        sums[k] += weighted.sum(axis=0)
+
+    if peak is not None and block.shape[0]:
+        filled = np.where(finite, block, -np.inf)
+        channel = filled.argmax(axis=0)
+        best = np.take_along_axis(filled, channel[None], axis=0)[0]
+        better = best > peak
+        peak[better] = best[better]
+        peak_u[better] = u_block[channel[better], 0, 0]
+
+def compute_moments_python(blocks, v, v_unit, bunit, requested_moments, shape):
+    """
+    Fallback pure python implementation, and the reference the C kernel is checked
+    against (cpp/build.py).
+    blocks is a callable returning a fresh iterator of (offset, block) pairs; every
+    requested moment comes from one pass over them.
+    """
+    dv = abs(v[1] - v[0]) if len(v) > 1 else 1.0
+    v_ref = reference_velocity(v)
+    u = np.asarray(v, dtype=np.float64) - v_ref
+    max_power, track_peak = sweep_needs(requested_moments)
+    sums, peak, peak_u = _new_sums(shape, max_power, track_peak)
+
+    for offset, block in blocks():
+        accumulate_block_python(block, u[offset:offset + block.shape[0]], max_power, sums, peak, peak_u)
+
+    return finalize_moment_sums(sums, dv, v_ref, v_unit, bunit, requested_moments, peak=peak, peak_u=peak_u,
+                                use_c=False)
+
+def compute_moments_regions_python(data, mask, invert_mask, start, end, block_size, regions, v, v_unit, bunit,
+                                   requested_moments, shape):
+    """
+    Pure python moments swept over regions only (see MaskFootprint.regions).
+    Blocks keep the boundaries of the full sweep, clipped to each region's channels,
+    so every sum is the same as there; pixels outside the regions keep the empty
+    sums the full sweep gives where nothing is kept.
+    """
+    dv = abs(v[1] - v[0]) if len(v) > 1 else 1.0
+    v_ref = reference_velocity(v)
+    u = np.asarray(v, dtype=np.float64) - v_ref
+    max_power, track_peak = sweep_needs(requested_moments)
+    sums, peak, peak_u = _new_sums(shape, max_power, track_peak)
+
+    for c0, c1, y0, y1, x0, x1 in regions:
+        box = (slice(y0, y1), slice(x0, x1))
+        part, part_peak, part_peak_u = _new_sums((y1 - y0, x1 - x0), max_power, track_peak)
+        for b0 in range(start, end, block_size):
+            lo, hi = max(b0, c0), min(b0 + block_size, c1)
+            if lo >= hi:
+                continue
+            block = data[lo:hi, y0:y1, x0:x1]
+            if mask is not None:
+                block = apply_mask(block, mask[lo:hi, y0:y1, x0:x1], invert_mask)
+            accumulate_block_python(block, u[lo - start:hi - start], max_power, part, part_peak, part_peak_u)
+        sums[(slice(None),) + box] = part
+        if track_peak:
+            peak[box], peak_u[box] = part_peak, part_peak_u
+
+    return finalize_moment_sums(sums, dv, v_ref, v_unit, bunit, requested_moments, peak=peak, peak_u=peak_u,
+                                use_c=False)
+
+def _kernel_view(arr):
+    """
+    Returns (array, type code, byte swap flag) for passing a 3D block to the C kernel.
+    Supported types are passed through untouched, whatever their byte order and strides;
+    anything else is converted to float32.
+    """
+    code = _DTYPE_CODES.get((arr.dtype.kind, arr.dtype.itemsize))
+    if code is None:
+        arr = np.asarray(arr, dtype=np.float32)
+        code = _DTYPE_CODES[('f', 4)]
+    swap = arr.dtype.itemsize > 1 and not arr.dtype.isnative
+    return arr, code, swap
+
+def accumulate_block_c(data_block, mask_block, invert_mask, u_block, max_power, sums, peak=None, peak_u=None):
+    """
+    Adds one (channels, y, x) block into the running sums using the C kernel:
+    sums[k] += I * u^k for k <= max_power, with u the shifted spectral coordinate of
+    each channel, and the running peak when peak and peak_u are given. The kernel
+    applies the mask and skips NaNs itself, reading the blocks in place.
+    sums, peak and peak_u are C-contiguous float64 arrays; sums has at least max_power + 1 planes.
+    """
+    channels, height, width = data_block.shape
+    data_block, data_type, data_swap = _kernel_view(data_block)
+
+    if mask_block is not None:
+        mask_block, mask_type, mask_swap = _kernel_view(mask_block)
+        mask_ptr = mask_block.ctypes.data
+        mask_strides = mask_block.strides
+    else:
+        mask_ptr, mask_type, mask_swap = None, 0, False
+        mask_strides = (0, 0, 0)
+
+    u_c = np.ascontiguousarray(u_block, dtype=np.float64)
+
+    _lib.accumulate_moments_c(
+        data_block.ctypes.data, data_type, data_swap, *data_block.strides,
+        mask_ptr, mask_type, mask_swap, *mask_strides,
+        bool(invert_mask),
+        _double_ptr(u_c),
+        channels, height, width,
+        int(max_power),
+        _double_ptr(sums),
+        _double_ptr(peak) if peak is not None else None,
+        _double_ptr(peak_u) if peak is not None else None
+    )
+
+def compute_moments_c(data, mask, invert_mask, start, end, block_size, v, v_unit, bunit, requested_moments,
+                      regions=None):
+    """
+    C implementation: raw blocks of the cube (and mask) are handed to the kernel,
+    which adds them to double precision running sums of I * (v - v_ref)^k and tracks
+    the peak; the maps are finalized once at the end.
+    With regions (see MaskFootprint.regions) only those boxes are swept.
+    """
+    shape = data.shape[1:]
     dv = float(abs(v[1] - v[0]) if len(v) > 1 else 1.0)
-    
+    max_power, track_peak = sweep_needs(requested_moments)
+    v_ref = reference_velocity(v)
+    u = np.asarray(v, dtype=np.float64) - v_ref
+
+    sums, peak, peak_u = _new_sums(shape, max_power, track_peak)
+
+    if regions is not None:
+        for c0, c1, y0, y1, x0, x1 in regions:
+            # The kernel adds channel after channel per pixel, so the sums match the full sweep exactly
+            part, part_peak, part_peak_u = _new_sums((y1 - y0, x1 - x0), max_power, track_peak)
+            part_blocks = max(1, block_size * shape[0] * shape[1] // part[0].size)
+            for b0 in range(c0, c1, part_blocks):
+                b1 = min(c1, b0 + part_blocks)
+                mask_block = mask[b0:b1, y0:y1, x0:x1] if mask is not None else None
+                accumulate_block_c(data[b0:b1, y0:y1, x0:x1], mask_block, invert_mask, u[b0 - start:b1 - start],
+                                   max_power, part, part_peak, part_peak_u)
+            # Every pixel lies in one region, so its sums are complete here
+            sums[:, y0:y1, x0:x1] = part
+            if track_peak:
+                peak[y0:y1, x0:x1], peak_u[y0:y1, x0:x1] = part_peak, part_peak_u
+        return finalize_moment_sums(sums, dv, v_ref, v_unit, bunit, requested_moments, peak=peak, peak_u=peak_u)
+
+    for b0 in range(start, end, block_size):
+        b1 = min(end, b0 + block_size)
+        mask_block = mask[b0:b1, :, :] if mask is not None else None
+        accumulate_block_c(data[b0:b1, :, :], mask_block, invert_mask, u[b0 - start:b1 - start], max_power, sums,
+                           peak, peak_u)
+
+    return finalize_moment_sums(sums, dv, v_ref, v_unit, bunit, requested_moments, peak=peak, peak_u=peak_u)
+
+def finalize_moment_sums(sums, dv, v_ref, v_unit, bunit, requested_moments, peak=None, peak_u=None, use_c=None):
+    """
+    Turns per-pixel sums of I * u^k (sums[k], u = v - v_ref) into the requested maps
+    of MOMENTS, as in the C kernel: the dispersion from the variance identity on the
+    shifted coordinate, skewness and excess kurtosis from the central moments that
+    follow from the raw ones, and moments 8/9 from the tracked peak and its u.
+    sums needs as many planes as sweep_needs gives for the moments. Shared by the
+    streaming paths and the prefix-sum index; use_c=False keeps it in NumPy.
+    """
+    shape = sums.shape[1:]
+    height, width = shape
+    sums = np.ascontiguousarray(sums, dtype=np.float64)
+    maps = {mom: np.zeros(shape, dtype=np.float32) for mom in MOMENTS if mom in requested_moments}
+
+    if use_c is None:
+        use_c = _lib is not None and not FORCE_PYTHON
+    if use_c:
+        _lib.finalize_moments_c(
+            _double_ptr(sums),
+            _double_ptr(np.ascontiguousarray(peak)) if peak is not None else None,
+            _double_ptr(np.ascontiguousarray(peak_u)) if peak is not None else None,
+            height, width, float(dv), float(v_ref),
+            *(_float_ptr(maps[mom]) if mom in maps else None for mom in MOMENTS)
+        )
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            s_i = sums[0]
+            empty = s_i == 0.0
+            if '0' in maps:
+                maps['0'][:] = np.where(empty, 0.0, s_i * dv)
+            if len(sums) > 1:
+                mean_u = sums[1] / s_i
+            if '1' in maps:
+                maps['1'][:] = np.where(empty, np.nan, v_ref + mean_u)
+            if len(sums) > 2:
+                e2 = sums[2] / s_i
+                m2_sq = e2 - mean_u * mean_u
+            if '2' in maps:
+                maps['2'][:] = np.where(empty, np.nan, np.sqrt(np.maximum(m2_sq, 0.0)))
+            if len(sums) > 3:
+                # A profile of one channel has no shape
+                has_shape = ~empty & (m2_sq > 0.0)
+                mu2 = mean_u * mean_u
+                e3 = sums[3] / s_i
+                c3 = e3 - 3.0 * mean_u * e2 + 2.0 * mu2 * mean_u
+            if 'skew' in maps:
+                maps['skew'][:] = np.where(has_shape, c3 / (m2_sq * np.sqrt(m2_sq)), np.nan)
+            if 'kurt' in maps:
+                e4 = sums[4] / s_i
+                c4 = e4 - 4.0 * mean_u * e3 + 6.0 * mu2 * e2 - 3.0 * mu2 * mu2
+                maps['kurt'][:] = np.where(has_shape, c4 / (m2_sq * m2_sq) - 3.0, np.nan)
+            if peak is not None:
+                # Pixels without any value keep the initial -inf
+                found = peak > -np.inf
+                if '8' in maps:
+                    maps['8'][:] = np.where(found, peak, np.nan)
+                if '9' in maps:
+                    maps['9'][:] = np.where(found, v_ref + peak_u, np.nan)
+
+    results = {}
+    for mom, m in maps.items():
+        results[mom] = m
+        results[f"{mom}_unit"] = moment_unit(mom, bunit, v_unit)
+        print(f"DEBUG: Mom{mom} finite count: {np.sum(np.isfinite(m))}")
+        if mom == '0':
+            print(f"DEBUG: Mom0 min/max: {np.nanmin(m)} / {np.nanmax(m)}")
+
+    return results
+
+def compute_moments(data, wcs, bunit, start_chan, end_chan, requested_moments, mask=None, invert_mask=False,
+                    memory_budget=None, index=None, footprint=None):
+    """
+    Calculates the requested moments (any of MOMENTS) for the specified channel range,
+    all of them from one sweep.
+    The range is streamed in blocks of channels sized by memory_budget
+    (defaults to MOMENT_MEMORY_BUDGET), so peak memory does not depend on the range width.
+    If a MomentIndex built for this data, mask and invert flag is given, the maps are
+    read from its prefix sums instead of sweeping the range.
+    With the MaskFootprint of the mask and invert flag, only the boxes holding kept
+    voxels are read; the maps are exactly those of the full sweep.
+    Uses C accelerator if available.
+    """
+    if data is None:
+        return {}
+
+    # Ensure range is valid
+    start = max(0, int(start_chan))
+    end = min(data.shape[0], int(end_chan) + 1)
+
+    if start >= end:
+        return {}
+
+    if index is not None and index.matches(data, mask, invert_mask):
+        if index.supports(requested_moments):
+            print("INFO: Using prefix-sum index for moment calculation.")
+            return index.compute(start, end - 1, requested_moments, bunit)
+        print("INFO: Prefix-sum index only holds moments 0/1/2; sweeping the range.")
+
+    shape = data.shape[1:]
+    block_size = channel_block_size(shape[0], shape[1], memory_budget)
+
+    def blocks():
+        return iter_channel_blocks(data, start, end, block_size, mask=mask, invert_mask=invert_mask)
+
+    regions = None
+    if mask is not None:
+        print(f"DEBUG: compute_moments - Invert={invert_mask}")
+        if footprint is not None:
+            regions = footprint.regions(start, end)
+            swept = sum((c1 - c0) * (y1 - y0) * (x1 - x0) for c0, c1, y0, y1, x0, x1 in regions)
+            print(f"DEBUG: mask keeps {footprint.occupancy:.1%} of the cube; sweeping {len(regions)} regions "
+                  f"({swept / ((end - start) * shape[0] * shape[1]):.1%} of the range)")
+    print(f"DEBUG: streaming {end - start} channels in blocks of {block_size}")
+
+    # Get spectral axis, in double precision: narrow lines at high velocity need every digit
+    v, v_unit = get_spectral_axis(wcs, start, end, dtype=np.float64)
+
     # If C library is available, use it
     if _lib and not FORCE_PYTHON:
-        print("INFO: Using C implementation for moment calculation.")
-        channels, height, width = subset.shape
-        # Prepare arrays for C (must be contiguous and type float32)
-        # We need to make sure 'subset' is float32 and contiguous
-        subset_c = np.ascontiguousarray(subset, dtype=np.float32)
-        
-        # Sanitize NaNs to 0.0 for C processing
-        np.nan_to_num(subset_c, copy=False, nan=0.0)
-        
-        v_c = np.ascontiguousarray(v, dtype=np.float32)
-
-        # Allocate output arrays
-        m0 = np.zeros((height, width), dtype=np.float32)
-        m1 = np.zeros((height, width), dtype=np.float32)
-        m2 = np.zeros((height, width), dtype=np.float32)
-
+        print(f"INFO: Using C implementation for moment calculation ({describe_kernel()}).")
         try:
-            _lib.calculate_moments_c(
-                subset_c.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
-                v_c.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
-                channels, height, width, dv,
-                '0' in requested_moments,
-                '1' in requested_moments,
-                '2' in requested_moments,
-                m0.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
-                m1.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
-                m2.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
-            )
-
-            results = {}
-            if '0' in requested_moments:
-                results['0'] = m0
-                results['0_unit'] = f"{bunit} {v_unit}"
-                print(f"DEBUG: Mom0 finite count: {np.sum(np.isfinite(m0))}")
-                print(f"DEBUG: Mom0 min/max: {np.nanmin(m0)} / {np.nanmax(m0)}")
-
-            if '1' in requested_moments:
-                results['1'] = m1
-                results['1_unit'] = v_unit
-                print(f"DEBUG: Mom1 finite count: {np.sum(np.isfinite(m1))}")
-
-            if '2' in requested_moments:
-                results['2'] = m2
-                results['2_unit'] = v_unit
-                print(f"DEBUG: Mom2 finite count: {np.sum(np.isfinite(m2))}")
-
-            return results
+            return compute_moments_c(data, mask, invert_mask, start, end, block_size, v, v_unit, bunit, requested_moments,
+                                     regions=regions)
         except Exception as e:
             print(f"ERROR: C moment calculation failed, falling back: {e}")
             # Fallback to python happens below
@@ -172,4 +510,7 @@ def compute_moments(data, wcs, bunit, start_chan, end_chan, requested_moments, m
         print("INFO: Using pure Python implementation for moment calculation (FORCED).")
     else:
         print("INFO: Using pure Python implementation for moment calculation.")
-    return compute_moments_python(subset, v, v_unit, bunit, requested_moments)
+    if regions is not None:
+        return compute_moments_regions_python(data, mask, invert_mask, start, end, block_size, regions,
+                                              v, v_unit, bunit, requested_moments, shape)
+    return compute_moments_python(blocks, v, v_unit, bunit, requested_moments, shape)
@@ -0,0 +1,147 @@
+"""
+Builds the native moment kernel (moments.so) from moments.c and checks it against
+the pure Python implementation.
+
+    python backend/moments/cpp/build.py [--cc gcc] [--no-openmp] [--no-check]
+
+Run it once after installing or updating CubeFig (and after editing moments.c);
+calculator.py only loads the library and never compiles it. OpenMP is used when
+the compiler supports it; otherwise the kernel is built single-threaded. The
+SHA-256 of moments.c is compiled in, so calculator.py can tell when the library no
+longer matches the source and falls back to Python until it is rebuilt.
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+
+CPP_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(CPP_DIR, 'moments.c')
+LIBRARY = os.path.join(CPP_DIR, 'moments.so')
+
+CFLAGS = ['-O3', '-std=c99', '-fPIC', '-shared']
+OPENMP_FLAGS = ['-fopenmp']
+
+# Per moment of the check: (scale of the differences, None for the map's peak; its name)
+CHECK_SCALES = {
+    '0': (None, 'of the peak'), '8': (None, 'of the peak'),
+    '1': (0.2, 'channels'), '2': (0.2, 'channels'), '9': (0.2, 'channels'),
+    'skew': (1.0, ''), 'kurt': (1.0, ''),
+}
+
+# Largest accepted difference per moment. Maps are float32: about 1e-7 of the peak, and
+# 12000 km/s carries 1e-3 km/s of rounding
+CHECK_TOLERANCE = {'0': 1e-5, '8': 1e-5, '1': 1e-2, '2': 1e-2, '9': 1e-2, 'skew': 1e-3, 'kurt': 1e-3}
+
+def source_hash(path=SOURCE):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def find_compiler(cc=None):
+    """The C compiler to use: cc if given, else $CC, else the first of cc, gcc and clang on the PATH."""
+    for candidate in (cc, os.environ.get('CC'), 'cc', 'gcc', 'clang'):
+        if candidate and shutil.which(candidate):
+            return candidate
+    return None
+
+def build(cc=None, openmp=True, output=LIBRARY, verbose=True):
+    """
+    Compiles moments.c into output (replaced atomically). Tries OpenMP first and falls
+    back to a single-threaded build if the compiler rejects it.
+    Returns True if the library was built with OpenMP; raises RuntimeError if no build worked.
+    """
+    compiler = find_compiler(cc)
+    if compiler is None:
+        raise RuntimeError("No C compiler found (set CC or install gcc/clang).")
+
+    tmp = f"{output}.{os.getpid()}.tmp"
+    define = f'-DMOMENTS_SOURCE_HASH="{source_hash()}"'
+    attempts = [True, False] if openmp else [False]
+    errors = []
+    for with_openmp in attempts:
+        cmd = [compiler, *CFLAGS, *(OPENMP_FLAGS if with_openmp else []), define, SOURCE, '-o', tmp, '-lm']
+        if verbose:
+            print(f"INFO: {' '.join(cmd)}")
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode == 0:
+            os.replace(tmp, output)
+            return with_openmp
+        errors.append(result.stderr.strip())
+        if verbose and with_openmp:
+            print("Warning: Building with OpenMP failed; trying without")
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    raise RuntimeError(f"Compiling moments.c failed: {errors[-1]}")
+
+def check(verbose=True):
+    """
+    Compares the freshly built kernel with the pure Python implementation on a synthetic
+    cube of narrow lines at high systemic velocity, with NaNs and a mask.
+    Returns the largest difference per moment: relative to the map's peak for moments
+    0 and 8, in channel widths for moments 1, 2 and 9, absolute for skewness and kurtosis.
+    """
+    import numpy as np
+    sys.path.insert(0, os.path.abspath(os.path.join(CPP_DIR, '..', '..', '..')))
+    from backend.moments import calculator
+
+    rng = np.random.default_rng(0)
+    channels, height, width = 96, 37, 300
+    # 0.2 km/s channels around 12000 km/s
+    v = 12000.0 + 0.2 * np.arange(channels)
+    centre = 12000.0 + rng.uniform(6, 13, (height, width))
+    sigma = rng.uniform(0.4, 2.0, (height, width))
+    data = np.exp(-0.5 * ((v[:, None, None] - centre) / sigma) ** 2).astype(np.float32)
+    data += rng.normal(0, 1e-3, data.shape).astype(np.float32)
+    data[rng.random(data.shape) < 0.01] = np.nan
+    mask = (rng.random(data.shape) > 0.05).astype(np.uint8)
+
+    def run(force_python):
+        previous = calculator.FORCE_PYTHON
+        calculator.FORCE_PYTHON = force_python
+        try:
+            def blocks():
+                return calculator.iter_channel_blocks(data, 0, channels, channels, mask=mask)
+            if force_python:
+                return calculator.compute_moments_python(blocks, v, 'km/s', 'Jy', calculator.MOMENTS, (height, width))
+            return calculator.compute_moments_c(data, mask, False, 0, channels, channels, v, 'km/s', 'Jy', calculator.MOMENTS)
+        finally:
+            calculator.FORCE_PYTHON = previous
+
+    reference, native = run(True), run(False)
+    errors = {}
+    for mom in calculator.MOMENTS:
+        ref, got = reference[mom].astype(np.float64), native[mom].astype(np.float64)
+        scale, unit = CHECK_SCALES[mom]
+        scale = np.nanmax(np.abs(ref)) if scale is None else scale
+        # Blank pixels have to agree as well
+        same_blanks = np.array_equal(np.isnan(ref), np.isnan(got))
+        errors[mom] = float(np.nanmax(np.abs(got - ref)) / scale) if same_blanks else float('inf')
+        if verbose:
+            print(f"INFO: Moment {mom}: largest difference to the Python reference {errors[mom]:.2e} {unit}".rstrip())
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the native moment kernel')
+    parser.add_argument('--cc', type=str, help='C compiler (default: $CC, cc, gcc or clang)')
+    parser.add_argument('--no-openmp', action='store_true', help='Build single-threaded')
+    parser.add_argument('--no-check', action='store_true', help='Skip the comparison with the Python implementation')
+    args = parser.parse_args()
+
+    try:
+        with_openmp = build(cc=args.cc, openmp=not args.no_openmp)
+    except RuntimeError as e:
+        print(f"ERROR: {e}")
+        return 1
+    print(f"INFO: Built {LIBRARY} ({'OpenMP' if with_openmp else 'single-threaded'})")
+
+    if not args.no_check:
+        errors = check()
+        if any(errors[mom] > CHECK_TOLERANCE[mom] for mom in errors):
+            print("ERROR: The native kernel disagrees with the Python implementation")
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
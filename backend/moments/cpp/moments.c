@@ -4,95 +4,309 @@
 #include <stdlib.h>
 #include <string.h>
 
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
 /**
- * Optimized Moment Map Calculation
- * 
- * Uses a single-pass "Horizontal Sweep" through memory for maximum cache performance.
- * Leverages the variance identity Var(X) = E[X^2] - (E[X])^2 to compute Mom 2 in one go.
+ * Moment Map Calculation
+ *
+ * The work is split in two entry points so the caller can stream a channel range
+ * in blocks: accumulate_moments_c adds one block of channels into running per-pixel
+ * sums, finalize_moments_c turns the sums into moment maps once all blocks are in.
+ *
+ * Sums are taken of I * (v - v_ref)^k with v_ref near the middle of the range (the
+ * caller passes the shifted velocities). The dispersion then comes from the identity
+ * Var = E[u^2] - E[u]^2 on shifted velocities u, which stays accurate for narrow
+ * lines at high systemic velocity where the unshifted identity cancels catastrophically;
+ * skewness and kurtosis follow the same way from the third and fourth powers.
+ * The peak intensity and the channel holding it are tracked in the same sweep.
+ *
+ * accumulate_moments_c reads the caller's buffers as they are: any supported element
+ * type, either byte order and arbitrary byte strides (e.g. a memory-mapped big-endian
+ * FITS cube, or a 2D mask broadcast along the spectral axis with a zero stride).
+ * Masking and NaN rejection happen inside the loop, so no sanitised copies are needed.
+ *
+ * The image is cut into row segments of TILE_X pixels, shared out among OpenMP
+ * threads in one parallel region per block. Each tile runs through all channels of
+ * the block with its accumulators in cache; every pixel is summed by one thread in
+ * channel order, so results do not depend on the thread count.
+ *
+ * Build with build.py next to this file, which compiles with OpenMP when available.
  */
-void calculate_moments_c(
-    const float* data,
-    const float* v,
+
+// Bumped whenever an entry point changes; calculator.py refuses other versions
+#define MOMENTS_ABI_VERSION 3
+
+// Set by build.py to the SHA-256 of this file, so stale builds are noticed
+#ifndef MOMENTS_SOURCE_HASH
+#define MOMENTS_SOURCE_HASH "unknown"
+#endif
+
+// Pixels per tile, and the largest power of (v - v_ref) that is accumulated
+#define TILE_X 256
+#define MAX_POWER 4
+
+// Element type codes, must match _DTYPE_CODES in calculator.py
+enum {
+    DT_FLOAT32 = 0,
+    DT_FLOAT64 = 1,
+    DT_INT8 = 2,
+    DT_INT16 = 3,
+    DT_INT32 = 4,
+    DT_INT64 = 5,
+    DT_UINT8 = 6,
+    DT_UINT16 = 7,
+    DT_UINT32 = 8
+};
+
+static inline uint16_t swap16(uint16_t x) {
+    return (uint16_t)((x >> 8) | (x << 8));
+}
+
+static inline uint32_t swap32(uint32_t x) {
+    return ((x >> 24) & 0xffu) | ((x >> 8) & 0xff00u) |
+           ((x << 8) & 0xff0000u) | ((x << 24) & 0xff000000u);
+}
+
+static inline uint64_t swap64(uint64_t x) {
+    return ((uint64_t)swap32((uint32_t)x) << 32) | swap32((uint32_t)(x >> 32));
+}
+
+// Reads one element of the given type, byte-swapping if it is not in native order
+static inline double read_value(const char* ptr, int dtype, bool swap) {
+    switch (dtype) {
+        case DT_FLOAT32: {
+            uint32_t u; float f;
+            memcpy(&u, ptr, 4);
+            if (swap) u = swap32(u);
+            memcpy(&f, &u, 4);
+            return (double)f;
+        }
+        case DT_FLOAT64: {
+            uint64_t u; double d;
+            memcpy(&u, ptr, 8);
+            if (swap) u = swap64(u);
+            memcpy(&d, &u, 8);
+            return d;
+        }
+        case DT_INT8:
+            return (double)(*(const int8_t*)ptr);
+        case DT_UINT8:
+            return (double)(*(const uint8_t*)ptr);
+        case DT_INT16:
+        case DT_UINT16: {
+            uint16_t u;
+            memcpy(&u, ptr, 2);
+            if (swap) u = swap16(u);
+            return (dtype == DT_INT16) ? (double)(int16_t)u : (double)u;
+        }
+        case DT_INT32:
+        case DT_UINT32: {
+            uint32_t u;
+            memcpy(&u, ptr, 4);
+            if (swap) u = swap32(u);
+            return (dtype == DT_INT32) ? (double)(int32_t)u : (double)u;
+        }
+        case DT_INT64: {
+            uint64_t u;
+            memcpy(&u, ptr, 8);
+            if (swap) u = swap64(u);
+            return (double)(int64_t)u;
+        }
+        default:
+            return NAN;
+    }
+}
+
+int moments_abi_version(void) {
+    return MOMENTS_ABI_VERSION;
+}
+
+const char* moments_source_hash(void) {
+    return MOMENTS_SOURCE_HASH;
+}
+
+bool moments_has_openmp(void) {
+#ifdef _OPENMP
+    return true;
+#else
+    return false;
+#endif
+}
+
+int moments_get_threads(void) {
+#ifdef _OPENMP
+    return omp_get_max_threads();
+#else
+    return 1;
+#endif
+}
+
+void moments_set_threads(int threads) {
+#ifdef _OPENMP
+    if (threads > 0) omp_set_num_threads(threads);
+#else
+    (void)threads;
+#endif
+}
+
+void accumulate_moments_c(
+    const char* data,
+    int data_type,
+    bool data_swap,
+    int64_t data_stride_c,
+    int64_t data_stride_y,
+    int64_t data_stride_x,
+    const char* mask,
+    int mask_type,
+    bool mask_swap,
+    int64_t mask_stride_c,
+    int64_t mask_stride_y,
+    int64_t mask_stride_x,
+    bool invert_mask,
+    const double* u,      // v - v_ref per channel
     int channels,
     int height,
     int width,
-    double dv,
-    bool compute0,
-    bool compute1,
-    bool compute2,
-    float* mom0_out,
-    float* mom1_out,
-    float* mom2_out
+    int max_power,        // 0..MAX_POWER: sums of I * u^k for k <= max_power
+    double* sums,         // (max_power + 1) planes of height x width, row-major
+    double* peak,         // running maximum of I per pixel (-inf before any value), or NULL
+    double* peak_u        // u of the channel holding the maximum, or NULL
 ) {
-    int num_pixels = height * width;
-
-    // Use double precision for accumulators to prevent rounding errors during single-pass
-    double* sum_i  = (double*)calloc(num_pixels, sizeof(double));
-    double* sum_iv = (double*)calloc(num_pixels, sizeof(double));
-    double* sum_iv2 = (double*)calloc(num_pixels, sizeof(double));
-
-    if (!sum_i || !sum_iv || !sum_iv2) {
-        if (sum_i) free(sum_i);
-        if (sum_iv) free(sum_iv);
-        if (sum_iv2) free(sum_iv2);
-        return;
-    }
+    if (max_power > MAX_POWER) max_power = MAX_POWER;
+    const int64_t plane = (int64_t)height * width;
+    const int tiles_per_row = (width + TILE_X - 1) / TILE_X;
+    const int64_t n_tiles = (int64_t)height * tiles_per_row;
+    const bool track_peak = peak != NULL && peak_u != NULL;
+
+    #pragma omp parallel for schedule(dynamic, 4)
+    for (int64_t t = 0; t < n_tiles; t++) {
+        const int y = (int)(t / tiles_per_row);
+        const int x0 = (int)(t % tiles_per_row) * TILE_X;
+        const int nx = (width - x0 < TILE_X) ? width - x0 : TILE_X;
+        const int64_t offset = (int64_t)y * width + x0;
+        double acc[MAX_POWER + 1][TILE_X];
+        double top[TILE_X], top_u[TILE_X];
+
+        for (int k = 0; k <= max_power; k++) {
+            memcpy(acc[k], sums + k * plane + offset, nx * sizeof(double));
+        }
+        if (track_peak) {
+            memcpy(top, peak + offset, nx * sizeof(double));
+            memcpy(top_u, peak_u + offset, nx * sizeof(double));
+        }
 
-    // Pass 1: Accumulate sums across all channels
-    // Outer loop over channels, inner loops over spatial coordinates (contiguous sweep)
-    for (int c = 0; c < channels; c++) {
-        float vc = v[c];
-        double vc_d = (double)vc;
-        double vc2_d = vc_d * vc_d;
-        
-        const float* channel_data = data + (c * num_pixels);
-
-        #pragma omp parallel for
-        for (int p = 0; p < num_pixels; p++) {
-            float val = channel_data[p];
-            if (!isnan(val)) {
-                sum_i[p] += (double)val;
-                if (compute1 || compute2) {
-                    double val_d = (double)val;
-                    sum_iv[p] += val_d * vc_d;
-                    if (compute2) {
-                        sum_iv2[p] += val_d * vc2_d;
-                    }
+        for (int c = 0; c < channels; c++) {
+            const double uc = u[c];
+            const char* row_data = data + c * data_stride_c + y * data_stride_y + x0 * data_stride_x;
+            const char* row_mask = mask ? mask + c * mask_stride_c + y * mask_stride_y + x0 * mask_stride_x : NULL;
+            for (int x = 0; x < nx; x++) {
+                if (row_mask) {
+                    // Keep mask > 0; inverted keeps mask <= 0 and NaN
+                    double m = read_value(row_mask + x * mask_stride_x, mask_type, mask_swap);
+                    if ((m > 0.0) == invert_mask) continue;
+                }
+                double val = read_value(row_data + x * data_stride_x, data_type, data_swap);
+                if (isnan(val)) continue;
+                // Double precision accumulators prevent rounding errors during single-pass
+                double w = val;
+                acc[0][x] += w;
+                for (int k = 1; k <= max_power; k++) {
+                    w *= uc;
+                    acc[k][x] += w;
+                }
+                // Strictly greater: the first channel wins ties, as in numpy's argmax
+                if (track_peak && val > top[x]) {
+                    top[x] = val;
+                    top_u[x] = uc;
                 }
             }
         }
+
+        for (int k = 0; k <= max_power; k++) {
+            memcpy(sums + k * plane + offset, acc[k], nx * sizeof(double));
+        }
+        if (track_peak) {
+            memcpy(peak + offset, top, nx * sizeof(double));
+            memcpy(peak_u + offset, top_u, nx * sizeof(double));
+        }
     }
+}
+
+void finalize_moments_c(
+    const double* sums,   // planes of I * u^k as left by accumulate_moments_c, as many as the outputs need
+    const double* peak,   // NULL unless peak_out or vpeak_out is given
+    const double* peak_u,
+    int height,
+    int width,
+    double dv,
+    double v_ref,
+    // Maps to compute, NULL to skip: moments 0, 1, 2, 8 (peak), 9 (velocity at peak),
+    // skewness and excess kurtosis of the line profile
+    float* mom0_out,
+    float* mom1_out,
+    float* mom2_out,
+    float* peak_out,
+    float* vpeak_out,
+    float* skew_out,
+    float* kurt_out
+) {
+    const int64_t num_pixels = (int64_t)height * width;
+    const bool shape = skew_out || kurt_out;
 
-    // Pass 2: Finalize moment values
     #pragma omp parallel for
-    for (int p = 0; p < num_pixels; p++) {
-        double s_i = sum_i[p];
+    for (int64_t p = 0; p < num_pixels; p++) {
+        if (peak_out || vpeak_out) {
+            // Pixels without any value keep the initial -inf
+            bool found = peak[p] > -INFINITY;
+            if (peak_out) peak_out[p] = found ? (float)peak[p] : NAN;
+            if (vpeak_out) vpeak_out[p] = found ? (float)(v_ref + peak_u[p]) : NAN;
+        }
+
+        double s_i = sums[p];
         if (s_i == 0.0) {
-            if (compute0) mom0_out[p] = 0.0f;
-            if (compute1) mom1_out[p] = NAN;
-            if (compute2) mom2_out[p] = NAN;
+            if (mom0_out) mom0_out[p] = 0.0f;
+            if (mom1_out) mom1_out[p] = NAN;
+            if (mom2_out) mom2_out[p] = NAN;
+            if (skew_out) skew_out[p] = NAN;
+            if (kurt_out) kurt_out[p] = NAN;
             continue;
         }
 
-        if (compute0) {
+        if (mom0_out) {
             mom0_out[p] = (float)(s_i * dv);
         }
 
-        double m1 = 0.0;
-        if (compute1 || compute2) {
-            m1 = sum_iv[p] / s_i;
-            if (compute1) mom1_out[p] = (float)m1;
-        }
+        // Mean of the shifted velocity, small next to v_ref for a line near the middle of the range
+        double mean_u = (mom1_out || mom2_out || shape) ? sums[num_pixels + p] / s_i : 0.0;
+        if (mom1_out) mom1_out[p] = (float)(v_ref + mean_u);
+
+        if (!mom2_out && !shape) continue;
+        double e2 = sums[2 * num_pixels + p] / s_i;
+        double m2_sq = e2 - (mean_u * mean_u);
 
-        if (compute2) {
-            // Var(X) = E[X^2] - (E[X])^2
-            double m2_sq = (sum_iv2[p] / s_i) - (m1 * m1);
+        if (mom2_out) {
             // Protect against tiny negative values due to floating point precision
             mom2_out[p] = (m2_sq > 0.0) ? (float)sqrt(m2_sq) : 0.0f;
         }
-    }
 
-    free(sum_i);
-    free(sum_iv);
-    free(sum_iv2);
+        if (!shape) continue;
+        if (!(m2_sq > 0.0)) {
+            // A profile of one channel has no shape
+            if (skew_out) skew_out[p] = NAN;
+            if (kurt_out) kurt_out[p] = NAN;
+            continue;
+        }
+        // Central moments from the raw ones about v_ref
+        double mu2 = mean_u * mean_u;
+        double e3 = sums[3 * num_pixels + p] / s_i;
+        double c3 = e3 - 3.0 * mean_u * e2 + 2.0 * mu2 * mean_u;
+        if (skew_out) skew_out[p] = (float)(c3 / (m2_sq * sqrt(m2_sq)));
+        if (kurt_out) {
+            double e4 = sums[4 * num_pixels + p] / s_i;
+            double c4 = e4 - 4.0 * mean_u * e3 + 6.0 * mu2 * e2 - 3.0 * mu2 * mu2;
+            kurt_out[p] = (float)(c4 / (m2_sq * m2_sq) - 3.0);
+        }
+    }
 }
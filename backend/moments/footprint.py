@@ -0,0 +1,136 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from ..fits_handler import keep_mask
+
+# Mask values read at once while a footprint is derived (bytes)
+FOOTPRINT_BUILD_BYTES = 256 * 1024 * 1024
+
+# Footprints kept at once, keyed by mask token and invert flag
+FOOTPRINT_ENTRIES = 8
+
+# Spatial tiles (rows, columns) that each get their own channel span
+FOOTPRINT_TILE = (64, 64)
+
+# Tiles are swept while they touch at most this share of the bounding box's voxels in the
+# range; above it one sweep of the bounding box costs less than many small reads
+SPARSE_MAX_SHARE = 0.5
+
+class MaskFootprint:
+    """
+    Where a mask keeps anything: the plane of pixels kept in at least one channel,
+    its bounding box, and for every pixel of the box the first and last kept channel.
+    Derived with one streamed pass over the mask.
+    """
+
+    def __init__(self, plane, box, lo, hi, n_channels, kept_voxels):
+        self.plane = plane # bool (y, x)
+        self.box = box # (y0, y1, x0, x1), None if the mask keeps nothing
+        self.lo = lo # first kept channel per pixel of the box (n_channels for none)
+        self.hi = hi # last kept channel per pixel of the box (-1 for none)
+        self.n_channels = n_channels
+        self.kept_voxels = kept_voxels
+
+    @property
+    def occupancy(self):
+        """Share of the cube's voxels the mask keeps."""
+        total = self.n_channels * self.plane.size
+        return self.kept_voxels / total if total else 0.0
+
+    @classmethod
+    def build(cls, mask, invert_mask=False, budget=None):
+        n, h, w = mask.shape
+        span_type = np.int16 if n < np.iinfo(np.int16).max else np.int32
+        if mask.strides[0] == 0:
+            # 2D mask broadcast over the channels: every kept pixel spans the whole cube
+            plane = keep_mask(np.asarray(mask[0]), invert_mask)
+            lo = np.where(plane, 0, n).astype(span_type)
+            hi = np.where(plane, n - 1, -1).astype(span_type)
+            kept = int(plane.sum()) * n
+        else:
+            plane = np.zeros((h, w), dtype=bool)
+            lo = np.full((h, w), n, dtype=span_type)
+            hi = np.full((h, w), -1, dtype=span_type)
+            kept = 0
+            # Whole channels in order: contiguous reads, and spans follow from running updates
+            per_block = max(1, (budget or FOOTPRINT_BUILD_BYTES) // max(1, h * w * mask.itemsize))
+            for c0 in range(0, n, per_block):
+                for c, keep in enumerate(keep_mask(np.asarray(mask[c0:c0 + per_block]), invert_mask), start=c0):
+                    lo[keep & ~plane] = c
+                    hi[keep] = c
+                    plane |= keep
+                    kept += int(np.count_nonzero(keep))
+
+        rows, cols = np.flatnonzero(plane.any(axis=1)), np.flatnonzero(plane.any(axis=0))
+        if rows.size == 0:
+            return cls(plane, None, None, None, n, 0)
+        box = (int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1)
+        y0, y1, x0, x1 = box
+        return cls(plane, box, lo[y0:y1, x0:x1].copy(), hi[y0:y1, x0:x1].copy(), n, kept)
+
+    def regions(self, start, end):
+        """
+        (c0, c1, y0, y1, x0, x1) boxes of the cube, channels [c0, c1), that hold every
+        voxel the mask keeps in channels [start, end). Each pixel lies in at most one box.
+        """
+        if self.box is None:
+            return []
+        y0, y1, x0, x1 = self.box
+        lo = np.maximum(self.lo.astype(np.int64), start)
+        hi = np.minimum(self.hi.astype(np.int64), end - 1)
+        active = lo <= hi
+        if not active.any():
+            return []
+        # Pixels with nothing kept in the range drop out of the per-tile spans
+        lo[~active], hi[~active] = end, -1
+
+        th, tw = FOOTPRINT_TILE
+        bh, bw = y1 - y0, x1 - x0
+        nty, ntx = -(-bh // th), -(-bw // tw)
+        lo_pad = np.full((nty * th, ntx * tw), end, dtype=np.int64)
+        hi_pad = np.full((nty * th, ntx * tw), -1, dtype=np.int64)
+        lo_pad[:bh, :bw], hi_pad[:bh, :bw] = lo, hi
+        tile_lo = lo_pad.reshape(nty, th, ntx, tw).min(axis=(1, 3))
+        tile_hi = hi_pad.reshape(nty, th, ntx, tw).max(axis=(1, 3))
+
+        tiles, work = [], 0
+        for ty, tx in zip(*np.nonzero(tile_lo <= tile_hi)):
+            ty0, tx0 = y0 + ty * th, x0 + tx * tw
+            ty1, tx1 = min(y1, ty0 + th), min(x1, tx0 + tw)
+            c0, c1 = int(tile_lo[ty, tx]), int(tile_hi[ty, tx]) + 1
+            tiles.append((c0, c1, int(ty0), int(ty1), int(tx0), int(tx1)))
+            work += (c1 - c0) * (ty1 - ty0) * (tx1 - tx0)
+
+        c0, c1 = int(lo[active].min()), int(hi[active].max()) + 1
+        if work > SPARSE_MAX_SHARE * (c1 - c0) * bh * bw:
+            return [(c0, c1, y0, y1, x0, x1)]
+        return tiles
+
+class FootprintCache:
+    """Footprints of recently used masks, keyed by mask token and invert flag."""
+
+    def __init__(self, max_entries=FOOTPRINT_ENTRIES):
+        self.max_entries = max_entries
+        self._footprints = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, state, invert_mask=False):
+        """Footprint of a session's mask, derived on first use."""
+        key = (state.mask_token, bool(invert_mask))
+        with self._lock:
+            if key in self._footprints:
+                self._footprints.move_to_end(key)
+                return self._footprints[key]
+
+        footprint = MaskFootprint.build(state.mask, invert_mask)
+        print(f"DEBUG: Mask footprint derived: {footprint.occupancy:.1%} of the cube kept, box {footprint.box}")
+
+        with self._lock:
+            self._footprints[key] = footprint
+            while len(self._footprints) > self.max_entries:
+                self._footprints.popitem(last=False)
+        return footprint
+
+# Shared instance used by the moment handler and spectrum extraction
+footprints = FootprintCache()
@@ -1,10 +1,120 @@
+from ..limits import moment_limits
 from ..plotter import create_plot
-from .calculator import compute_moments
+from ..preview import render_preview, resolve_render_mode, interactive_format
+from ..pyramid import pyramids, pyramid_factors, choose_factor, level_pixel, level_wcs
+from ..render_cache import render_cache, render_key, render_tags
+from ..render_pool import render_pool
+from .calculator import MOMENTS, compute_moments
+from .footprint import footprints
+from .index import MomentIndex
+from .store import moment_store
+
+def get_moment_index(state, invert_mask):
+    """
+    Returns the prefix-sum index for the loaded cube and mask, (re)building it
+    when the cube, mask or invert flag changed. None if the index is disabled.
+    """
+    if not state.use_moment_index:
+        return None
+
+    index = state.moment_index
+    if index is None or not index.matches(state.data, state.mask, invert_mask):
+        index = MomentIndex.build(state.data, state.wcs, mask=state.mask, invert_mask=invert_mask)
+        state.moment_index = index
+    return index
+
+def moment_cbar_label(mom):
+    if mom == '1':
+        return "Velocity Field"
+    elif mom == '2':
+        return "Velocity Dispersion"
+    elif mom == '8':
+        return "Peak Intensity"
+    elif mom == '9':
+        return "Velocity at Peak"
+    elif mom == 'skew':
+        return "Skewness"
+    elif mom == 'kurt':
+        return "Excess Kurtosis"
+    return "Intensity"
+
+def moment_title(mom):
+    """Name of a moment map in plot titles: 'Moment 0' for the numbered ones."""
+    return moment_cbar_label(mom) if mom in ('skew', 'kurt') else f"Moment {mom}"
+
+def render_moment_image(state, mom, req_data, mode='export', fmt='png'):
+    """
+    Renders a stored moment map with the visual parameters of a request.
+    mode 'preview' uses the fast interactive renderer, 'publication' the matplotlib
+    figure with mathtext labels and 'export' the matplotlib figure typeset with LaTeX.
+    Returns the encoded image bytes.
+    """
+    mom_info = state.moment_data[mom]
+    title = req_data.get('title', '')
+    mom_title = f"{title}\n{moment_title(mom)}" if title else moment_title(mom)
+    # Quick-look maps are one pixel per block of an overview level
+    level = mom_info.get('level', 1)
+
+    if mode == 'preview':
+        return render_preview(
+            mom_info['data'], state.wcs, mom_info['unit'],
+            title=mom_title, grid=req_data.get('grid', False), beam=state.beam,
+            show_beam=req_data.get('showBeam', False), show_center=req_data.get('showCenter', False),
+            center_x=req_data.get('centerX'), center_y=req_data.get('centerY'),
+            user_vmin=req_data.get('vmin'), user_vmax=req_data.get('vmax'),
+            cbar_unit=req_data.get('cbarUnit', 'None'), fmt=fmt,
+            auto_limits=moment_limits(state, mom), factor=level
+        )
+
+    plot_kwargs = dict(
+        unit_label=mom_info['unit'],
+        title=mom_title, grid=req_data.get('grid', False), beam=state.beam,
+        show_beam=req_data.get('showBeam', False), show_center=req_data.get('showCenter', False),
+        center_x=level_pixel(req_data.get('centerX'), level), center_y=level_pixel(req_data.get('centerY'), level),
+        show_physical=req_data.get('showPhysical', False), distance_val=req_data.get('distanceVal'),
+        distance_unit=req_data.get('distanceUnit', 'Mpc'),
+        cbar_unit=req_data.get('cbarUnit', 'None'),
+        show_offset=req_data.get('showOffset', False),
+        offset_angle_unit=req_data.get('offsetAngleUnit', 'arcsec'),
+        fig_width=float(req_data.get('figWidth', 8)),
+        fig_height=float(req_data.get('figHeight', 8)),
+        cbar_label=moment_cbar_label(mom),
+        user_vmin=req_data.get('vmin'), user_vmax=req_data.get('vmax'),
+        auto_limits=moment_limits(state, mom),
+        fmt=fmt,
+        text_profile='export' if mode == 'export' else 'interactive'
+    )
+
+    # Workers draw with the cube's own WCS, which only fits full-resolution maps
+    if render_pool.enabled and level == 1:
+        image = render_pool.render_moment(state, mom, plot_kwargs)
+        if image is not None:
+            return image
+
+    buf = create_plot(mom_info['data'], level_wcs(state.wcs, level), return_base64=False, **plot_kwargs)
+    return buf.getvalue()
+
+def quick_look_level(state, req_data):
+    """
+    Overview pyramid factor for quick-look moments: the coarsest level that still fills
+    the view ('viewWidth', 'viewHeight' in screen pixels), or the coarsest level there
+    is without a view size. 1 when the cube is too small to have levels.
+    """
+    factors = pyramid_factors(state.data.shape[1:])
+    if not factors:
+        return 1
+    try:
+        view_shape = (int(float(req_data.get('viewHeight') or 0)), int(float(req_data.get('viewWidth') or 0)))
+    except ValueError:
+        raise ValueError("View size must be a number of pixels.")
+    if min(view_shape) <= 0:
+        return factors[-1]
+    return choose_factor(factors, state.data.shape[1:], view_shape)
 
 def handle_moment_calculation(state, req_data):
     """
     Orchestrates the calculation and rendering of requested moment maps.
-    Returns a dictionary of moment names to base64 images.
+    Rendered images go to the render cache; returns a dictionary of moment names to render keys.
     """
     if state.data is None:
         return None
@@ -13,72 +123,64 @@ def handle_moment_calculation(state, req_data):
     start_chan = req_data.get('startChan', 0)
     end_chan = req_data.get('endChan', 0)
     requested_moments = req_data.get('moments', [])
-    
-    title = req_data.get('title', '')
-    grid = req_data.get('grid', False)
-    show_beam = req_data.get('showBeam', False)
-    show_center = req_data.get('showCenter', False)
-    center_x = req_data.get('centerX')
-    center_y = req_data.get('centerY')
-    show_physical = req_data.get('showPhysical', False)
-    distance_val = req_data.get('distanceVal')
-    distance_unit = req_data.get('distanceUnit', 'Mpc')
-    cbar_unit = req_data.get('cbarUnit', 'None')
-    show_offset = req_data.get('showOffset', False)
-    offset_angle_unit = req_data.get('offsetAngleUnit', 'arcsec')
-    fig_width = float(req_data.get('figWidth', 8))
-    fig_height = float(req_data.get('figHeight', 8))
+    unknown = [mom for mom in requested_moments if mom not in MOMENTS]
+    if unknown:
+        raise ValueError(f"Unknown moment(s): {', '.join(map(str, unknown))}.")
+
     invert_mask = req_data.get('invertMask', False)
+    level = quick_look_level(state, req_data) if req_data.get('quickLook', False) else 1
+
+    # Step 1: Maps computed before (by any session or server run) come from the moment store
+    results = {}
+    store_keys = {mom: moment_store.key(state, start_chan, end_chan, invert_mask, mom, level) for mom in requested_moments}
+    for mom, store_key in store_keys.items():
+        stored = moment_store.get(store_key)
+        if stored is not None:
+            results[mom], results[f"{mom}_unit"] = stored
+    if results:
+        print(f"INFO: Moments {', '.join(m for m in requested_moments if m in results)} read from the moment store")
 
-    # Step 1: Calculate raw moment data
-    results = compute_moments(state.data, state.wcs, state.unit, start_chan, end_chan, requested_moments, mask=state.mask, invert_mask=invert_mask)
+    # Step 2: Calculate the rest in one sweep
+    missing = [mom for mom in requested_moments if mom not in results]
+    if missing and level > 1:
+        # Quick look: the same sweep over a block-averaged level, which already carries the mask
+        cube = pyramids.get(state, invert_mask).level_cube(level, int(start_chan), int(end_chan))
+        computed = compute_moments(cube, state.wcs, state.unit, start_chan, end_chan, missing)
+        print(f"INFO: Quick-look moments {', '.join(missing)} computed at 1/{level} resolution")
+        for mom in missing:
+            if mom in computed:
+                moment_store.put(store_keys[mom], computed[mom], computed.get(f"{mom}_unit", "Arbitrary Units"),
+                                 level_wcs(state.wcs, level))
+        results.update(computed)
+    elif missing:
+        index = get_moment_index(state, invert_mask)
+        # Without an index that answers them, only the part of the cube the mask keeps is read
+        swept = index is None or not index.supports(missing)
+        footprint = footprints.get(state, invert_mask) if state.mask is not None and swept else None
+        computed = compute_moments(state.data, state.wcs, state.unit, start_chan, end_chan, missing,
+                                   mask=state.mask, invert_mask=invert_mask, index=index, footprint=footprint)
+        for mom in missing:
+            if mom in computed:
+                moment_store.put(store_keys[mom], computed[mom], computed.get(f"{mom}_unit", "Arbitrary Units"), state.wcs)
+        results.update(computed)
     
-    # Step 2: Render results to base64 images
-    images = {}
+    # Step 3: Render results into the render cache
+    mode = resolve_render_mode(req_data)
+    fmt = interactive_format(mode)
+    keys = {}
     for mom in requested_moments:
         if mom in results:
             mom_data = results[mom]
             raw_unit = results.get(f"{mom}_unit", "Arbitrary Units")
             
             # Store raw data for future interactive re-renders
-            state.moment_data[mom] = {
-                'data': mom_data,
-                'unit': raw_unit
-            }
-
-            # Formatting title
-            mom_title = f"{title}\nMoment {mom}" if title else f"Moment {mom}"
-
-            # Dimensions
-            fig_width = float(req_data.get('figWidth', 8))
-            fig_height = float(req_data.get('figHeight', 8))
-
-            # Custom Label for Colorbar
-            # Custom Label for Colorbar
-            cbar_label = "Intensity"
-            if mom == '1':
-                cbar_label = "Velocity Field"
-            elif mom == '2':
-                cbar_label = "Velocity Dispersion"
-            
-            # Extract Manual Vmin/Vmax
-            user_vmin = req_data.get('vmin')
-            user_vmax = req_data.get('vmax')
-
-            img_base64 = create_plot(
-                mom_data, state.wcs, raw_unit, 
-                title=mom_title, grid=grid, beam=state.beam, 
-                show_beam=show_beam, show_center=show_center,
-                center_x=center_x, center_y=center_y,
-                show_physical=show_physical, distance_val=distance_val,
-                distance_unit=distance_unit,
-                cbar_unit=cbar_unit,
-                show_offset=show_offset,
-                offset_angle_unit=offset_angle_unit,
-                fig_width=fig_width, fig_height=fig_height,
-                cbar_label=cbar_label,
-                user_vmin=user_vmin, user_vmax=user_vmax
-            )
-            images[mom] = img_base64
+            state.set_moment(mom, mom_data, raw_unit, level=level)
+
+            image = render_moment_image(state, mom, req_data, mode=mode, fmt=fmt)
+
+            # Same key /render_moment uses, so switching to the new tab is a cache hit
+            key = render_key('moment', mom, state, req_data, fmt=fmt, mode=mode)
+            render_cache.put(key, image, render_tags('moment', mom, state))
+            keys[mom] = key
             
-    return images
+    return keys
@@ -0,0 +1,98 @@
+import tempfile
+import numpy as np
+
+from . import calculator
+
+# Prefix sums larger than this are kept in an anonymous temporary file instead of RAM
+INDEX_IN_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024
+
+# Moments the prefix sums answer; the peak and line-shape moments need a sweep
+INDEX_MOMENTS = ('0', '1', '2')
+
+class MomentIndex:
+    """
+    Spectral prefix sums of I, I*u and I*u^2 (u = v - v_ref) for one cube, mask and invert flag.
+
+    prefix[k, c] holds the sum over channels [0, c) of the k-th quantity, so the
+    sums for any channel range are the difference of two planes and moments 0/1/2
+    cost O(pixels) instead of O(channels x pixels). Accumulators are float64.
+    """
+
+    def __init__(self, data, mask, invert_mask, v, v_unit, v_ref, prefix):
+        self.data = data
+        self.mask = mask
+        self.invert_mask = bool(invert_mask) if mask is not None else False
+        self.v = v
+        self.v_unit = v_unit
+        self.v_ref = v_ref
+        self.prefix = prefix
+
+    @classmethod
+    def build(cls, data, wcs, mask=None, invert_mask=False, memory_budget=None):
+        """
+        Builds the index with one streamed pass over the cube.
+        """
+        channels, height, width = data.shape
+        v, v_unit = calculator.get_spectral_axis(wcs, 0, channels, dtype=np.float64)
+        # Powers of v are summed relative to the middle of the cube, as in the streaming kernel
+        v_ref = calculator.reference_velocity(v)
+        u = v - v_ref
+        prefix = _allocate_prefix((3, channels + 1, height, width))
+        print(f"INFO: Building moment index ({prefix.nbytes / 1024**2:.0f} MB) for {channels} channels")
+
+        running = np.zeros((3, height, width), dtype=np.float64)
+        prefix[:, 0] = 0.0
+
+        if calculator._lib and not calculator.FORCE_PYTHON:
+            # The kernel adds one channel at a time into the running sums, which are snapshotted
+            for c in range(channels):
+                mask_block = mask[c:c + 1, :, :] if mask is not None else None
+                calculator.accumulate_block_c(data[c:c + 1, :, :], mask_block, invert_mask, u[c:c + 1], 2, running)
+                prefix[:, c + 1] = running
+        else:
+            block_size = calculator.channel_block_size(height, width, memory_budget)
+            blocks = calculator.iter_channel_blocks(data, 0, channels, block_size, mask=mask, invert_mask=invert_mask)
+            for offset, block in blocks:
+                n = block.shape[0]
+                block = np.nan_to_num(np.asarray(block, dtype=np.float64), nan=0.0)
+                u_block = u[offset:offset + n, None, None]
+                for k, weighted in enumerate((block, block * u_block, block * u_block * u_block)):
+                    np.cumsum(weighted, axis=0, out=weighted)
+                    weighted += running[k]
+                    prefix[k, offset + 1:offset + n + 1] = weighted
+                    running[k] = weighted[-1]
+
+        return cls(data, mask, invert_mask, v, v_unit, v_ref, prefix)
+
+    def matches(self, data, mask, invert_mask):
+        """True if the index was built for exactly this data, mask and invert flag."""
+        if data is not self.data or mask is not self.mask:
+            return False
+        return mask is None or bool(invert_mask) == self.invert_mask
+
+    def supports(self, requested_moments):
+        """True if every requested moment follows from the stored sums."""
+        return all(mom in INDEX_MOMENTS for mom in requested_moments)
+
+    def compute(self, start_chan, end_chan, requested_moments, bunit):
+        """
+        Moments 0/1/2 for channels [start_chan, end_chan] (inclusive) from the prefix sums.
+        """
+        start = max(0, int(start_chan))
+        end = min(self.prefix.shape[1] - 1, int(end_chan) + 1)
+        if start >= end:
+            return {}
+
+        sums = self.prefix[:, end] - self.prefix[:, start]
+
+        v = self.v[start:end]
+        dv = float(abs(v[1] - v[0]) if len(v) > 1 else 1.0)
+        return calculator.finalize_moment_sums(sums, dv, self.v_ref, self.v_unit, bunit, requested_moments)
+
+def _allocate_prefix(shape):
+    nbytes = int(np.prod(shape)) * np.dtype(np.float64).itemsize
+    if nbytes <= INDEX_IN_MEMORY_LIMIT:
+        return np.empty(shape, dtype=np.float64)
+    # Unlinked temporary file: the space is released as soon as the map is dropped
+    backing = tempfile.TemporaryFile()
+    return np.memmap(backing, dtype=np.float64, mode='w+', shape=shape)
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import numpy as np
+from astropy.io import fits
+
+# Bumped whenever stored maps would differ for the same inputs
+STORE_VERSION = 2
+
+STORE_SUFFIX = '.fits'
+
+class MomentStore:
+    """
+    Moment maps on disk, one FITS image (celestial WCS, BUNIT) per map, so results
+    survive loading another cube and restarting the server.
+
+    Maps are keyed by the fingerprints of cube and mask (Dataset.fingerprint), the channel range,
+    the invert flag and the moment, so the same inputs find the same file however
+    the cube was opened. The directory is kept under max_bytes by deleting the least
+    recently used files.
+    """
+
+    def __init__(self, directory=None, max_bytes=2 * 1024 ** 3):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'cubefig_moments')
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def configure(self, directory=None, max_bytes=None):
+        with self._lock:
+            if directory:
+                self.directory = directory
+            if max_bytes is not None:
+                self.max_bytes = int(max_bytes)
+
+    def key(self, state, start_chan, end_chan, invert_mask, mom, level=1):
+        """
+        Key of one moment map of a session's cube and mask, or None without a cube.
+        level is the overview pyramid factor of a quick-look map (1 for full resolution).
+        """
+        if state.dataset is None:
+            return None
+        n_channels = state.data.shape[0]
+        # Same clipping as compute_moments, so equivalent ranges share an entry
+        start = max(0, int(start_chan))
+        end = min(n_channels, int(end_chan) + 1)
+        has_mask = state.mask_dataset is not None
+        parts = {
+            'version': STORE_VERSION,
+            'cube': state.dataset.fingerprint,
+            'mask': state.mask_dataset.fingerprint if has_mask else None,
+            'invert': bool(invert_mask) if has_mask else False,
+            'range': [start, end],
+            'moment': str(mom),
+        }
+        if int(level) > 1:
+            # Full-resolution keys stay as they were before quick-look maps existed
+            parts['level'] = int(level)
+        blob = json.dumps(parts, sort_keys=True)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """(map, unit) stored under key, or None."""
+        if not self.enabled or key is None:
+            return None
+        path = self._path(key)
+        try:
+            with fits.open(path, memmap=False) as hdul:
+                data = np.asarray(hdul[0].data, dtype=np.float32)
+                unit = hdul[0].header.get('BUNIT', 'Arbitrary Units')
+            os.utime(path) # Recently used: evicted last
+            return data, unit
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Warning: Ignoring unreadable stored moment map {path}: {e}")
+            return None
+
+    def put(self, key, data, unit, wcs):
+        if not self.enabled or key is None:
+            return
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            header = wcs.celestial.to_header()
+            header['BUNIT'] = unit
+            fits.PrimaryHDU(np.asarray(data, dtype=np.float32), header=header).writeto(tmp, overwrite=True)
+            # Readers only ever see complete files
+            os.replace(tmp, path)
+        except Exception as e:
+            print(f"Warning: Could not store moment map: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + STORE_SUFFIX)
+
+    def _evict(self):
+        with self._lock:
+            try:
+                entries = []
+                for name in os.listdir(self.directory):
+                    if name.endswith(STORE_SUFFIX):
+                        st = os.stat(os.path.join(self.directory, name))
+                        entries.append((st.st_mtime, st.st_size, name))
+            except OSError:
+                return
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    total -= size
+                except OSError:
+                    pass
+
+def restore_moments(state, start_chan, end_chan, invert_mask, moments, level=1):
+    """
+    Puts the stored maps of the given moments into a session's state without computing
+    anything. Returns the moments that were found.
+    """
+    restored = []
+    for mom in moments:
+        stored = moment_store.get(moment_store.key(state, start_chan, end_chan, invert_mask, mom, level))
+        if stored is not None:
+            state.set_moment(mom, *stored, level=level)
+            restored.append(mom)
+    return restored
+
+# Shared instance used by the routes
+moment_store = MomentStore()
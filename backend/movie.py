@@ -0,0 +1,193 @@
+import io
+import itertools
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+# Output formats and their mime types
+MOVIE_FORMATS = {'gif': 'image/gif', 'mp4': 'video/mp4', 'webp': 'image/webp'}
+
+# Frames rendered concurrently; at most twice as many are held at once
+MOVIE_WORKERS = min(4, os.cpu_count() or 1)
+MOVIE_MAX_FRAMES = 2000
+
+STREAM_CHUNK = 64 * 1024
+
+def ffmpeg_path():
+    return shutil.which('ffmpeg')
+
+def render_frames(render_fn, channels, workers=None):
+    """
+    Yields render_fn(c) for each channel in order, rendering up to `workers` frames
+    concurrently and keeping at most 2 * workers frames in memory.
+    """
+    workers = workers or MOVIE_WORKERS
+    pending = deque()
+    channels = iter(channels)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='movie') as pool:
+        try:
+            for c in itertools.islice(channels, 2 * workers):
+                pending.append(pool.submit(render_fn, c))
+            while pending:
+                frame = pending.popleft().result()
+                for c in itertools.islice(channels, 1):
+                    pending.append(pool.submit(render_fn, c))
+                yield frame
+        finally:
+            # Client gone or a frame failed: do not render the rest
+            for future in pending:
+                future.cancel()
+
+def movie_stream(frames, fmt, fps=10):
+    """
+    Validates the request and returns an iterator of encoded chunks.
+    frames yields PNG bytes; they are encoded as they arrive, never collected.
+    Raises ValueError for unsupported formats or a missing encoder.
+    """
+    if fmt not in MOVIE_FORMATS:
+        raise ValueError(f"Unsupported movie format '{fmt}' (use {', '.join(MOVIE_FORMATS)}).")
+    fps = float(fps)
+    if not 0 < fps <= 120:
+        raise ValueError("Frame rate must be between 0 and 120 fps.")
+
+    if fmt == 'gif':
+        return _gif_stream(frames, fps)
+
+    ffmpeg = ffmpeg_path()
+    if not ffmpeg:
+        raise ValueError(f"{fmt.upper()} export needs ffmpeg, which was not found. GIF export works without it.")
+    cmd = [ffmpeg, '-loglevel', 'error', '-f', 'image2pipe', '-framerate', f'{fps:g}', '-c:v', 'png', '-i', '-']
+    if fmt == 'mp4':
+        # Fragmented MP4 needs no seeking back, so it can be written straight to the pipe
+        cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white', '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+                '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4', '-']
+        return _ffmpeg_stream(cmd, frames)
+    # Animated WebP patches its header at the end, so ffmpeg writes a file that is sent afterwards
+    cmd += ['-c:v', 'libwebp_anim', '-loop', '0', '-quality', '80', '-f', 'webp']
+    return _ffmpeg_file(cmd, frames)
+
+# --- GIF ---
+
+def _gif_stream(frames, fps):
+    """
+    Animated GIF written frame by frame. Each frame carries its own colour table,
+    so preview frames keep their exact palette and figure frames get an adaptive one.
+    """
+    delay = max(2, round(100 / fps)) # Centiseconds; most viewers ignore less than 2
+    size = None
+    for png in frames:
+        img = Image.open(io.BytesIO(png))
+        if size is None:
+            size = img.size
+            # Header, logical screen without a global colour table, loop forever
+            yield b'GIF89a' + struct.pack('<HHBBB', size[0], size[1], 0x70, 0, 0)
+            yield b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00'
+        yield b'\x21\xf9\x04\x04' + struct.pack('<H', delay) + b'\x00\x00'
+        yield _gif_image_block(_gif_frame(img, size))
+    if size is not None:
+        yield b'\x3b'
+
+def _gif_frame(img, size):
+    if img.size != size:
+        # Figure frames can differ by a few pixels when tick labels change width
+        canvas = Image.new('RGB', size, 'white')
+        canvas.paste(img.convert('RGB'))
+        img = canvas
+    if img.mode != 'P':
+        img = img.convert('RGB').quantize(colors=256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    return img
+
+def _gif_image_block(img):
+    """Image descriptor + data of a palette image, with its colour table moved into a local one."""
+    buf = io.BytesIO()
+    img.save(buf, format='GIF', optimize=False)
+    data = buf.getvalue()
+
+    flags = data[10]
+    table_size = 3 * (2 << (flags & 0x07)) if flags & 0x80 else 0
+    table = data[13:13 + table_size]
+    pos = 13 + table_size
+    # Skip extension blocks (graphic control, comments) up to the image descriptor
+    while data[pos] == 0x21:
+        pos += 2
+        while data[pos]:
+            pos += data[pos] + 1
+        pos += 1
+
+    descriptor = bytearray(data[pos:pos + 10])
+    if table and not descriptor[9] & 0x80:
+        descriptor[9] = (descriptor[9] & 0x40) | 0x80 | (flags & 0x07)
+        return bytes(descriptor) + table + data[pos + 10:-1]
+    return data[pos:-1]
+
+# --- FFMPEG ---
+
+def _feed(proc, frames):
+    try:
+        for frame in frames:
+            proc.stdin.write(frame)
+    except (BrokenPipeError, ValueError):
+        pass # Encoder stopped (client gone or ffmpeg failed)
+    except Exception as e:
+        print(f"ERROR: Movie frame rendering failed: {e}")
+    finally:
+        frames.close()
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+
+def _run_encoder(cmd, frames, stdout):
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=stdout, stderr=subprocess.DEVNULL)
+    feeder = threading.Thread(target=_feed, args=(proc, frames), daemon=True)
+    feeder.start()
+    return proc, feeder
+
+def _finish_encoder(proc, feeder):
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+    feeder.join()
+
+def _ffmpeg_stream(cmd, frames):
+    proc, feeder = _run_encoder(cmd, frames, subprocess.PIPE)
+    try:
+        while True:
+            chunk = proc.stdout.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            yield chunk
+        proc.wait()
+        if proc.returncode:
+            print(f"ERROR: ffmpeg exited with code {proc.returncode}")
+    finally:
+        proc.stdout.close()
+        _finish_encoder(proc, feeder)
+
+def _ffmpeg_file(cmd, frames):
+    fd, path = tempfile.mkstemp(suffix='.movie')
+    os.close(fd)
+    try:
+        proc, feeder = _run_encoder(cmd + ['-y', path], frames, subprocess.DEVNULL)
+        try:
+            proc.wait()
+        finally:
+            _finish_encoder(proc, feeder)
+        if proc.returncode:
+            print(f"ERROR: ffmpeg exited with code {proc.returncode}")
+            return
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(STREAM_CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
@@ -1,13 +1,17 @@
-import numpy as np
 import io
 import base64
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from astropy.visualization import ZScaleInterval
+from matplotlib.texmanager import TexManager
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from .physical_axes_plotter import draw_physical_axes
 from .beam_plotter import draw_beam
+from .limits import zscale_limits
 
 # Global LaTeX settings
 plt.rcParams.update({
@@ -21,21 +25,191 @@ plt.rcParams.update({
     "ytick.labelsize": 10,
 })
 
-def create_plot(image_data, wcs, unit_label, title="", grid=False, beam=None, show_beam=False,
-                show_center=False, center_x=None, center_y=None,
-                show_physical=False, distance_val=None, distance_unit='Mpc',
-                norm_global=False, global_min=None, global_max=None,
-                user_vmin=None, user_vmax=None,
-                cbar_unit='None', show_offset=False, offset_angle_unit='arcsec',
-                fig_width=8, fig_height=8, cbar_label=None,
-                fmt='png', return_base64=True):
-    try:
-        # --- DEBUG PRINT ---
-        print(f"DEBUG: Grid Requested = {grid}")
-        
-        wcs_2d = wcs.celestial
-        fig = plt.figure(figsize=(fig_width, fig_height))
+# Text rendering profiles, applied on top of the settings above.
+# Interactive figures use mathtext (no LaTeX subprocesses); exports keep LaTeX typesetting.
+TEXT_PROFILES = {
+    'interactive': {
+        "text.usetex": False,
+        "font.serif": ["STIXGeneral", "DejaVu Serif"],
+        "mathtext.fontset": "stix",
+    },
+    'export': {
+        "text.usetex": True,
+    },
+}
+
+_usetex_checked = None
+
+def usetex_available():
+    """True if latex and dvipng are installed (needed for text.usetex PNG output)."""
+    global _usetex_checked
+    if _usetex_checked is None:
+        _usetex_checked = bool(shutil.which('latex') and shutil.which('dvipng'))
+        if not _usetex_checked:
+            print("Warning: LaTeX (latex/dvipng) not found; exports use mathtext instead of usetex")
+    return _usetex_checked
+
+def resolve_text_profile(text_profile):
+    """Profile actually used: usetex profiles fall back to mathtext when LaTeX is missing."""
+    if TEXT_PROFILES.get(text_profile, {}).get("text.usetex") and not usetex_available():
+        return 'interactive'
+    return text_profile if text_profile in TEXT_PROFILES else 'interactive'
+
+def configure_tex_cache(cache_dir):
+    """
+    Stores LaTeX output (dvi files and glyph bitmaps) under cache_dir instead of
+    matplotlib's cache directory, so it can live on a persistent volume.
+    """
+    path = Path(cache_dir).expanduser()
+    path.mkdir(parents=True, exist_ok=True)
+    if hasattr(TexManager, '_cache_dir'):
+        TexManager._cache_dir = path
+    else:
+        # Older matplotlib
+        TexManager.texcache = str(path)
+    print(f"INFO: LaTeX cache directory: {path}")
+
+def get_unit_scale(cbar_unit):
+    """
+    Returns (scale factor, unit prefix) for the colorbar unit selection.
+    """
+    if cbar_unit == 'milli':
+        return 1e3, "m"
+    elif cbar_unit == 'micro':
+        return 1e6, r"$\mu$"
+    elif cbar_unit == 'nano':
+        return 1e9, "n"
+    return 1.0, ""
+
+def get_display_limits(plot_data, norm_global=False, data_min=None, data_max=None,
+                       user_vmin=None, user_vmax=None, scale_factor=1.0, auto_limits=None):
+    """
+    Colour limits in display units.
+    Automatic limits come from plot_data (or data_min/data_max) multiplied by scale_factor;
+    user overrides are already in display units. auto_limits are precomputed (cached)
+    ZScale limits of plot_data, in the same units as plot_data.
+    Priority: Global Normalization > ZScale (Auto), then user overrides (partial or full).
+    """
+    if norm_global and data_min is not None and data_max is not None:
+        vmin, vmax = data_min * scale_factor, data_max * scale_factor
+    else:
+        # ZScale Fallback, on a subsample of the pixels
+        if auto_limits is None:
+            auto_limits = zscale_limits(plot_data)
+        if auto_limits is not None:
+            vmin, vmax = auto_limits[0] * scale_factor, auto_limits[1] * scale_factor
+        else:
+            vmin, vmax = 0, 1 # Default for empty/NaN data
+
+    # Apply User Overrides (Partial or Full)
+    if user_vmin is not None and str(user_vmin).strip() != "":
+        try:
+            vmin = float(user_vmin)
+        except ValueError:
+            pass
+
+    if user_vmax is not None and str(user_vmax).strip() != "":
+        try:
+            vmax = float(user_vmax)
+        except ValueError:
+            pass
+
+    return vmin, vmax
+
+# Serializes matplotlib work across threads
+_plot_lock = threading.RLock()
+
+# Figures are kept alive per layout (WCS, size, toggles, labels); a render that only
+# changes pixels or colour limits reuses one and updates the image in place
+FIGURE_TEMPLATE_LIMIT = 8
+_figure_templates = OrderedDict() # layout key -> _FigureTemplate
 
+SAVE_DPI = 150
+SAVE_PAD_INCHES = 0.05
+
+class _FigureTemplate:
+    """
+    A built figure and the tight bounding boxes it was saved with.
+
+    With everything but the pixels fixed, the tight box of a PNG only changes when the
+    colorbar tick labels do, so it is measured once per label set instead of on every save.
+    """
+
+    def __init__(self, wcs, fig, im, cbar):
+        self.wcs = wcs
+        self.fig = fig
+        self.im = im
+        self.cbar = cbar
+        self.tight_bboxes = {} # colorbar labels -> bbox (inches)
+
+    def update(self, plot_data, vmin, vmax):
+        self.im.set_data(plot_data)
+        self.im.set_clim(vmin, vmax)
+
+    def _colorbar_labels(self):
+        axis = self.cbar.ax.yaxis
+        formatter = axis.get_major_formatter()
+        labels = formatter.format_ticks(axis.get_majorticklocs())
+        return tuple(labels), formatter.get_offset()
+
+    def save(self, buf, fmt):
+        if fmt != 'png':
+            # Vector backends measure text differently; let savefig find their tight box
+            self.fig.savefig(buf, format=fmt, dpi=SAVE_DPI, bbox_inches='tight', pad_inches=SAVE_PAD_INCHES)
+            return
+
+        labels = self._colorbar_labels()
+        bbox = self.tight_bboxes.get(labels)
+        if bbox is None:
+            # Same measurement savefig(bbox_inches='tight') makes: an Agg draw at the save dpi
+            original_dpi = self.fig.dpi
+            self.fig.dpi = SAVE_DPI
+            try:
+                self.fig.canvas.draw()
+                bbox = self.fig.get_tightbbox(self.fig.canvas.get_renderer()).padded(SAVE_PAD_INCHES)
+            finally:
+                self.fig.dpi = original_dpi
+            if len(self.tight_bboxes) >= 64:
+                self.tight_bboxes.clear()
+            self.tight_bboxes[labels] = bbox
+        self.fig.savefig(buf, format=fmt, dpi=SAVE_DPI, bbox_inches=bbox)
+
+    def close(self):
+        plt.close(self.fig)
+
+def _layout_key(wcs, shape, *layout):
+    # The WCS object is compared by identity; the template keeps it alive, so ids are never reused
+    return (id(wcs), tuple(shape), repr(layout))
+
+def _get_template(key, wcs):
+    template = _figure_templates.get(key)
+    if template is None or template.wcs is not wcs:
+        return None
+    _figure_templates.move_to_end(key)
+    return template
+
+def _store_template(key, template):
+    _figure_templates[key] = template
+    while len(_figure_templates) > FIGURE_TEMPLATE_LIMIT:
+        _, old = _figure_templates.popitem(last=False)
+        old.close()
+
+def clear_figure_templates():
+    """Closes every cached figure."""
+    with _plot_lock:
+        while _figure_templates:
+            _, template = _figure_templates.popitem(last=False)
+            template.close()
+
+def _build_figure(plot_data, vmin, vmax, wcs, final_unit_label, title, grid, beam, show_beam,
+                  show_center, center_x, center_y, show_physical, distance_val, distance_unit,
+                  show_offset, offset_angle_unit, fig_width, fig_height, cbar_label):
+    """
+    Builds the full figure (WCS axes, overlays, colorbar) around plot_data.
+    """
+    wcs_2d = wcs.celestial
+    fig = plt.figure(figsize=(fig_width, fig_height))
+    try:
         if show_offset and center_x is not None and center_y is not None:
             # Shift WCS to be a relative offset from center
             wcs_axes = wcs_2d.deepcopy()
@@ -44,10 +218,10 @@ def create_plot(image_data, wcs, unit_label, title="", grid=False, beam=None, sh
                 wcs_axes.wcs.crpix = [float(center_x) + 1, float(center_y) + 1]
                 # Set reference value to 0,0
                 wcs_axes.wcs.crval = [0, 0]
-                
+            
                 # Change CTYPE to generic linear to allow arbitrary scaling without RA/Dec limits
                 wcs_axes.wcs.ctype = ["LINEAR", "LINEAR"]
-                
+            
                 # Scaling factor (1 deg = 3600 arcsec, or 3,600,000 mas)
                 if offset_angle_unit == 'milliarcsec':
                     angle_multiplier = 3600.0 * 1000.0
@@ -60,10 +234,10 @@ def create_plot(image_data, wcs, unit_label, title="", grid=False, beam=None, sh
                     wcs_axes.wcs.cdelt = [d * angle_multiplier for d in wcs_axes.wcs.cdelt]
                 if hasattr(wcs_axes.wcs, 'cd'):
                     wcs_axes.wcs.cd = wcs_axes.wcs.cd * angle_multiplier
-                    
+                
                 ax = plt.subplot(projection=wcs_axes)
                 # No special formatter needed for LINEAR, defaults to decimal
-                
+            
                 ax.set_xlabel(rf'$\Delta$ RA [{unit_str}]')
                 ax.set_ylabel(rf'$\Delta$ Dec [{unit_str}]')
             except Exception as e:
@@ -76,64 +250,15 @@ def create_plot(image_data, wcs, unit_label, title="", grid=False, beam=None, sh
             ax.set_xlabel('Right Ascension [J2000]')
             ax.set_ylabel('Declination [J2000]')
         
-        # --- INTENSITY SCALING ---
-        scale_factor = 1.0
-        unit_prefix = ""
-        if cbar_unit == 'milli':
-            scale_factor = 1e3
-            unit_prefix = "m"
-        elif cbar_unit == 'micro':
-            scale_factor = 1e6
-            unit_prefix = r"$\mu$"
-        elif cbar_unit == 'nano':
-            scale_factor = 1e9
-            unit_prefix = "n"
-
-        # Apply scaling to data for plotting purposes
-        plot_data = image_data * scale_factor
-        scaled_min = (global_min * scale_factor) if global_min is not None else None
-        scaled_max = (global_max * scale_factor) if global_max is not None else None
-        
-        # Adjust unit label
-        # Example: Jy/beam -> mJy/beam
-        final_unit_label = f"{unit_prefix}{unit_label}"
-
-        # Plot Data
-        # Plot Data
-        # Determine Default Scaling (Base)
-        # Priority: Global Normalization > ZScale (Auto)
-        if norm_global and scaled_min is not None and scaled_max is not None:
-             vmin, vmax = scaled_min, scaled_max
-        else:
-            # ZScale Fallback
-            if np.any(np.isfinite(plot_data)):
-                interval = ZScaleInterval()
-                vmin, vmax = interval.get_limits(plot_data)
-            else:
-                vmin, vmax = 0, 1 # Default for empty/NaN data
-
-        # Apply User Overrides (Partial or Full)
-        if user_vmin is not None and str(user_vmin).strip() != "":
-            try:
-                vmin = float(user_vmin)
-            except ValueError:
-                pass
-                
-        if user_vmax is not None and str(user_vmax).strip() != "":
-            try:
-                vmax = float(user_vmax)
-            except ValueError:
-                pass
-            
         im = ax.imshow(plot_data, origin='lower', cmap='viridis', vmin=vmin, vmax=vmax)
-        
+    
         # --- GRIDLINES FIX ---
         if grid:
             ax.coords.grid(True, ls='dotted')
 
         # --- BEAM INFO ---
         if show_beam:
-            draw_beam(ax, wcs_2d, beam, image_data.shape)
+            draw_beam(ax, wcs_2d, beam, plot_data.shape)
 
         # --- CENTER MARKER ---
         if show_center and center_x is not None and center_y is not None:
@@ -152,21 +277,6 @@ def create_plot(image_data, wcs, unit_label, title="", grid=False, beam=None, sh
         if title:
             ax.set_title(title, pad=15, fontsize=14)
 
-        # --- Coordinates Definitions ---
-        try:
-            ra = ax.coords['ra']
-        except:
-            ra = ax.coords[0]
-
-        try:
-            dec = ax.coords['dec']
-        except:
-            dec = ax.coords[1]
-
-        # Standard Labels (already handled above if offset)
-        # ax.set_xlabel('Right Ascension [J2000]')
-        # ax.set_ylabel('Declination [J2000]')
-
         # Styling
         ax.tick_params(direction='out', color='black')
 
@@ -178,16 +288,95 @@ def create_plot(image_data, wcs, unit_label, title="", grid=False, beam=None, sh
         cbar = plt.colorbar(im, cax=cax)
         cax.tick_params(axis='x', which='both', bottom=False, top=False)
         cax.tick_params(axis='y', which='both', left=False, right=True)
-        if not (final_unit_label.startswith('[') and final_unit_label.endswith(']')):
+        # Dimensionless maps (skewness, kurtosis) go without brackets
+        if final_unit_label and not (final_unit_label.startswith('[') and final_unit_label.endswith(']')):
             final_unit_label = f"[{final_unit_label}]"
-        cbar.set_label(f'{cbar_label} {final_unit_label}', rotation=270, labelpad=20)
+        cbar.set_label(f'{cbar_label} {final_unit_label}'.rstrip(), rotation=270, labelpad=20)
+    except Exception:
+        plt.close(fig)
+        raise
+
+    return _FigureTemplate(wcs, fig, im, cbar)
+
+def create_plot(image_data, wcs, unit_label, title="", grid=False, beam=None, show_beam=False,
+                show_center=False, center_x=None, center_y=None,
+                show_physical=False, distance_val=None, distance_unit='Mpc',
+                norm_global=False, global_min=None, global_max=None,
+                user_vmin=None, user_vmax=None,
+                cbar_unit='None', show_offset=False, offset_angle_unit='arcsec',
+                fig_width=8, fig_height=8, cbar_label=None,
+                fmt='png', return_base64=True, text_profile='export', auto_limits=None):
+    """
+    Full matplotlib figure of a 2D map.
+    text_profile 'interactive' typesets with mathtext, 'export' with LaTeX (see TEXT_PROFILES).
+    auto_limits: cached ZScale limits of image_data (data units), computed here if None.
+    """
+    text_profile = resolve_text_profile(text_profile)
+
+    # pyplot keeps global figure state: renders from request and prefetch threads take turns
+    with _plot_lock, plt.rc_context(TEXT_PROFILES[text_profile]):
+        return _create_plot(
+            image_data, wcs, unit_label, title=title, grid=grid, beam=beam, show_beam=show_beam,
+            show_center=show_center, center_x=center_x, center_y=center_y,
+            show_physical=show_physical, distance_val=distance_val, distance_unit=distance_unit,
+            norm_global=norm_global, global_min=global_min, global_max=global_max,
+            user_vmin=user_vmin, user_vmax=user_vmax,
+            cbar_unit=cbar_unit, show_offset=show_offset, offset_angle_unit=offset_angle_unit,
+            fig_width=fig_width, fig_height=fig_height, cbar_label=cbar_label,
+            fmt=fmt, return_base64=return_base64, text_profile=text_profile, auto_limits=auto_limits)
+
+def _create_plot(image_data, wcs, unit_label, title="", grid=False, beam=None, show_beam=False,
+                 show_center=False, center_x=None, center_y=None,
+                 show_physical=False, distance_val=None, distance_unit='Mpc',
+                 norm_global=False, global_min=None, global_max=None,
+                 user_vmin=None, user_vmax=None,
+                 cbar_unit='None', show_offset=False, offset_angle_unit='arcsec',
+                 fig_width=8, fig_height=8, cbar_label=None,
+                 fmt='png', return_base64=True, text_profile='export', auto_limits=None):
+    # Body of create_plot, run under _plot_lock with the text profile applied
+    try:
+        # --- DEBUG PRINT ---
+        print(f"DEBUG: Grid Requested = {grid}")
+    
+        # --- INTENSITY SCALING ---
+        scale_factor, unit_prefix = get_unit_scale(cbar_unit)
+
+        # Apply scaling to data for plotting purposes
+        plot_data = image_data * scale_factor
+        scaled_min = (global_min * scale_factor) if global_min is not None else None
+        scaled_max = (global_max * scale_factor) if global_max is not None else None
+    
+        # Adjust unit label
+        # Example: Jy/beam -> mJy/beam
+        final_unit_label = f"{unit_prefix}{unit_label}"
+
+        scaled_auto = (auto_limits[0] * scale_factor, auto_limits[1] * scale_factor) if auto_limits else None
+        vmin, vmax = get_display_limits(plot_data, norm_global, scaled_min, scaled_max, user_vmin, user_vmax,
+                                        auto_limits=scaled_auto)
+
+        beam_layout = tuple(sorted(beam.items())) if (show_beam and beam) else None
+        key = _layout_key(wcs, plot_data.shape, text_profile, final_unit_label, title, grid, show_beam, beam_layout,
+                          show_center, center_x, center_y, show_physical, distance_val, distance_unit,
+                          show_offset, offset_angle_unit, fig_width, fig_height, cbar_label)
+        template = _get_template(key, wcs)
+        if template is not None:
+            template.update(plot_data, vmin, vmax)
+        else:
+            template = _build_figure(plot_data, vmin, vmax, wcs, final_unit_label, title, grid, beam, show_beam,
+                                     show_center, center_x, center_y, show_physical, distance_val, distance_unit,
+                                     show_offset, offset_angle_unit, fig_width, fig_height, cbar_label)
+            _store_template(key, template)
 
-        # Save
         # Save
         buf = io.BytesIO()
-        plt.savefig(buf, format=fmt, dpi=150, bbox_inches='tight', pad_inches=0.05)
+        try:
+            template.save(buf, fmt)
+        except Exception:
+            # Do not reuse a figure left in an unknown state
+            _figure_templates.pop(key, None)
+            template.close()
+            raise
         buf.seek(0)
-        plt.close(fig)
 
         if return_base64:
             return base64.b64encode(buf.getvalue()).decode('utf-8')
@@ -198,4 +387,4 @@ def create_plot(image_data, wcs, unit_label, title="", grid=False, beam=None, sh
         print(f"Plotting Error: {e}")
         import traceback
         traceback.print_exc()
-        raise e
\ No newline at end of file
+        raise e
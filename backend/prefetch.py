@@ -0,0 +1,126 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .render_cache import render_cache
+
+class _Window:
+    """Prefetch bookkeeping of one owner (session)."""
+
+    def __init__(self):
+        self.generation = 0
+        self.params_key = None
+        self.pending = {} # channel -> Future
+
+class ChannelPrefetcher:
+    """
+    Renders the channels around the last requested one into the render cache
+    with a small worker pool, so stepping through a cube is served from memory.
+
+    Each owner (a browser session) has its own window, tagged with a generation;
+    when that owner's render parameters change, its queued jobs are cancelled and
+    jobs already started drop their result. Other owners are unaffected.
+    """
+
+    def __init__(self, cache, depth=2, workers=2):
+        self.cache = cache
+        self.depth = depth
+        self.workers = workers
+        self._executor = None
+        # Reentrant: a job that already finished runs its done-callback inside schedule()
+        self._lock = threading.RLock()
+        self._windows = {} # owner -> _Window
+
+    def configure(self, depth=None, workers=None):
+        with self._lock:
+            if depth is not None:
+                self.depth = max(0, int(depth))
+            if workers is not None and workers != self.workers:
+                self.workers = max(1, int(workers))
+                self._shutdown_locked()
+
+    def schedule(self, owner, channel, n_channels, params_key, key_fn, render_fn):
+        """
+        Queues renders of channel +/- 1..depth (nearest first) for owner.
+        params_key identifies cube, mask and visual parameters; key_fn(c) gives the
+        cache key of channel c and render_fn(c) returns (image bytes, cache tags).
+        """
+        if self.depth <= 0:
+            return
+
+        with self._lock:
+            window = self._windows.get(owner)
+            if window is None:
+                window = self._windows[owner] = _Window()
+
+            if params_key != window.params_key:
+                # Parameters changed: everything queued so far is stale
+                window.generation += 1
+                window.params_key = params_key
+                self._cancel_locked(window, keep=())
+                # Jobs already running finish on their own and discard their result
+                window.pending.clear()
+
+            channels = []
+            for step in range(1, self.depth + 1):
+                for c in (channel + step, channel - step):
+                    if 0 <= c < n_channels:
+                        channels.append(c)
+
+            # Channels that fell out of the window are no longer worth rendering
+            self._cancel_locked(window, keep=channels)
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='prefetch')
+
+            generation = window.generation
+            for c in channels:
+                if c in window.pending:
+                    continue
+                key = key_fn(c)
+                if self.cache.get(key) is not None:
+                    continue
+                future = self._executor.submit(self._run, window, generation, c, key, render_fn)
+                window.pending[c] = future
+                future.add_done_callback(lambda f, window=window, c=c: self._forget(window, c, f))
+
+    def discard(self, owner):
+        """Cancels and forgets everything queued for owner (e.g. an evicted session)."""
+        with self._lock:
+            window = self._windows.pop(owner, None)
+            if window is not None:
+                window.generation += 1
+                self._cancel_locked(window, keep=())
+                window.pending.clear()
+
+    def _run(self, window, generation, channel, key, render_fn):
+        if generation != window.generation or self.cache.get(key) is not None:
+            return
+        try:
+            image, tags = render_fn(channel)
+        except Exception as e:
+            print(f"Warning: Prefetch of channel {channel} failed: {e}")
+            return
+        # Parameters may have changed while rendering
+        if generation == window.generation:
+            self.cache.put(key, image, tags)
+
+    def _forget(self, window, channel, future):
+        with self._lock:
+            if window.pending.get(channel) is future:
+                del window.pending[channel]
+
+    def _cancel_locked(self, window, keep):
+        for c in list(window.pending):
+            # cancel() runs the done-callback (_forget) at once, which may already drop the entry
+            if c not in keep and window.pending[c].cancel():
+                window.pending.pop(c, None)
+
+    def _shutdown_locked(self):
+        for window in self._windows.values():
+            self._cancel_locked(window, keep=())
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+# Shared instance used by the routes
+prefetcher = ChannelPrefetcher(render_cache)
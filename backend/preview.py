@@ -0,0 +1,216 @@
+import io
+import zlib
+import numpy as np
+import matplotlib
+from PIL import Image, ImageDraw, ImageFont
+from astropy.wcs.utils import proj_plane_pixel_scales
+from .plotter import get_unit_scale, get_display_limits
+
+# Interactive views use the preview renderer unless configured (or requested) otherwise.
+# 'publication' sends them through the full matplotlib figure (mathtext labels);
+# /export always uses that figure typeset with LaTeX.
+RENDER_MODES = ('preview', 'publication')
+RENDER_MODE = 'preview'
+
+# Encoding of preview frames: 'png' or 'webp'
+PREVIEW_FORMAT = 'png'
+
+# Palette PNGs are deflated with run-length matching only: blank and clipped areas
+# still shrink, but encoding costs a fraction of the default LZ77 search
+PNG_COMPRESS_LEVEL = 1
+PNG_COMPRESS_TYPE = zlib.Z_RLE
+
+# --- PALETTE ---
+# Indices 0..N_LEVELS-1 hold the colormap, the rest are overlay colours
+N_LEVELS = 250
+GREY, BLACK, WHITE, RED = 250, 251, 252, 253
+NAN_INDEX = 255 # Blank pixels, drawn white like the matplotlib figure background
+
+def _build_palette(cmap_name='viridis'):
+    rgb = np.zeros((256, 3), dtype=np.uint8)
+    cmap = matplotlib.colormaps[cmap_name]
+    rgb[:N_LEVELS] = np.round(cmap(np.linspace(0.0, 1.0, N_LEVELS))[:, :3] * 255)
+    rgb[GREY] = (128, 128, 128)
+    rgb[BLACK] = (0, 0, 0)
+    rgb[WHITE] = (255, 255, 255)
+    rgb[RED] = (255, 0, 0)
+    rgb[NAN_INDEX] = (255, 255, 255)
+    return rgb.ravel().tolist()
+
+_PALETTE = _build_palette()
+
+def resolve_render_mode(req_data):
+    """Render mode of an interactive request: its 'renderMode' field if valid, else RENDER_MODE."""
+    mode = req_data.get('renderMode')
+    return mode if mode in RENDER_MODES else RENDER_MODE
+
+def interactive_format(mode):
+    """Image format served for interactive views in the given render mode."""
+    return PREVIEW_FORMAT if mode == 'preview' else 'png'
+
+def to_palette_indices(image_data, vmin, vmax):
+    """
+    Maps a 2D slice linearly onto palette indices 0..N_LEVELS-1 (clipped), NaN -> NAN_INDEX.
+    Rows are flipped so the first image row is the top of the sky (origin='lower').
+    """
+    lo, hi = float(vmin), float(vmax)
+    scale = (N_LEVELS - 1) / (hi - lo) if hi > lo else 0.0
+
+    # One float32 work buffer, updated in place
+    work = np.subtract(image_data[::-1], np.float32(lo), dtype=np.float32)
+    work *= np.float32(scale)
+    np.clip(work, 0, N_LEVELS - 1, out=work)
+    # +0.5 rounds to the nearest level; NaN stays NaN through clip and add
+    work += np.float32(0.5)
+    work[np.isnan(work)] = NAN_INDEX
+    return work.astype(np.uint8)
+
+def _ticks(n, count=8):
+    step = max(1, n // count)
+    return np.arange(step, n - 1, step)
+
+def _draw_frame(indices, grid):
+    """Frame with inward ticks, plus dotted lines at the tick positions if grid is set."""
+    h, w = indices.shape
+    tick = max(2, min(h, w) // 60)
+    xt, yt = _ticks(w), _ticks(h)
+
+    if grid:
+        indices[yt[:, None], np.arange(0, w, 3)] = BLACK
+        indices[np.arange(0, h, 3)[:, None], xt] = BLACK
+
+    indices[[0, -1], :] = BLACK
+    indices[:, [0, -1]] = BLACK
+    indices[:tick, xt] = BLACK
+    indices[-tick:, xt] = BLACK
+    indices[yt, :tick] = BLACK
+    indices[yt, -tick:] = BLACK
+
+def _load_font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow < 10.1 only has the fixed bitmap font
+        return ImageFont.load_default()
+
+def _draw_text(draw, xy, text, font, anchor='la'):
+    try:
+        draw.text(xy, text, fill=WHITE, font=font, anchor=anchor, stroke_width=1, stroke_fill=BLACK)
+    except ValueError:
+        # Bitmap fonts do not support anchors
+        draw.text(xy, text, fill=WHITE, font=font, stroke_width=1, stroke_fill=BLACK)
+
+def _draw_beam(draw, wcs_2d, beam, shape, factor=1):
+    """
+    Beam ellipse and axes in the lower left corner, same geometry as beam_plotter.draw_beam.
+    factor is the size of a map pixel in cube pixels.
+    """
+    if not beam or not beam.get('bmaj'):
+        return
+    try:
+        scales = proj_plane_pixel_scales(wcs_2d)
+        bmaj_pix = beam['bmaj'] / scales[1] / factor
+        bmin_pix = beam['bmin'] / scales[0] / factor
+        rad_pa = np.radians(beam['bpa'])
+
+        h, w = shape
+        offset = 0.05 * min(h, w)
+        bx = by = offset + bmaj_pix / 2
+
+        # Major axis along (-sin PA, cos PA), minor along (cos PA, sin PA), in pixel (x, y)
+        maj = np.array([-np.sin(rad_pa), np.cos(rad_pa)]) * bmaj_pix / 2
+        mnr = np.array([np.cos(rad_pa), np.sin(rad_pa)]) * bmin_pix / 2
+        t = np.linspace(0, 2 * np.pi, 64, endpoint=False)
+        pts = np.array([bx, by]) + np.outer(np.cos(t), mnr) + np.outer(np.sin(t), maj)
+
+        def to_image(p):
+            return [(float(x), float(h - 1 - y)) for x, y in p]
+
+        draw.polygon(to_image(pts), fill=GREY, outline=BLACK)
+        for axis in (maj, mnr):
+            draw.line(to_image([(bx - axis[0], by - axis[1]), (bx + axis[0], by + axis[1])]), fill=BLACK)
+    except Exception as beam_err:
+        print(f"Warning: Could not draw beam: {beam_err}")
+
+def _draw_center(draw, center_x, center_y, shape):
+    try:
+        h, w = shape
+        cx, cy = float(center_x), h - 1 - float(center_y)
+        r_out = max(4, min(h, w) / 50)
+        angles = np.pi / 2 + np.arange(10) * np.pi / 5
+        radii = np.where(np.arange(10) % 2 == 0, r_out, r_out * 0.4)
+        star = [(cx + r * np.cos(a), cy - r * np.sin(a)) for r, a in zip(radii, angles)]
+        draw.polygon(star, fill=RED, outline=BLACK)
+    except Exception as e:
+        print(f"Error drawing center marker: {e}")
+
+def _draw_colorbar(draw, vmin, vmax, unit_label, font, shape):
+    """Inset colorbar in the upper right corner with its limits and unit."""
+    h, w = shape
+    margin = max(4, min(h, w) // 40)
+    bar_w = max(4, w // 40)
+    bar_h = max(N_LEVELS // 5, h * 2 // 5)
+    x1 = w - 1 - margin
+    x0 = x1 - bar_w
+    y0 = margin
+    y1 = min(h - 1 - margin, y0 + bar_h)
+
+    levels = np.linspace(N_LEVELS - 1, 0, y1 - y0 + 1).round().astype(np.uint8)
+    for row, level in enumerate(levels):
+        draw.line([(x0, y0 + row), (x1, y0 + row)], fill=int(level))
+    draw.rectangle([x0, y0, x1, y1], outline=BLACK)
+
+    _draw_text(draw, (x0 - 3, y0), f"{vmax:.3g}", font, anchor='ra')
+    _draw_text(draw, (x0 - 3, y1), f"{vmin:.3g}", font, anchor='rd')
+    if unit_label:
+        _draw_text(draw, (x1, y1 + 3), unit_label, font, anchor='ra')
+
+def render_preview(image_data, wcs, unit_label, title="", grid=False, beam=None, show_beam=False,
+                   show_center=False, center_x=None, center_y=None,
+                   norm_global=False, global_min=None, global_max=None,
+                   user_vmin=None, user_vmax=None, cbar_unit='None', fmt=None, auto_limits=None,
+                   factor=1, origin=(0, 0)):
+    """
+    Fast interactive rendering of a 2D map: colormap lookup + PNG/WebP encoding, with
+    frame, grid, beam, center marker, title and colorbar drawn as light overlays.
+    One image pixel per data pixel. A map cut from an overview level or a zoom window
+    gives the cube pixels per map pixel (factor) and the cube pixel of its lower left
+    corner (origin), so overlays land where they do on the full cube. Returns the encoded bytes.
+    Physical/offset axes and figure size only apply to the publication figure.
+    """
+    fmt = fmt or PREVIEW_FORMAT
+
+    # Limits follow create_plot exactly; the data itself stays unscaled
+    scale_factor, unit_prefix = get_unit_scale(cbar_unit)
+    vmin, vmax = get_display_limits(image_data, norm_global, global_min, global_max,
+                                    user_vmin, user_vmax, scale_factor=scale_factor, auto_limits=auto_limits)
+    indices = to_palette_indices(image_data, vmin / scale_factor, vmax / scale_factor)
+
+    _draw_frame(indices, grid)
+
+    img = Image.fromarray(indices, mode='P')
+    img.putpalette(_PALETTE)
+    draw = ImageDraw.Draw(img)
+    font = _load_font(max(10, min(indices.shape) // 40))
+
+    if show_beam:
+        _draw_beam(draw, wcs.celestial, beam, indices.shape, factor)
+    if show_center and center_x is not None and center_y is not None and str(center_x) != '' and str(center_y) != '':
+        # Cube pixel centres to map pixel centres
+        cx = (float(center_x) - origin[0] + 0.5) / factor - 0.5
+        cy = (float(center_y) - origin[1] + 0.5) / factor - 0.5
+        _draw_center(draw, cx, cy, indices.shape)
+    if title:
+        _draw_text(draw, (6, 4), title.replace('\n', ' - '), font)
+
+    # Mathtext prefix of the publication figure reads better as a plain letter here
+    plain_prefix = 'u' if cbar_unit == 'micro' else unit_prefix
+    unit_text = f"{plain_prefix}{unit_label}" if unit_label else ''
+    _draw_colorbar(draw, vmin, vmax, unit_text, font, indices.shape)
+
+    buf = io.BytesIO()
+    if fmt == 'webp':
+        img.convert('RGB').save(buf, format='WEBP', quality=90, method=0)
+    else:
+        img.save(buf, format='PNG', compress_level=PNG_COMPRESS_LEVEL, compress_type=PNG_COMPRESS_TYPE)
+    return buf.getvalue()
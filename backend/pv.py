@@ -0,0 +1,221 @@
+import io
+import math
+import warnings
+
+import numpy as np
+import matplotlib.pyplot as plt
+from astropy.wcs.utils import proj_plane_pixel_scales
+
+from .fits_handler import apply_mask
+from .moments.calculator import get_spectral_axis
+from .plotter import (_plot_lock, TEXT_PROFILES, SAVE_DPI, SAVE_PAD_INCHES, resolve_text_profile,
+                      get_unit_scale, get_display_limits)
+
+# Upper bounds on the samples along the path and across the slit
+PV_MAX_SAMPLES = 16384
+PV_MAX_WIDTH = 101
+
+# Working set of one block of channels while the slice is sampled (bytes)
+PV_MEMORY_BUDGET = 128 * 1024 * 1024
+
+# A sample is valid when its finite neighbours carry at least this share of the interpolation weight
+PV_MIN_WEIGHT = 0.5
+
+CMAP = 'viridis'
+
+def pv_path(req_data):
+    """
+    End points (x1, y1, x2, y2) in pixels of the slice a request describes: the end
+    points themselves when all four are given, otherwise 'pvCenterX', 'pvCenterY', 'angle'
+    (position angle in degrees, from north (+y) through east (-x)) and 'length' (pixels).
+    """
+    ends = [req_data.get(k) for k in ('x1', 'y1', 'x2', 'y2')]
+    if all(v not in (None, '') for v in ends):
+        x1, y1, x2, y2 = (float(v) for v in ends)
+    else:
+        centre = [req_data.get(k) for k in ('pvCenterX', 'pvCenterY', 'angle', 'length')]
+        if any(v in (None, '') for v in centre):
+            raise ValueError("Give the slice as end points (x1, y1, x2, y2) or as centre, angle and length.")
+        cx, cy, angle, length = (float(v) for v in centre)
+        pa = math.radians(angle)
+        dx, dy = -math.sin(pa) * length / 2, math.cos(pa) * length / 2
+        x1, y1, x2, y2 = cx - dx, cy - dy, cx + dx, cy + dy
+    if not all(math.isfinite(v) for v in (x1, y1, x2, y2)):
+        raise ValueError("Slice end points must be finite numbers.")
+    if math.hypot(x2 - x1, y2 - y1) < 1:
+        raise ValueError("Slice must be at least one pixel long.")
+    return x1, y1, x2, y2
+
+def sample_points(x1, y1, x2, y2, width=1):
+    """
+    Pixel positions sampled for a slice: one pixel apart along the path and, for a
+    slit wider than one pixel, one pixel apart across it.
+    Returns (xs, ys) of shape (n_across, n_along) and the distance of each sample
+    along the path from its centre (pixels).
+    """
+    length = math.hypot(x2 - x1, y2 - y1)
+    n_along = int(math.ceil(length)) + 1
+    if n_along > PV_MAX_SAMPLES:
+        raise ValueError(f"Slice is {n_along} samples long (at most {PV_MAX_SAMPLES}).")
+    width = float(width)
+    if not 1 <= width <= PV_MAX_WIDTH:
+        raise ValueError(f"Slit width must be between 1 and {PV_MAX_WIDTH} pixels.")
+
+    ux, uy = (x2 - x1) / length, (y2 - y1) / length
+    along = np.linspace(0.0, length, n_along)
+    n_across = max(1, int(round(width)))
+    across = np.linspace(-(width - 1) / 2, (width - 1) / 2, n_across)
+    # The perpendicular is (-uy, ux)
+    xs = x1 + along[None, :] * ux - across[:, None] * uy
+    ys = y1 + along[None, :] * uy + across[:, None] * ux
+    return xs, ys, along - length / 2
+
+def extract_pv(data, x1, y1, x2, y2, width=1, start=0, end=None, mask=None, invert_mask=False, memory_budget=None):
+    """
+    Position-velocity slice of a (channels, y, x) cube between two pixel positions.
+    Every channel is interpolated (bilinear, NaN-aware) at all sample positions at
+    once, and samples across a slit wider than one pixel are averaged. Only the
+    bounding box of the samples is read, a block of channels at a time.
+    Returns a float32 array (channels start..end, samples along the path) and the
+    offsets of the samples from the path centre (pixels).
+    """
+    n_channels, height, w = data.shape
+    end = n_channels - 1 if end is None else min(int(end), n_channels - 1)
+    start = max(0, int(start))
+    if end < start:
+        raise ValueError("No channels in the requested range.")
+
+    xs, ys, offsets = sample_points(x1, y1, x2, y2, width)
+    n_across, n_along = xs.shape
+    pv = np.full((end - start + 1, n_along), np.nan, dtype=np.float32)
+
+    # Samples off the image stay blank
+    inside = (xs >= 0) & (xs <= w - 1) & (ys >= 0) & (ys <= height - 1)
+    if not inside.any():
+        return pv, offsets
+    bx0, by0 = int(np.floor(xs[inside].min())), int(np.floor(ys[inside].min()))
+    bx1, by1 = int(np.ceil(xs[inside].max())) + 1, int(np.ceil(ys[inside].max())) + 1
+    box_w = bx1 - bx0
+
+    # Corner indices and weights in the flattened box, shared by every channel
+    px, py = np.where(inside, xs - bx0, 0.0).ravel(), np.where(inside, ys - by0, 0.0).ravel()
+    ix0, iy0 = np.floor(px).astype(np.int64), np.floor(py).astype(np.int64)
+    fx, fy = px - ix0, py - iy0
+    ix1, iy1 = np.minimum(ix0 + 1, box_w - 1), np.minimum(iy0 + 1, by1 - by0 - 1)
+    corners = [(iy0 * box_w + ix0, (1 - fx) * (1 - fy)), (iy0 * box_w + ix1, fx * (1 - fy)),
+               (iy1 * box_w + ix0, (1 - fx) * fy), (iy1 * box_w + ix1, fx * fy)]
+    corners = [(idx, weight.astype(np.float32)) for idx, weight in corners]
+    valid_point = inside.ravel()
+
+    n_points = len(px)
+    per_voxel = (by1 - by0) * box_w + 6 * n_points
+    per_chunk = max(1, (memory_budget or PV_MEMORY_BUDGET) // max(1, per_voxel * 4))
+    for c0 in range(start, end + 1, per_chunk):
+        c1 = min(end + 1, c0 + per_chunk)
+        block = np.asarray(data[c0:c1, by0:by1, bx0:bx1], dtype=np.float32)
+        if mask is not None:
+            block = apply_mask(block, mask[c0:c1, by0:by1, bx0:bx1], invert_mask)
+        flat = block.reshape(c1 - c0, -1)
+
+        total = np.zeros((c1 - c0, n_points), dtype=np.float32)
+        weights = np.zeros((c1 - c0, n_points), dtype=np.float32)
+        for idx, weight in corners:
+            values = flat[:, idx]
+            finite = np.isfinite(values)
+            total += np.where(finite, values, 0) * weight
+            weights += finite * weight
+        with np.errstate(divide='ignore', invalid='ignore'):
+            samples = np.where((weights >= PV_MIN_WEIGHT) & valid_point, total / weights, np.nan)
+
+        with warnings.catch_warnings():
+            # Samples blank across the whole slit stay NaN on purpose
+            warnings.simplefilter('ignore', RuntimeWarning)
+            pv[c0 - start:c1 - start] = np.nanmean(samples.reshape(c1 - c0, n_across, n_along), axis=1)
+    return pv, offsets
+
+def offset_scale(wcs, x1, y1, x2, y2):
+    """Arcseconds per pixel along the path."""
+    try:
+        scales = proj_plane_pixel_scales(wcs.celestial)
+        length = math.hypot(x2 - x1, y2 - y1)
+        return 3600.0 * math.hypot((x2 - x1) / length * scales[0], (y2 - y1) / length * scales[1])
+    except Exception as e:
+        print(f"Warning: No celestial pixel scale for PV offsets ({e}); using pixels")
+        return None
+
+def render_pv(pv, offsets, spectral, spectral_unit, unit_label, title="", grid=False,
+              norm_global=False, global_min=None, global_max=None,
+              user_vmin=None, user_vmax=None, cbar_unit='None',
+              offset_unit='arcsec', offset_angle_unit='arcsec', fig_width=8, fig_height=6,
+              cbar_label="Specific Intensity", fmt='png', text_profile='export', auto_limits=None):
+    """
+    Figure of a position-velocity slice: offset along the path on x, spectral
+    coordinate on y. Offsets in arcsec are shown in offset_angle_unit. Returns the encoded bytes.
+    """
+    if offset_unit == 'arcsec' and offset_angle_unit == 'milliarcsec':
+        offsets, offset_unit = offsets * 1000.0, 'mas'
+    scale_factor, unit_prefix = get_unit_scale(cbar_unit)
+    vmin, vmax = get_display_limits(pv, norm_global, global_min, global_max, user_vmin, user_vmax,
+                                    scale_factor=scale_factor, auto_limits=auto_limits)
+
+    # Cell edges, so every sample is drawn centred on its offset and channel
+    d_off = offsets[1] - offsets[0] if len(offsets) > 1 else 1.0
+    d_spec = float(spectral[1] - spectral[0]) if len(spectral) > 1 else 1.0
+    extent = (offsets[0] - d_off / 2, offsets[-1] + d_off / 2,
+              spectral[0] - d_spec / 2, spectral[-1] + d_spec / 2)
+
+    text_profile = resolve_text_profile(text_profile)
+    with _plot_lock, plt.rc_context(TEXT_PROFILES[text_profile]):
+        fig = plt.figure(figsize=(float(fig_width), float(fig_height)))
+        try:
+            ax = fig.add_subplot(1, 1, 1)
+            im = ax.imshow(pv * scale_factor, origin='lower', cmap=CMAP, vmin=vmin, vmax=vmax,
+                           extent=extent, aspect='auto', interpolation='nearest')
+            ax.set_xlabel(f'Offset [{offset_unit}]')
+            ax.set_ylabel(f'Velocity [{spectral_unit}]' if spectral_unit == 'km/s' else f'Spectral Axis [{spectral_unit}]')
+            if grid:
+                ax.grid(True, ls='dotted', color='white', alpha=0.6)
+            if title:
+                ax.set_title(title, pad=15, fontsize=14)
+            ax.tick_params(direction='out', color='black')
+
+            final_unit_label = f"{unit_prefix}{unit_label}"
+            if not (final_unit_label.startswith('[') and final_unit_label.endswith(']')):
+                final_unit_label = f"[{final_unit_label}]"
+            cbar = fig.colorbar(im, ax=ax, fraction=0.05, pad=0.03)
+            cbar.set_label(f'{cbar_label} {final_unit_label}', rotation=270, labelpad=20)
+
+            buf = io.BytesIO()
+            fig.savefig(buf, format=fmt, dpi=SAVE_DPI, bbox_inches='tight', pad_inches=SAVE_PAD_INCHES)
+            return buf.getvalue()
+        finally:
+            plt.close(fig)
+
+def compute_pv(state, req_data):
+    """
+    Extracts the slice a request describes from a session's cube and mask.
+    Returns the dict stored by FitsState.set_pv (without its token).
+    """
+    x1, y1, x2, y2 = pv_path(req_data)
+    width = float(req_data.get('width') or 1)
+    n_channels = state.data.shape[0]
+    # An unset slider means the whole cube; start == end is a one-channel slice
+    start = int(req_data.get('startChan') or 0)
+    end_chan = req_data.get('endChan')
+    end = int(end_chan) if end_chan not in (None, '') else n_channels - 1
+    if end < start:
+        raise ValueError(f"End channel {end} is before start channel {start}.")
+
+    pv, offsets = extract_pv(state.data, x1, y1, x2, y2, width=width, start=start, end=end,
+                             mask=state.mask, invert_mask=req_data.get('invertMask', False))
+    start, end = max(0, start), min(end, n_channels - 1)
+    spectral, spectral_unit = get_spectral_axis(state.wcs, start, end + 1)
+
+    scale = offset_scale(state.wcs, x1, y1, x2, y2)
+    if scale is not None:
+        offsets, offset_unit = offsets * scale, 'arcsec'
+    else:
+        offset_unit = 'pixels'
+    return {'data': pv, 'offsets': offsets, 'offset_unit': offset_unit,
+            'spectral': spectral, 'spectral_unit': spectral_unit,
+            'path': [x1, y1, x2, y2, width, start, end, bool(req_data.get('invertMask', False))]}
@@ -0,0 +1,300 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import numpy as np
+
+from .fits_handler import apply_mask
+
+# Levels are kept on disk, one float32 file per level, removed when the pyramid is dropped
+PYRAMID_DIR = os.path.join(tempfile.gettempdir(), 'cubefig_pyramid')
+
+# Levels halve the image until its larger side would drop below this many pixels
+PYRAMID_MIN_SIZE = 512
+
+# Pyramids (cube, mask and invert flag) kept at once
+PYRAMID_ENTRIES = 4
+
+# Full-resolution channels read at once while levels are filled (float32 bytes)
+PYRAMID_CHUNK_BYTES = 64 * 1024 * 1024
+
+def pyramid_factors(shape):
+    """Downsampling factors (2, 4, 8, ...) worth building for an image of shape (h, w)."""
+    factors = []
+    f = 2
+    while max(shape) / f >= PYRAMID_MIN_SIZE:
+        factors.append(f)
+        f *= 2
+    return factors
+
+def choose_factor(factors, region_shape, view_shape):
+    """
+    Coarsest factor that still gives at least one image pixel per screen pixel when
+    a region of region_shape (h, w) is shown in view_shape (h, w), scaled to fit.
+    """
+    if not view_shape or min(view_shape) <= 0:
+        return 1
+    # Screen pixels per image pixel when the region is fitted into the view
+    limit = min(region_shape[0] / view_shape[0], region_shape[1] / view_shape[1])
+    return max([1] + [f for f in factors if f <= limit])
+
+def block_sums(planes, factor):
+    """
+    (sums, counts) of the finite values in factor x factor blocks of (..., h, w) planes;
+    edge blocks cover what is left. Means of any coarser level follow exactly by
+    summing both again.
+    """
+    h, w = planes.shape[-2:]
+    ph, pw = -(-h // factor) * factor, -(-w // factor) * factor
+    lead = planes.shape[:-2]
+    finite = np.isfinite(planes)
+    values = np.zeros(lead + (ph, pw), dtype=np.float64)
+    counts = np.zeros(lead + (ph, pw), dtype=np.int32)
+    values[..., :h, :w] = np.where(finite, planes, 0)
+    counts[..., :h, :w] = finite
+    shape = lead + (ph // factor, factor, pw // factor, factor)
+    axes = (len(lead) + 1, len(lead) + 3)
+    return values.reshape(shape).sum(axis=axes), counts.reshape(shape).sum(axis=axes)
+
+def block_average(planes, factor):
+    """NaN-aware mean over factor x factor blocks; blocks without finite values are NaN."""
+    sums, counts = block_sums(planes, factor)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan).astype(np.float32)
+
+class CubePyramid:
+    """
+    Block-averaged (NaN-aware) copies of a cube at every factor of pyramid_factors,
+    with the mask applied before averaging. A channel is filled at all levels the
+    first time any level of it is needed, from one read of the full-resolution plane;
+    precompute() fills the rest in the background.
+    """
+
+    def __init__(self, data, mask=None, invert_mask=False, directory=None):
+        self.data = data
+        self.mask = mask
+        self.invert_mask = invert_mask
+        self.factors = pyramid_factors(data.shape[1:])
+        self.directory = os.path.join(directory or PYRAMID_DIR, uuid.uuid4().hex)
+        self.filled = np.zeros(data.shape[0], dtype=bool)
+        self.levels = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        if self.factors:
+            os.makedirs(self.directory, exist_ok=True)
+        n, h, w = data.shape
+        for f in self.factors:
+            self.levels[f] = np.lib.format.open_memmap(
+                os.path.join(self.directory, f'level{f}.npy'), mode='w+', dtype=np.float32,
+                shape=(n, -(-h // f), -(-w // f)))
+
+    def level(self, channel, factor):
+        """One channel at a downsampling factor (1 is the masked full-resolution plane)."""
+        if factor == 1:
+            plane = self.data[channel]
+            return apply_mask(plane, self.mask[channel], self.invert_mask) if self.mask is not None else plane
+        self.fill(channel, channel + 1)
+        levels = self._filled_level(factor)
+        if levels is None:
+            return block_average(self._planes(slice(channel, channel + 1)), factor)[0]
+        return levels[channel]
+
+    def level_cube(self, factor, start, end):
+        """The whole level array with channels start..end (inclusive) filled."""
+        self.fill(start, end + 1)
+        levels = self._filled_level(factor)
+        if levels is None:
+            n, h, w = self.data.shape
+            # Zeroed pages are only committed where the range is written
+            levels = np.zeros((n, -(-h // factor), -(-w // factor)), dtype=np.float32)
+            levels[start:end + 1] = block_average(self._planes(slice(start, end + 1)), factor)
+        return levels
+
+    def _filled_level(self, factor):
+        # The level array, or None once the pyramid is closed (evicted, or its cube or
+        # mask released) and its levels may be incomplete. A reference taken here stays
+        # readable after close() unlinks the files.
+        with self._lock:
+            return None if self._closed else self.levels[factor]
+
+    def _planes(self, sel):
+        # Full-resolution channels as float32 with the mask applied
+        planes = np.asarray(self.data[sel], dtype=np.float32)
+        if self.mask is not None:
+            planes = apply_mask(planes, self.mask[sel], self.invert_mask)
+        return planes
+
+    def fill(self, start, end):
+        """Fills channels [start, end) at every level, a block of channels at a time."""
+        n, h, w = self.data.shape
+        start, end = max(0, start), min(n, end)
+        if not self.factors or self.filled[start:end].all():
+            return
+        per_chunk = max(1, PYRAMID_CHUNK_BYTES // max(1, h * w * 4))
+        with self._lock:
+            todo = np.flatnonzero(~self.filled[start:end]) + start
+            for i in range(0, len(todo), per_chunk):
+                if self._closed:
+                    return
+                channels = todo[i:i + per_chunk]
+                # Contiguous runs read as one slice; the rest channel by channel
+                if channels[-1] - channels[0] == len(channels) - 1:
+                    sel = slice(channels[0], channels[-1] + 1)
+                else:
+                    sel = channels
+                planes = self._planes(sel)
+                # Each level from the sums of the one below, so every level is the exact block mean
+                sums, counts = block_sums(planes, self.factors[0])
+                for f in self.factors:
+                    if f != self.factors[0]:
+                        sums, counts = _merge(sums, 2), _merge(counts, 2)
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        self.levels[f][channels] = np.where(counts > 0, sums / counts, np.nan)
+                self.filled[channels] = True
+
+    def precompute(self):
+        n = self.data.shape[0]
+        per_chunk = max(1, PYRAMID_CHUNK_BYTES // max(1, int(np.prod(self.data.shape[1:])) * 4))
+        for c0 in range(0, n, per_chunk):
+            if self._closed:
+                return
+            self.fill(c0, c0 + per_chunk)
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            self.levels = {}
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+def _merge(values, factor):
+    # Sums factor x factor blocks of an already summed level (edge blocks padded with zeros)
+    h, w = values.shape[-2:]
+    ph, pw = -(-h // factor) * factor, -(-w // factor) * factor
+    padded = np.zeros(values.shape[:-2] + (ph, pw), dtype=values.dtype)
+    padded[..., :h, :w] = values
+    lead = values.shape[:-2]
+    shape = lead + (ph // factor, factor, pw // factor, factor)
+    return padded.reshape(shape).sum(axis=(len(lead) + 1, len(lead) + 3))
+
+class PyramidRegistry:
+    """
+    Pyramids of recently viewed (cube, mask, invert) combinations, least recently
+    used dropped first. Keys carry identity tokens, so a reloaded cube never hits
+    an old pyramid.
+    """
+
+    def __init__(self, max_entries=PYRAMID_ENTRIES):
+        self.max_entries = max_entries
+        self._pyramids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, state, invert_mask=False):
+        """Pyramid of a session's cube and mask; None when the cube is too small to need one."""
+        if state.data is None or not pyramid_factors(state.data.shape[1:]):
+            return None
+        has_mask = state.mask is not None
+        key = (state.data_token, state.mask_token if has_mask else None, bool(invert_mask) if has_mask else False)
+        dropped = []
+        with self._lock:
+            pyramid = self._pyramids.get(key)
+            if pyramid is None:
+                pyramid = CubePyramid(state.data, state.mask if has_mask else None, bool(invert_mask))
+                self._pyramids[key] = pyramid
+                while len(self._pyramids) > self.max_entries:
+                    dropped.append(self._pyramids.popitem(last=False)[1])
+            self._pyramids.move_to_end(key)
+        for old in dropped:
+            old.close()
+        return pyramid
+
+    def discard(self, dataset):
+        """Closes the pyramids of a released Dataset (as cube or as mask) and removes their files."""
+        with self._lock:
+            keys = [key for key in self._pyramids if dataset.token in key[:2]]
+            dropped = [self._pyramids.pop(key) for key in keys]
+        for old in dropped:
+            old.close()
+
+    def precompute(self, state, invert_mask=False):
+        """Fills every level of a session's pyramid in a background thread."""
+        pyramid = self.get(state, invert_mask)
+        if pyramid is None:
+            return
+
+        def run():
+            try:
+                t = time.perf_counter()
+                pyramid.precompute()
+                print(f"INFO: Overview pyramid (factors {pyramid.factors}) built in {time.perf_counter() - t:.2f} s")
+            except Exception as e:
+                print(f"Warning: Building the overview pyramid failed: {e}")
+        threading.Thread(target=run, daemon=True).start()
+
+def view_slice(state, channel, invert_mask, factor=1, region=None):
+    """
+    Pixels of a channel for an interactive view: the (masked) plane at a pyramid
+    factor, cropped to region (x0, y0, x1, y1 in full-resolution pixels, exclusive
+    ends) when zoomed in. Only the cropped rows are read at full resolution.
+    Returns the plane and the full-resolution pixel (x, y) of its first pixel's corner.
+    """
+    h, w = state.data.shape[1:]
+    x0, y0, x1, y1 = region if region is not None else (0, 0, w, h)
+    if factor > 1:
+        plane = pyramids.get(state, invert_mask).level(channel, factor)
+        # Whole blocks covering the region
+        bx0, by0 = x0 // factor, y0 // factor
+        plane = plane[by0:-(-y1 // factor), bx0:-(-x1 // factor)]
+        return np.asarray(plane), (bx0 * factor, by0 * factor)
+
+    plane = state.data[channel, y0:y1, x0:x1]
+    if state.mask is not None:
+        plane = apply_mask(plane, state.mask[channel, y0:y1, x0:x1], invert_mask)
+    return plane, (x0, y0)
+
+_level_wcs = OrderedDict()
+
+def level_wcs(wcs, factor):
+    """
+    WCS of a cube's overview level: the same sky, factor x factor cube pixels per
+    level pixel. Only the two celestial (first) axes change.
+    """
+    if factor == 1:
+        return wcs
+    key = (id(wcs), factor)
+    scaled = _level_wcs.get(key)
+    if scaled is None or scaled[0] is not wcs:
+        copy = wcs.deepcopy()
+        # Level pixel centres sit at the centres of their blocks
+        copy.wcs.crpix[:2] = (copy.wcs.crpix[:2] - 0.5) / factor + 0.5
+        if copy.wcs.has_cd():
+            copy.wcs.cd[:2, :2] *= factor
+        else:
+            copy.wcs.cdelt[:2] *= factor
+        scaled = (wcs, copy)
+        _level_wcs[key] = scaled
+        while len(_level_wcs) > PYRAMID_ENTRIES * 4:
+            _level_wcs.popitem(last=False)
+    return scaled[1]
+
+def level_pixel(value, factor):
+    """Cube pixel coordinate as a coordinate on an overview level (empty values stay as they are)."""
+    if factor == 1 or value in (None, ''):
+        return value
+    return (float(value) + 0.5) / factor - 0.5
+
+def parse_region(value, shape):
+    """Zoom window 'x0,y0,x1,y1' (full-resolution pixels, ends exclusive) clipped to shape (h, w); None for the whole image."""
+    if value in (None, ''):
+        return None
+    x0, y0, x1, y1 = (int(round(float(v))) for v in str(value).split(','))
+    x0, x1 = sorted((max(0, x0), min(shape[1], x1)))
+    y0, y1 = sorted((max(0, y0), min(shape[0], y1)))
+    if x1 - x0 < 1 or y1 - y0 < 1 or (x0, y0, x1, y1) == (0, 0, shape[1], shape[0]):
+        return None
+    return x0, y0, x1, y1
+
+# Shared instance used by the routes
+pyramids = PyramidRegistry()
@@ -0,0 +1,118 @@
+import hashlib
+import itertools
+import json
+import threading
+import uuid
+from collections import OrderedDict
+
+# Identity tokens for loaded cubes, masks and moment maps.
+# Every load or computation takes a fresh token, so render keys never outlive their pixels.
+_tokens = itertools.count(1)
+
+def new_token():
+    return next(_tokens)
+
+# Render keys double as HTTP ETags. Tokens start over when the server restarts,
+# so keys also carry an id of this server instance.
+_INSTANCE = uuid.uuid4().hex
+
+# Request fields that change the rendered image
+RENDER_PARAM_KEYS = (
+    'title', 'grid', 'showBeam', 'showCenter', 'centerX', 'centerY',
+    'showPhysical', 'distanceVal', 'distanceUnit', 'normGlobal', 'clipPercent', 'vmin', 'vmax',
+    'cbarUnit', 'showOffset', 'offsetAngleUnit', 'figWidth', 'figHeight',
+    'pyramidLevel', 'viewRegion',
+)
+
+def render_key(kind, target, state, req_data, invert_mask=False, fmt='png', mode='publication'):
+    """
+    Hash identifying one rendered image: cube identity, channel or moment,
+    mask and invert state, the visual parameters, the renderer and the output format.
+    """
+    has_mask = state.mask is not None
+    parts = {
+        'instance': _INSTANCE,
+        'kind': kind,
+        'target': target,
+        'data': state.data_token,
+        'mask': state.mask_token if has_mask else None,
+        'invert': bool(invert_mask) if has_mask else False,
+        'params': {k: req_data.get(k) for k in RENDER_PARAM_KEYS},
+        'fmt': fmt,
+        'mode': mode,
+    }
+    if kind == 'moment':
+        parts['moment'] = state.moment_data[target]['token']
+    elif kind == 'pv':
+        parts['pv'] = state.pv_data['token']
+    blob = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+def render_tags(kind, target, state):
+    """Tokens an entry depends on; invalidating any of them drops the entry."""
+    tags = [state.data_token]
+    if state.mask is not None:
+        tags.append(state.mask_token)
+    if kind == 'moment':
+        tags.append(state.moment_data[target]['token'])
+    elif kind == 'pv':
+        tags.append(state.pv_data['token'])
+    return tuple(tags)
+
+class RenderCache:
+    """
+    Thread-safe LRU cache of encoded images, bounded by entry count and total bytes.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_entries=512):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (image bytes, tags)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def configure(self, max_bytes=None, max_entries=None):
+        with self._lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if max_entries is not None:
+                self.max_entries = max_entries
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, image, tags=()):
+        if len(image) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = (image, tuple(tags))
+            self._bytes += len(image)
+            self._evict()
+
+    def invalidate(self, tag=None):
+        """Drops every entry depending on tag, or everything if tag is None."""
+        with self._lock:
+            if tag is None:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            stale = [k for k, (_, tags) in self._entries.items() if tag in tags]
+            for k in stale:
+                self._bytes -= len(self._entries.pop(k)[0])
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (image, _) = self._entries.popitem(last=False)
+            self._bytes -= len(image)
+
+# Shared instance used by the routes
+render_cache = RenderCache()
@@ -0,0 +1,201 @@
+import atexit
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from .fits_handler import apply_mask, datasets
+from .plotter import create_plot, usetex_available
+
+# Moment maps kept in shared memory for the workers, most recently used last
+SHARED_MOMENT_LIMIT = 32
+
+# Cubes and masks a worker keeps open (mapped) between jobs
+WORKER_DATASET_LIMIT = 4
+
+class RenderPool:
+    """
+    Matplotlib rendering in a pool of worker processes.
+
+    Workers never receive pixel data through pickling: cube channels and masks are
+    read from the FITS files through the workers' own memory maps (the page cache is
+    shared with the server), and moment maps are handed over in shared memory blocks.
+    Jobs only carry the server's dataset keys, block names and the create_plot keyword
+    arguments. A worker renders only from the same file version the server has open.
+    """
+
+    def __init__(self):
+        self.processes = 0 # 0 renders in the server process, one figure at a time
+        self._executor = None
+        self._lock = threading.Lock()
+        self._shared = OrderedDict() # moment token -> SharedMemory
+
+    @property
+    def enabled(self):
+        return self.processes > 0
+
+    def configure(self, processes):
+        with self._lock:
+            self._shutdown_locked()
+            self.processes = max(0, int(processes))
+
+    def start(self):
+        """
+        Starts the workers. Call before the server starts its threads: workers are
+        forked, so they inherit the server's configuration (fonts, LaTeX cache, ...).
+        """
+        with self._lock:
+            self._start_locked()
+
+    def _start_locked(self):
+        if self._executor is not None or not self.enabled:
+            return
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            print("Warning: Render processes need the 'fork' start method; rendering in-process")
+            self.processes = 0
+            return
+        # Resolved once here and inherited, instead of per worker
+        usetex_available()
+        # Workers must share the server's tracker, or theirs would unlink the server's blocks on exit
+        resource_tracker.ensure_running()
+        self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                             mp_context=multiprocessing.get_context('fork'))
+        # With fork, the first job launches every worker at once
+        self._executor.submit(_noop).result()
+        print(f"INFO: Rendering figures in {self.processes} worker processes")
+
+    def render_channel(self, state, channel, invert_mask, plot_kwargs):
+        """
+        Renders cube channel `channel` (masked as in the server) with create_plot(**plot_kwargs)
+        in a worker. Returns the image bytes, or None if it has to be rendered in-process.
+        """
+        mask_key = state.mask_dataset.key if state.mask_dataset is not None else None
+        job = {'cube': state.dataset.key, 'channel': channel,
+               'mask': mask_key, 'invert': invert_mask}
+        return self._run(job, plot_kwargs)
+
+    def render_moment(self, state, mom, plot_kwargs):
+        """Same as render_channel for a stored moment map, passed in shared memory."""
+        info = state.moment_data[mom]
+        try:
+            block = self._share(info['token'], info['data'])
+        except Exception as e:
+            print(f"Warning: Could not share moment map with render workers: {e}")
+            return None
+        job = {'cube': state.dataset.key,
+               'moment': (block.name, info['data'].shape, info['data'].dtype.str)}
+        return self._run(job, plot_kwargs)
+
+    def _run(self, job, plot_kwargs):
+        with self._lock:
+            self._start_locked()
+            executor = self._executor
+        if executor is None:
+            return None
+        try:
+            return executor.submit(_render_job, job, plot_kwargs).result()
+        except BrokenProcessPool:
+            print("Warning: A render worker died; restarting the pool and rendering in-process")
+            with self._lock:
+                if self._executor is executor:
+                    self._shutdown_locked()
+            return None
+        except OSError as e:
+            # File replaced or removed, shared block gone, ...: the server still has the data
+            print(f"Warning: Render worker could not read its input ({e}); rendering in-process")
+            return None
+
+    def _share(self, token, data):
+        with self._lock:
+            block = self._shared.get(token)
+            if block is not None:
+                self._shared.move_to_end(token)
+                return block
+            block = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+            np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)[...] = data
+            self._shared[token] = block
+            while len(self._shared) > SHARED_MOMENT_LIMIT:
+                _, old = self._shared.popitem(last=False)
+                _free_block(old)
+            return block
+
+    def _shutdown_locked(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def shutdown(self):
+        with self._lock:
+            self._shutdown_locked()
+            while self._shared:
+                _free_block(self._shared.popitem()[1])
+
+def _free_block(block):
+    # Workers attached at the moment keep their mapping until they close it
+    block.close()
+    try:
+        block.unlink()
+    except FileNotFoundError:
+        pass
+
+class DatasetChanged(OSError):
+    """The file behind a job's dataset key was replaced or modified since the server opened it."""
+
+# --- WORKER SIDE ---
+
+_worker_datasets = OrderedDict() # dataset key -> Dataset
+
+def _noop():
+    return None
+
+def _worker_dataset(server_key):
+    """
+    The worker's Dataset of the file version the server opened as server_key
+    (path, size, mtime_ns, memmap). Raises DatasetChanged if the file on disk differs.
+    """
+    # Always mapped in workers, whatever the server uses: pages are shared, not copied
+    key = tuple(server_key[:3]) + (True,)
+    if key in _worker_datasets:
+        _worker_datasets.move_to_end(key)
+        return _worker_datasets[key]
+    path = server_key[0]
+    dataset = datasets.open(path, memmap=True)
+    if dataset.key != key:
+        datasets.release(dataset)
+        raise DatasetChanged(f"{path} changed since the server opened it")
+    _worker_datasets[dataset.key] = dataset
+    while len(_worker_datasets) > WORKER_DATASET_LIMIT:
+        datasets.release(_worker_datasets.popitem(last=False)[1])
+    return dataset
+
+def _render_job(job, plot_kwargs):
+    cube = _worker_dataset(job['cube'])
+
+    if 'moment' in job:
+        name, shape, dtype = job['moment']
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            # The figure keeps a reference to its data, so it gets a private copy
+            image = np.array(np.ndarray(shape, dtype=dtype, buffer=block.buf))
+        finally:
+            block.close()
+    else:
+        channel = job['channel']
+        image = cube.data[channel, :, :]
+        if job['mask'] is not None:
+            mask = _worker_dataset(job['mask']).data
+            plane = mask[channel, :, :] if mask.ndim == 3 else mask
+            image = apply_mask(image, plane, job['invert'])
+
+    buf = create_plot(image, cube.wcs, return_base64=False, **plot_kwargs)
+    return buf.getvalue()
+
+# Shared instance used by the routes
+render_pool = RenderPool()
+
+# Shared moment blocks outlive the process otherwise
+atexit.register(render_pool.shutdown)
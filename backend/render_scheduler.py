@@ -0,0 +1,74 @@
+import itertools
+import threading
+
+class Superseded(Exception):
+    """Raised inside a render whose result nobody is waiting for any more."""
+
+class RenderScheduler:
+    """
+    Latest-wins scheduling of interactive renders.
+
+    Every client view (e.g. one browser tab's cube view) owns a slot that renders
+    one request at a time. A new request for a slot supersedes the ones still
+    waiting for it, and a render in progress can poll check() to give up early
+    once a newer request has arrived.
+    """
+
+    # Slots remembered at most; idle ones are forgotten first
+    MAX_SLOTS = 1024
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._tickets = itertools.count(1)
+        self._latest = {} # slot -> newest ticket
+        self._busy = set() # slots with a render in progress
+
+    def submit(self, slot):
+        """Registers a request for slot and returns its ticket."""
+        with self._cond:
+            ticket = next(self._tickets)
+            self._latest.pop(slot, None)
+            self._latest[slot] = ticket
+            if len(self._latest) > self.MAX_SLOTS:
+                self._forget_idle()
+            # Requests queued for this slot are stale now
+            self._cond.notify_all()
+            return ticket
+
+    def is_current(self, slot, ticket):
+        return self._latest.get(slot) == ticket
+
+    def check(self, slot, ticket):
+        """Raises Superseded if a newer request for slot has arrived."""
+        if not self.is_current(slot, ticket):
+            raise Superseded()
+
+    def acquire(self, slot, ticket):
+        """
+        Waits until slot is free. Returns False, without taking the slot,
+        as soon as the request is superseded.
+        """
+        with self._cond:
+            while slot in self._busy:
+                if not self.is_current(slot, ticket):
+                    return False
+                self._cond.wait()
+            if not self.is_current(slot, ticket):
+                return False
+            self._busy.add(slot)
+            return True
+
+    def release(self, slot):
+        with self._cond:
+            self._busy.discard(slot)
+            self._cond.notify_all()
+
+    def _forget_idle(self):
+        for slot in list(self._latest):
+            if len(self._latest) <= self.MAX_SLOTS // 2:
+                break
+            if slot not in self._busy:
+                del self._latest[slot]
+
+# Shared instance used by the routes
+render_scheduler = RenderScheduler()
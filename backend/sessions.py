@@ -0,0 +1,148 @@
+import secrets
+import threading
+from collections import OrderedDict
+
+from .fits_handler import FitsState, datasets
+
+class SessionRegistry:
+    """
+    Per-browser-session FitsState objects, least recently used first.
+
+    Cubes and masks opened by several sessions are shared through the dataset pool;
+    what a session owns on its own (moment maps, moment index) counts against a
+    global memory ceiling. Above it, or above MAX_SESSIONS, idle sessions are evicted
+    oldest first. Sessions with a request in flight, and the most recently used one,
+    are never evicted.
+    """
+
+    MAX_SESSIONS = 64
+
+    def __init__(self, memory_limit_bytes=None):
+        self.memory_limit_bytes = memory_limit_bytes
+        self._sessions = OrderedDict() # id -> FitsState
+        self._active = {} # id -> requests in flight
+        self._lock = threading.Lock()
+        self._evict_listeners = []
+
+        # Applied to every new session
+        self.use_memmap = True
+        self.use_moment_index = False
+        self.initial_file = None
+        self.initial_mask = None
+
+    def configure(self, memory_limit_mb=None, max_sessions=None, use_memmap=None,
+                  use_moment_index=None, initial_file=None, initial_mask=None):
+        if memory_limit_mb is not None:
+            self.memory_limit_bytes = int(memory_limit_mb * 1024 * 1024) if memory_limit_mb > 0 else None
+        if max_sessions is not None:
+            self.MAX_SESSIONS = max(1, int(max_sessions))
+        if use_memmap is not None:
+            self.use_memmap = use_memmap
+        if use_moment_index is not None:
+            self.use_moment_index = use_moment_index
+        if initial_file is not None:
+            self.initial_file = initial_file
+        if initial_mask is not None:
+            self.initial_mask = initial_mask
+
+    def on_evict(self, fn):
+        """Registers fn(state), called after a session is evicted."""
+        self._evict_listeners.append(fn)
+
+    @staticmethod
+    def new_id():
+        return secrets.token_urlsafe(18)
+
+    def new_state(self):
+        """A fresh FitsState with the startup file and mask (if any) already loaded."""
+        state = FitsState()
+        state.use_memmap = self.use_memmap
+        state.use_moment_index = self.use_moment_index
+        if self.initial_file:
+            result = state.load_fits_from_path(self.initial_file)
+            if "error" in result:
+                print(f"Warning: Could not load {self.initial_file} for new session: {result['error']}")
+            elif self.initial_mask:
+                result = state.load_mask_from_path(self.initial_mask)
+                if "error" in result:
+                    print(f"Warning: Could not load mask {self.initial_mask} for new session: {result['error']}")
+        return state
+
+    def acquire(self, session_id):
+        """
+        Returns the session's state, creating it if needed, and marks a request in flight.
+        Every acquire must be paired with a release.
+        """
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is not None:
+                self._sessions.move_to_end(session_id)
+                self._active[session_id] = self._active.get(session_id, 0) + 1
+                return state
+
+        # Loading happens outside the lock; opening a shared dataset is cheap anyway
+        state = self.new_state()
+        with self._lock:
+            existing = self._sessions.get(session_id)
+            if existing is not None:
+                # Another request for the same new session got there first
+                discard, state = state, existing
+            else:
+                discard = None
+                self._sessions[session_id] = state
+            self._sessions.move_to_end(session_id)
+            self._active[session_id] = self._active.get(session_id, 0) + 1
+        if discard is not None:
+            discard.close()
+        else:
+            print(f"INFO: New session ({len(self._sessions)} open)")
+        return state
+
+    def release(self, session_id):
+        """Ends a request of the session, then enforces the limits."""
+        with self._lock:
+            count = self._active.get(session_id, 0) - 1
+            if count > 0:
+                self._active[session_id] = count
+            else:
+                self._active.pop(session_id, None)
+        self.enforce_limits()
+
+    def memory_bytes(self):
+        """Session-owned memory plus in-RAM (non-mapped) datasets, each counted once."""
+        with self._lock:
+            states = list(self._sessions.values())
+        return sum(s.memory_bytes() for s in states) + datasets.resident_bytes()
+
+    def enforce_limits(self):
+        while True:
+            with self._lock:
+                over_count = len(self._sessions) > self.MAX_SESSIONS
+                if not over_count and self.memory_limit_bytes is None:
+                    return
+            if not over_count and self.memory_bytes() <= self.memory_limit_bytes:
+                return
+            if not self._evict_oldest_idle():
+                return
+
+    def _evict_oldest_idle(self):
+        with self._lock:
+            # The newest session stays even if it alone is over the ceiling
+            candidates = list(self._sessions)[:-1]
+            for session_id in candidates:
+                if session_id not in self._active:
+                    state = self._sessions.pop(session_id)
+                    break
+            else:
+                return False
+        print(f"INFO: Evicting idle session ({len(self._sessions)} left)")
+        state.close()
+        for fn in self._evict_listeners:
+            fn(state)
+        return True
+
+    def __len__(self):
+        return len(self._sessions)
+
+# Shared instance used by the routes
+sessions = SessionRegistry()
@@ -0,0 +1,291 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import warnings
+import numpy as np
+
+from .fits_handler import apply_mask
+from .moments.footprint import footprints
+
+# Spectral-major copies of cubes, '<path hash>-<content fingerprint>.yxv.npy'
+SPECTRAL_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'cubefig_spectral')
+SPECTRAL_CACHE_SUFFIX = '.yxv.npy'
+
+# Disk space for the copies; least recently used ones are deleted above it (0 means no limit)
+SPECTRAL_CACHE_MAX_BYTES = 0
+
+# Rows of the cube transposed at once while a spectral-major copy is built (float32 bytes)
+SPECTRAL_BUILD_BYTES = 256 * 1024 * 1024
+
+# Upper bound on the pixels of an aperture's bounding box
+APERTURE_MAX_PIXELS = 4 * 1024 * 1024
+
+APERTURES = ('pixel', 'box', 'circle', 'mask')
+
+class SpectralCube:
+    """
+    (y, x, v) float32 copy of a cube on disk, so the spectrum of a pixel is one
+    contiguous read. Built a band of rows at a time; rows below rows_ready can be
+    read while the rest is still being written. Keyed by the cube's content
+    fingerprint, so a finished copy is reused after a restart.
+    """
+
+    def __init__(self, path, shape, persist=True):
+        self.path = path
+        self.shape = tuple(shape) # (channels, y, x) of the cube
+        self.persist = persist
+        self.rows_ready = 0
+        self.array = None
+        self._stop = threading.Event()
+
+    @property
+    def ready(self):
+        return self.rows_ready >= self.shape[1]
+
+    def open_existing(self):
+        """Maps a finished copy from an earlier run; False if there is none that fits."""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            array = np.load(self.path, mmap_mode='r')
+        except Exception as e:
+            print(f"Warning: Ignoring unreadable spectral cache {self.path}: {e}")
+            return False
+        n_channels, height, width = self.shape
+        if array.shape != (height, width, n_channels) or array.dtype != np.float32:
+            return False
+        self.array = array
+        self.rows_ready = height
+        try:
+            # Marks the copy as recently used for eviction
+            os.utime(self.path)
+        except OSError:
+            pass
+        return True
+
+    def build(self, data, budget=None):
+        """Transposes data (channels, y, x) into the copy, a band of rows at a time."""
+        n_channels, height, width = self.shape
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path[:-len('.npy')]}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+        rows = max(1, (budget or SPECTRAL_BUILD_BYTES) // max(1, n_channels * width * 4))
+        try:
+            array = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(height, width, n_channels))
+            self.array = array
+            for y0 in range(0, height, rows):
+                if self._stop.is_set():
+                    raise InterruptedError
+                y1 = min(height, y0 + rows)
+                # One strided read of the band across all channels, written back contiguously per pixel
+                array[y0:y1] = np.asarray(data[:, y0:y1, :], dtype=np.float32).transpose(1, 2, 0)
+                self.rows_ready = y1
+            array.flush()
+            # Later runs only ever find complete copies
+            os.replace(tmp, self.path)
+        except BaseException:
+            self.array = None
+            self.rows_ready = 0
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def region(self, y0, y1, x0, x1):
+        """(y, x, v) values of a box, or None while its rows are not built yet."""
+        if self.array is None or y1 > self.rows_ready:
+            return None
+        return self.array[y0:y1, x0:x1, :]
+
+    def close(self):
+        self._stop.set()
+        self.array = None
+        with _build_lock:
+            # Once unmapped the copy may be evicted
+            _open_paths.discard(self.path)
+        if not self.persist and os.path.exists(self.path):
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                print(f"Warning: Could not remove spectral cache {self.path}: {e}")
+
+_build_lock = threading.Lock()
+_open_paths = set() # Copies mapped by open datasets, never evicted
+
+def _path_prefix(path):
+    return hashlib.sha256(os.path.realpath(path).encode()).hexdigest()[:16] + '-'
+
+def _remove_copy(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError as e:
+        print(f"Warning: Could not remove spectral cache {path}: {e}")
+        return False
+
+def _drop_orphans(prefix, keep):
+    """Removes copies of the same file under an older fingerprint (touched, replaced or rewritten)."""
+    try:
+        names = os.listdir(SPECTRAL_CACHE_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(SPECTRAL_CACHE_DIR, name)
+        if name.startswith(prefix) and name.endswith(SPECTRAL_CACHE_SUFFIX) and path != keep and path not in _open_paths:
+            if _remove_copy(path):
+                print(f"DEBUG: Removed outdated spectral cache {name}")
+
+def _evict(reserve=0):
+    """
+    Deletes the least recently used copies until `reserve` more bytes fit the limit.
+    Copies in use count towards it but are never deleted.
+    """
+    if SPECTRAL_CACHE_MAX_BYTES <= 0:
+        return
+    try:
+        entries = []
+        for name in os.listdir(SPECTRAL_CACHE_DIR):
+            if name.endswith(SPECTRAL_CACHE_SUFFIX):
+                st = os.stat(os.path.join(SPECTRAL_CACHE_DIR, name))
+                entries.append((st.st_mtime, st.st_size, os.path.join(SPECTRAL_CACHE_DIR, name)))
+    except OSError:
+        return
+    total = sum(size for _, size, _ in entries) + reserve
+    for _, size, path in sorted(entries):
+        if total <= SPECTRAL_CACHE_MAX_BYTES:
+            break
+        if path not in _open_paths and _remove_copy(path):
+            total -= size
+
+def start_spectral_cache(dataset):
+    """
+    Gives a dataset its spectral-major copy: maps an existing one, or builds it in a
+    background thread. Only the first call per dataset does anything.
+    """
+    with _build_lock:
+        if dataset.spectral is not None:
+            return dataset.spectral
+        persist = dataset.spool_path is None
+        prefix = _path_prefix(dataset.key[0])
+        path = os.path.join(SPECTRAL_CACHE_DIR, prefix + dataset.fingerprint + SPECTRAL_CACHE_SUFFIX)
+        spectral = SpectralCube(path, dataset.data.shape, persist=persist)
+        dataset.spectral = spectral
+        _drop_orphans(prefix, path)
+        _open_paths.add(path)
+        if spectral.open_existing():
+            print(f"DEBUG: Spectral cache of {os.path.basename(dataset.key[0])} read from {path}")
+            _evict()
+            return spectral
+        n_channels, height, width = spectral.shape
+        _evict(reserve=n_channels * height * width * 4)
+
+    def run():
+        name = os.path.basename(dataset.key[0])
+        try:
+            t = time.perf_counter()
+            spectral.build(dataset.data)
+            print(f"INFO: Spectral cache of {name} built in {time.perf_counter() - t:.2f} s")
+        except InterruptedError:
+            print(f"DEBUG: Spectral cache of {name} abandoned (cube closed)")
+        except Exception as e:
+            print(f"Warning: Building the spectral cache of {name} failed: {e}")
+        with _build_lock:
+            _evict()
+    threading.Thread(target=run, daemon=True).start()
+    return spectral
+
+def aperture_region(req_data, shape, footprint=None):
+    """
+    Bounding box (y0, y1, x0, x1) of the aperture a request describes and its pixel
+    selection inside the box (bool array, or None for every pixel):
+    'pixel' (x, y), 'box' (x1, y1, x2, y2, inclusive), 'circle' (x, y, radius) or
+    'mask' (footprint: bool plane of pixels the mask keeps in any channel).
+    """
+    height, width = shape
+    aperture = req_data.get('aperture') or 'pixel'
+    if aperture not in APERTURES:
+        raise ValueError(f"Unknown aperture '{aperture}' (use {', '.join(APERTURES)}).")
+
+    def number(name):
+        value = req_data.get(name)
+        if value in (None, ''):
+            raise ValueError(f"Aperture '{aperture}' needs '{name}'.")
+        return float(value)
+
+    selection = None
+    if aperture == 'pixel':
+        x, y = int(round(number('x'))), int(round(number('y')))
+        y0, y1, x0, x1 = y, y + 1, x, x + 1
+    elif aperture == 'box':
+        xa, xb = sorted((int(round(number('x1'))), int(round(number('x2')))))
+        ya, yb = sorted((int(round(number('y1'))), int(round(number('y2')))))
+        y0, y1, x0, x1 = max(0, ya), min(height, yb + 1), max(0, xa), min(width, xb + 1)
+    elif aperture == 'circle':
+        cx, cy, radius = number('x'), number('y'), max(0.0, number('radius'))
+        y0, y1 = max(0, int(np.floor(cy - radius))), min(height, int(np.ceil(cy + radius)) + 1)
+        x0, x1 = max(0, int(np.floor(cx - radius))), min(width, int(np.ceil(cx + radius)) + 1)
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        selection = (xx - cx) ** 2 + (yy - cy) ** 2 <= radius ** 2
+        if selection.size and not selection.any():
+            # Radius below half a pixel: the pixel under the centre
+            selection[min(max(int(round(cy)), y0), y1 - 1) - y0, min(max(int(round(cx)), x0), x1 - 1) - x0] = True
+    else:
+        if footprint is None:
+            raise ValueError("Aperture 'mask' needs a loaded mask.")
+        rows, cols = np.flatnonzero(footprint.any(axis=1)), np.flatnonzero(footprint.any(axis=0))
+        if rows.size == 0:
+            raise ValueError("The mask keeps no pixels.")
+        y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        selection = footprint[y0:y1, x0:x1]
+
+    if not (0 <= y0 < y1 <= height and 0 <= x0 < x1 <= width):
+        raise ValueError("Aperture lies outside the image.")
+    if (y1 - y0) * (x1 - x0) > APERTURE_MAX_PIXELS:
+        raise ValueError(f"Aperture spans more than {APERTURE_MAX_PIXELS} pixels.")
+    return (int(y0), int(y1), int(x0), int(x1)), selection
+
+def mask_footprint(state, invert_mask=False):
+    """Pixels the session's mask keeps in at least one channel (cached per mask)."""
+    return footprints.get(state, invert_mask).plane
+
+def extract_spectrum(state, req_data):
+    """
+    Spectrum of an aperture: mean (or 'stat': 'sum') over its pixels per channel,
+    NaN-aware. The mask is applied for the 'mask' aperture, or any aperture with
+    'applyMask'. Reads the spectral-major copy when it covers the aperture, else
+    the bounding box of the cube itself.
+    Returns (values, n_pixels, source) with values a float64 array over all channels.
+    """
+    stat = req_data.get('stat') or 'mean'
+    if stat not in ('mean', 'sum'):
+        raise ValueError("Statistic must be 'mean' or 'sum'.")
+    invert_mask = req_data.get('invertMask', False)
+    aperture = req_data.get('aperture') or 'pixel'
+    use_mask = state.mask is not None and (aperture == 'mask' or req_data.get('applyMask', False))
+
+    footprint = mask_footprint(state, invert_mask) if aperture == 'mask' and state.mask is not None else None
+    (y0, y1, x0, x1), selection = aperture_region(req_data, state.data.shape[1:], footprint)
+
+    spectral = state.dataset.spectral if state.dataset is not None else None
+    block = spectral.region(y0, y1, x0, x1) if spectral is not None else None
+    if block is not None:
+        source = 'spectral_cache'
+    else:
+        # Channel-major: one strided read of the bounding box per channel
+        block = np.asarray(state.data[:, y0:y1, x0:x1], dtype=np.float32).transpose(1, 2, 0)
+        source = 'cube'
+
+    if use_mask:
+        mask_block = np.asarray(state.mask[:, y0:y1, x0:x1]).transpose(1, 2, 0)
+        block = apply_mask(block, mask_block, invert_mask)
+
+    pixels = block[selection] if selection is not None else block.reshape(-1, block.shape[-1])
+    pixels = np.asarray(pixels, dtype=np.float64)
+    with warnings.catch_warnings():
+        # Channels without any finite pixel give NaN on purpose
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if stat == 'sum':
+            values = np.where(np.isfinite(pixels).any(axis=0), np.nansum(pixels, axis=0), np.nan)
+        else:
+            values = np.nanmean(pixels, axis=0)
+    return values, len(pixels), source
@@ -0,0 +1,259 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+
+# Bumped whenever the stored layout changes; older files are recomputed
+STATS_VERSION = 1
+
+# Statistics are stored next to the cube ('<file>.stats.npz'), or in this directory
+# when it is set or the cube's directory is not writable
+STATS_CACHE_DIR = None
+STATS_FALLBACK_DIR = os.path.join(tempfile.gettempdir(), 'cubefig_stats')
+STATS_SIDECAR_SUFFIX = '.stats.npz'
+
+# Channels are read in blocks of about this many bytes (as float32)
+STATS_CHUNK_BYTES = 64 * 1024 * 1024
+
+HISTOGRAM_BINS = 4096
+
+# Pixels per channel used for its median and noise, and in total for the quantile sketch
+NOISE_SAMPLES = 256 * 1024
+QUANTILE_SAMPLES = 1024 * 1024
+
+# Percentiles stored in the quantile sketch, every 0.1 %
+QUANTILE_LEVELS = np.linspace(0.0, 100.0, 1001)
+
+# MAD of a normal distribution times this is its standard deviation
+MAD_TO_SIGMA = 1.4826
+
+class CubeStatistics:
+    """
+    Summary of a cube from one pass over its channels: global and per-channel extremes,
+    per-channel median and robust noise (MAD), a histogram of all finite values and an
+    approximate quantile table. Values without any finite pixel are NaN.
+    """
+
+    FIELDS = ('channel_min', 'channel_max', 'channel_median', 'channel_noise', 'channel_count',
+              'hist_counts', 'hist_range', 'quantiles')
+
+    def __init__(self, channel_min, channel_max, channel_median, channel_noise, channel_count,
+                 hist_counts, hist_range, quantiles):
+        self.channel_min = channel_min
+        self.channel_max = channel_max
+        self.channel_median = channel_median
+        self.channel_noise = channel_noise
+        self.channel_count = channel_count
+        self.hist_counts = hist_counts
+        self.hist_range = hist_range
+        self.quantiles = quantiles
+
+    @property
+    def min(self):
+        return _finite_or_none(np.fmin.reduce(self.channel_min))
+
+    @property
+    def max(self):
+        return _finite_or_none(np.fmax.reduce(self.channel_max))
+
+    @property
+    def count(self):
+        return int(self.channel_count.sum())
+
+    def histogram(self):
+        """(counts, bin edges) over all finite values."""
+        lo, hi = self.hist_range
+        return self.hist_counts, np.linspace(lo, hi, len(self.hist_counts) + 1)
+
+    def percentile(self, q):
+        """Approximate q-th percentile (0-100) of the finite values, or None if there are none."""
+        if not np.isfinite(self.quantiles).all():
+            return None
+        return float(np.interp(q, QUANTILE_LEVELS, self.quantiles))
+
+    def clip_range(self, percent):
+        """
+        Limits keeping the central `percent` % of the values (like a percentile interval:
+        99 cuts 0.5 % at each end). (None, None) for a cube without finite values.
+        """
+        percent = float(percent)
+        if not 0 < percent <= 100:
+            raise ValueError("Clip percentile must be between 0 and 100.")
+        cut = (100.0 - percent) / 2
+        return self.percentile(cut), self.percentile(100.0 - cut)
+
+    def summary(self):
+        """JSON-friendly overview (without the per-channel arrays)."""
+        return {
+            'min': self.min,
+            'max': self.max,
+            'count': self.count,
+            'percentiles': {p: self.percentile(p) for p in (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5)},
+            'noise_median': _finite_or_none(np.nanmedian(self.channel_noise)) if np.isfinite(self.channel_noise).any() else None,
+        }
+
+def compute_statistics(data, chunk_bytes=None):
+    """
+    Single streamed pass over a (channels, y, x) cube, a block of channels at a time,
+    so a memory-mapped cube is never fully resident.
+    """
+    n_channels = data.shape[0]
+    plane_size = int(np.prod(data.shape[1:]))
+    per_chunk = max(1, (chunk_bytes or STATS_CHUNK_BYTES) // max(1, plane_size * 4))
+    # Deterministic strided samples: the same cube always gives the same statistics
+    noise_step = max(1, plane_size // NOISE_SAMPLES)
+    sketch_step = max(1, (plane_size * n_channels) // QUANTILE_SAMPLES)
+
+    channel_min = np.full(n_channels, np.nan)
+    channel_max = np.full(n_channels, np.nan)
+    channel_median = np.full(n_channels, np.nan)
+    channel_noise = np.full(n_channels, np.nan)
+    channel_count = np.zeros(n_channels, dtype=np.int64)
+    histogram = _AdaptiveHistogram(HISTOGRAM_BINS)
+    sketch = []
+
+    for c0 in range(0, n_channels, per_chunk):
+        block = np.asarray(data[c0:c0 + per_chunk], dtype=np.float32).reshape(-1, plane_size)
+        finite = np.isfinite(block)
+        channel_count[c0:c0 + len(block)] = finite.sum(axis=1)
+        # fmin/fmax skip NaN without a masked copy; infinities need one
+        lo, hi = np.fmin.reduce(block, axis=1), np.fmax.reduce(block, axis=1)
+        if np.isinf(lo).any() or np.isinf(hi).any():
+            block = np.where(finite, block, np.float32(np.nan))
+            lo, hi = np.fmin.reduce(block, axis=1), np.fmax.reduce(block, axis=1)
+        channel_min[c0:c0 + len(block)] = lo
+        channel_max[c0:c0 + len(block)] = hi
+
+        histogram.add(block[finite])
+
+        for i, plane in enumerate(block):
+            sample = plane[::noise_step]
+            sample = sample[np.isfinite(sample)]
+            if sample.size:
+                median = np.median(sample)
+                channel_median[c0 + i] = median
+                channel_noise[c0 + i] = MAD_TO_SIGMA * np.median(np.abs(sample - median))
+
+        flat = block.ravel()[(-c0 * plane_size) % sketch_step::sketch_step]
+        sketch.append(flat[np.isfinite(flat)])
+
+    sketch = np.concatenate(sketch) if sketch else np.empty(0, dtype=np.float32)
+    if sketch.size:
+        quantiles = np.percentile(sketch, QUANTILE_LEVELS)
+        # The ends of the table are exact
+        quantiles[0], quantiles[-1] = np.fmin.reduce(channel_min), np.fmax.reduce(channel_max)
+    else:
+        quantiles = np.full(len(QUANTILE_LEVELS), np.nan)
+
+    counts, hist_range = histogram.result()
+    return CubeStatistics(channel_min, channel_max, channel_median, channel_noise, channel_count,
+                          counts, hist_range, quantiles)
+
+def cube_statistics(key, data, persist=True):
+    """
+    Statistics of an opened cube, read from its cache file when one matches key
+    (path, size, mtime_ns, ...); otherwise computed and, if persist, stored.
+    """
+    path, size, mtime_ns = key[:3]
+    stamp = np.array([str(path), str(size), str(mtime_ns), str(STATS_VERSION)])
+
+    if persist:
+        stats = _load(path, stamp)
+        if stats is not None:
+            print(f"DEBUG: Statistics of {os.path.basename(path)} read from cache")
+            return stats
+
+    t = time.perf_counter()
+    stats = compute_statistics(data)
+    print(f"INFO: Statistics of {os.path.basename(path)} computed in {time.perf_counter() - t:.2f} s")
+    if persist:
+        _save(path, stamp, stats)
+    return stats
+
+class _AdaptiveHistogram:
+    """
+    Fixed number of equal-width bins over a range that doubles (merging neighbouring
+    bins in pairs) whenever values fall outside it. Counts stay exact; no first pass
+    for the data range is needed.
+    """
+
+    def __init__(self, bins):
+        self.bins = bins
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.lo = None
+        self.width = None
+
+    def add(self, values):
+        if values.size == 0:
+            return
+        vmin, vmax = float(values.min()), float(values.max())
+        if self.lo is None:
+            self.lo = vmin
+            self.width = max((vmax - vmin) / self.bins, np.finfo(np.float32).tiny * 2 ** 30, abs(vmin) * 1e-6)
+        while vmin < self.lo:
+            self._grow(left=True)
+        while vmax >= self.lo + self.width * self.bins:
+            self._grow(left=False)
+        idx = ((values.astype(np.float64) - self.lo) / self.width).astype(np.int64)
+        np.clip(idx, 0, self.bins - 1, out=idx)
+        self.counts += np.bincount(idx, minlength=self.bins)
+
+    def _grow(self, left):
+        merged = self.counts.reshape(-1, 2).sum(axis=1)
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        half = self.bins // 2
+        if left:
+            # Old range becomes the upper half
+            self.counts[half:] = merged
+            self.lo -= self.width * self.bins
+        else:
+            self.counts[:half] = merged
+        self.width *= 2
+
+    def result(self):
+        if self.lo is None:
+            return self.counts, np.array([np.nan, np.nan])
+        return self.counts, np.array([self.lo, self.lo + self.width * self.bins])
+
+# --- CACHE FILES ---
+
+def _cache_paths(path):
+    hashed = hashlib.sha256(str(path).encode()).hexdigest()[:24] + STATS_SIDECAR_SUFFIX
+    if STATS_CACHE_DIR:
+        return [os.path.join(STATS_CACHE_DIR, hashed)]
+    return [str(path) + STATS_SIDECAR_SUFFIX, os.path.join(STATS_FALLBACK_DIR, hashed)]
+
+def _load(path, stamp):
+    for cache_path in _cache_paths(path):
+        if not os.path.exists(cache_path):
+            continue
+        try:
+            with np.load(cache_path, allow_pickle=False) as f:
+                if f['stamp'].tolist() != stamp.tolist():
+                    continue # Cube changed since, or older layout
+                return CubeStatistics(*(f[name] for name in CubeStatistics.FIELDS))
+        except Exception as e:
+            print(f"Warning: Ignoring unreadable statistics cache {cache_path}: {e}")
+    return None
+
+def _save(path, stamp, stats):
+    arrays = {name: getattr(stats, name) for name in CubeStatistics.FIELDS}
+    for cache_path in _cache_paths(path):
+        tmp = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+            with open(tmp, 'wb') as f:
+                np.savez(f, stamp=stamp, **arrays)
+            # Readers only ever see a complete file
+            os.replace(tmp, cache_path)
+            return
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    print(f"Warning: Could not store statistics of {os.path.basename(str(path))}")
+
+def _finite_or_none(value):
+    value = float(value)
+    return value if np.isfinite(value) else None
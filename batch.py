@@ -0,0 +1,11 @@
+import os
+import sys
+
+# Batch runs put one cube on each core, so the moment kernel stays single-threaded
+# per process unless OMP_NUM_THREADS says otherwise. Must be set before it loads.
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+
+from backend.batch import main
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,20 +15,50 @@ export async function fetchMaskUpload(file) {
     return await response.json();
 }
 
-export async function fetchRenderMoment(payload) {
-    const response = await fetch('/render_moment', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(payload)
+// Query string for GET image requests (null/undefined fields are left out)
+export function toQuery(payload) {
+    const query = new URLSearchParams();
+    Object.entries(payload).forEach(([key, value]) => {
+        if (value !== undefined && value !== null) query.append(key, value);
     });
-    return await response.json();
+    return query.toString();
 }
 
-export async function fetchRender(payload) {
-    const response = await fetch('/render', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(payload)
+// Identifies this page to the server's render scheduler: a newer request for the
+// same view supersedes the older ones still waiting there
+const clientId = (window.crypto && crypto.randomUUID)
+    ? crypto.randomUUID()
+    : Math.random().toString(36).slice(2) + Date.now().toString(36);
+
+// Fetches a rendered image as raw bytes. The browser cache revalidates it with its
+// ETag, so an unchanged frame costs a 304 round trip and no data.
+async function fetchImage(url, payload) {
+    const response = await fetch(`${url}?${toQuery(payload)}`, {
+        headers: { 'X-Client-Id': clientId }
     });
-    return await response.json();
-}
\ No newline at end of file
+    if (response.status === 204) {
+        // Superseded by a newer request for the same view
+        return { superseded: true };
+    }
+    if (!response.ok) {
+        const err = await response.json().catch(() => ({}));
+        return { error: err.error || response.statusText };
+    }
+    const blob = await response.blob();
+    return {
+        image: URL.createObjectURL(blob),
+        mode: response.headers.get('X-Render-Mode')
+    };
+}
+
+export function fetchRenderMoment(payload) {
+    return fetchImage('/render_moment', payload);
+}
+
+export function fetchRenderPV(payload) {
+    return fetchImage('/render_pv', payload);
+}
+
+export function fetchRender(payload) {
+    return fetchImage('/render', payload);
+}
@@ -18,6 +18,7 @@ export function getDefaultSettings() {
         distanceVal: elements.distanceInput ? elements.distanceInput.value : '',
         distanceUnit: elements.distanceUnit ? elements.distanceUnit.value : 'Mpc',
         normGlobal: elements.normGlobalToggle ? elements.normGlobalToggle.checked : false,
+        clipPercent: elements.clipPercentInput ? elements.clipPercentInput.value : '',
         vmin: elements.vminInput ? elements.vminInput.value : '',
         vmax: elements.vmaxInput ? elements.vmaxInput.value : '',
         cbarUnit: elements.cbarUnit ? elements.cbarUnit.value : 'None',
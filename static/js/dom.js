@@ -9,6 +9,7 @@ export const elements = {
     get invertMask() { return document.getElementById('invertMask'); },
     get sliderContainer() { return document.getElementById('sliderContainer'); },
     get imgElement() { return document.getElementById('fits-image'); },
+    get imageWrapper() { return document.getElementById('imageWrapper'); },
     get spinner() { return document.getElementById('loadingSpinner'); },
 
     // Slider Inputs
@@ -25,6 +26,7 @@ export const elements = {
     get gridToggle() { return document.getElementById('gridToggle'); },
     get beamToggle() { return document.getElementById('beamToggle'); },
     get normGlobalToggle() { return document.getElementById('normGlobalToggle'); },
+    get clipPercentInput() { return document.getElementById('clipPercentInput'); },
     get cbarUnit() { return document.getElementById('cbarUnit'); },
 
     // Center Marker
@@ -52,11 +54,31 @@ export const elements = {
     get mom0Toggle() { return document.getElementById('mom0Toggle'); },
     get mom1Toggle() { return document.getElementById('mom1Toggle'); },
     get mom2Toggle() { return document.getElementById('mom2Toggle'); },
+    get mom8Toggle() { return document.getElementById('mom8Toggle'); },
+    get mom9Toggle() { return document.getElementById('mom9Toggle'); },
+    get momskewToggle() { return document.getElementById('momskewToggle'); },
+    get momkurtToggle() { return document.getElementById('momkurtToggle'); },
+    get quickLookToggle() { return document.getElementById('quickLookToggle'); },
     get calculateMomentsBtn() { return document.getElementById('calculateMomentsBtn'); },
     get tabItems() { return document.querySelectorAll('.tab-item'); },
 
+    // PV Diagram
+    get pvDrawToggle() { return document.getElementById('pvDrawToggle'); },
+    get pvX1() { return document.getElementById('pvX1'); },
+    get pvY1() { return document.getElementById('pvY1'); },
+    get pvX2() { return document.getElementById('pvX2'); },
+    get pvY2() { return document.getElementById('pvY2'); },
+    get pvCenterX() { return document.getElementById('pvCenterX'); },
+    get pvCenterY() { return document.getElementById('pvCenterY'); },
+    get pvAngle() { return document.getElementById('pvAngle'); },
+    get pvLength() { return document.getElementById('pvLength'); },
+    get pvWidth() { return document.getElementById('pvWidth'); },
+    get calculatePVBtn() { return document.getElementById('calculatePVBtn'); },
+
     // Export & Workspace
     get exportLinks() { return document.querySelectorAll('.export-link'); },
+    get channelMapLinks() { return document.querySelectorAll('.channel-map-link'); },
+    get movieLinks() { return document.querySelectorAll('.movie-link'); },
     get saveWorkspaceBtn() { return document.getElementById('saveWorkspaceBtn'); },
     get loadWorkspaceBtn() { return document.getElementById('loadWorkspaceBtn'); },
     get workspaceInput() { return document.getElementById('workspaceInput'); },
@@ -3,10 +3,11 @@ import { state } from './state.js';
 import * as slider from './slider.js';
 import { handleUpload, handleMaskUpload } from './upload.js';
 import { updateStateFromUI, initializeUI } from './ui.js';
-import { renderView } from './render.js';
+import { renderView, releaseImage } from './render.js';
 import { handleMomentCalculation } from './moments.js';
+import { initPV, toggleDrawMode, handleCalculatePV } from './pv.js';
 import { switchTab } from './tabs.js'; // switchTab also handles close logic if we export it or move it there
-import { handleExport } from './export.js';
+import { handleExport, handleChannelMapExport, handleMovieExport } from './export.js';
 import { saveWorkspace, loadWorkspace } from './workspace.js';
 import { getDefaultSettings } from './constants.js'; // Needed for manual reset logic if needed
 
@@ -93,6 +94,14 @@ export function setupEventListeners() {
         });
     }
 
+    // Percentile clip over the whole cube
+    if (elements.clipPercentInput) {
+        elements.clipPercentInput.addEventListener('change', () => {
+            updateStateFromUI();
+            renderView(state.lastRenderedChannel);
+        });
+    }
+
     // Manual Scale Inputs
     if (elements.vminInput) {
         elements.vminInput.addEventListener('change', () => {
@@ -267,6 +276,15 @@ export function setupEventListeners() {
         elements.calculateMomentsBtn.addEventListener('click', handleMomentCalculation);
     }
 
+    // 7b. PV Diagram
+    if (elements.pvDrawToggle) {
+        initPV();
+        elements.pvDrawToggle.addEventListener('click', toggleDrawMode);
+    }
+    if (elements.calculatePVBtn) {
+        elements.calculatePVBtn.addEventListener('click', handleCalculatePV);
+    }
+
     // 8. Tabs
     if (elements.tabItems) {
         elements.tabItems.forEach(tab => {
@@ -280,9 +298,14 @@ export function setupEventListeners() {
                 closeBtn.addEventListener('click', (e) => {
                     e.stopPropagation();
                     const tabName = tab.dataset.tab;
-                    const key = tabName.replace('mom', '');
-
-                    delete state.momentImages[key];
+                    if (tabName === 'pv') {
+                        releaseImage(state.pvImage);
+                        state.pvImage = null;
+                    } else {
+                        const key = tabName.replace('mom', '');
+                        releaseImage(state.momentImages[key]);
+                        delete state.momentImages[key];
+                    }
                     tab.classList.add('hidden');
 
                     if (state.activeTab === tabName) {
@@ -313,6 +336,22 @@ export function setupEventListeners() {
             });
         });
     }
+    if (elements.channelMapLinks) {
+        elements.channelMapLinks.forEach(link => {
+            link.addEventListener('click', (e) => {
+                e.preventDefault();
+                handleChannelMapExport(link.dataset.fmt);
+            });
+        });
+    }
+    if (elements.movieLinks) {
+        elements.movieLinks.forEach(link => {
+            link.addEventListener('click', (e) => {
+                e.preventDefault();
+                handleMovieExport(link.dataset.fmt);
+            });
+        });
+    }
 
     // 10. Workspace Persistence
     if (elements.saveWorkspaceBtn) {
@@ -12,6 +12,8 @@ export async function handleExport(fmt) {
         // Add context (Channel or Moment)
         if (state.activeTab === 'cube') {
             payload.channel = state.lastRenderedChannel || 0;
+        } else if (state.activeTab === 'pv') {
+            payload.pv = true;
         } else {
             payload.momentType = state.activeTab.replace('mom', '');
         }
@@ -23,26 +25,94 @@ export async function handleExport(fmt) {
         });
 
         if (response.ok) {
-            const blob = await response.blob();
-            const url = window.URL.createObjectURL(blob);
-            const a = document.createElement('a');
-            a.href = url;
-
-            let filename = 'plot';
-            if (params.title && params.title.trim() !== '') {
-                filename = params.title.toLowerCase().replace(/[()]/g, '').replace(/\s+/g, '_');
-            }
+            let filename = exportBaseName(params);
 
-            if (state.activeTab !== 'cube') {
+            if (state.activeTab === 'pv') {
+                filename += '_pv';
+            } else if (state.activeTab !== 'cube') {
                 const momType = state.activeTab.replace('mom', '');
                 filename += `_moment_${momType}`;
             }
 
-            a.download = `${filename}.${fmt}`;
-            document.body.appendChild(a);
-            a.click();
-            a.remove();
-            window.URL.revokeObjectURL(url);
+            await downloadResponse(response, `${filename}.${fmt}`);
+        } else {
+            const err = await response.json();
+            alert("Export failed: " + (err.error || "Unknown error"));
+        }
+    } catch (error) {
+        console.error("Export Error:", error);
+        alert("Export failed.");
+    } finally {
+        elements.spinner.style.display = 'none';
+    }
+}
+
+// Grid of channels (current slider range) in one figure, with one colorbar
+export async function handleChannelMapExport(fmt) {
+    const stride = prompt("Channel stride (every n-th channel):", "1");
+    if (stride === null) return;
+    const binning = prompt("Channels averaged per panel:", "1");
+    if (binning === null) return;
+
+    elements.spinner.style.display = 'block';
+    try {
+        const params = state.tabSettings['cube'] || getRenderParams();
+        const payload = {
+            ...params,
+            format: fmt,
+            startChan: elements.valStart.value,
+            endChan: elements.valEnd.value,
+            stride: stride,
+            binning: binning
+        };
+
+        const response = await fetch('/export_channel_map', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(payload)
+        });
+
+        if (response.ok) {
+            await downloadResponse(response, `${exportBaseName(params)}_channel_map.${fmt}`);
+        } else {
+            const err = await response.json();
+            alert("Export failed: " + (err.error || "Unknown error"));
+        }
+    } catch (error) {
+        console.error("Export Error:", error);
+        alert("Export failed.");
+    } finally {
+        elements.spinner.style.display = 'none';
+    }
+}
+
+// Animated sweep through the current slider range, encoded on the server as frames are rendered
+export async function handleMovieExport(fmt) {
+    const stride = prompt("Channel stride (every n-th channel):", "1");
+    if (stride === null) return;
+    const fps = prompt("Frames per second:", "10");
+    if (fps === null) return;
+
+    elements.spinner.style.display = 'block';
+    try {
+        const params = state.tabSettings['cube'] || getRenderParams();
+        const payload = {
+            ...params,
+            format: fmt,
+            startChan: elements.valStart.value,
+            endChan: elements.valEnd.value,
+            stride: stride,
+            fps: fps
+        };
+
+        const response = await fetch('/export_movie', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(payload)
+        });
+
+        if (response.ok) {
+            await downloadResponse(response, `${exportBaseName(params)}_movie.${fmt}`);
         } else {
             const err = await response.json();
             alert("Export failed: " + (err.error || "Unknown error"));
@@ -54,3 +124,22 @@ export async function handleExport(fmt) {
         elements.spinner.style.display = 'none';
     }
 }
+
+function exportBaseName(params) {
+    if (params.title && params.title.trim() !== '') {
+        return params.title.toLowerCase().replace(/[()]/g, '').replace(/\s+/g, '_');
+    }
+    return 'plot';
+}
+
+async function downloadResponse(response, filename) {
+    const blob = await response.blob();
+    const url = window.URL.createObjectURL(blob);
+    const a = document.createElement('a');
+    a.href = url;
+    a.download = filename;
+    document.body.appendChild(a);
+    a.click();
+    a.remove();
+    window.URL.revokeObjectURL(url);
+}
@@ -85,6 +85,7 @@ document.addEventListener('DOMContentLoaded', () => {
             if (elements.vmaxInput) elements.vmaxInput.disabled = !!c.normGlobal;
         }
 
+        if (elements.clipPercentInput) elements.clipPercentInput.value = c.clipPercent || '';
         if (elements.cbarUnit) elements.cbarUnit.value = c.cbarUnit || 'None';
         if (elements.vminInput) elements.vminInput.value = c.vmin || '';
         if (elements.vmaxInput) elements.vmaxInput.value = c.vmax || '';
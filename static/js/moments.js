@@ -2,7 +2,7 @@ import { state } from './state.js';
 import { elements } from './dom.js';
 import * as api from './api.js';
 import { getDefaultSettings } from './constants.js';
-import { getRenderParams } from './render.js';
+import { getRenderParams, getViewSize, releaseImage } from './render.js';
 import { switchTab } from './tabs.js';
 
 export async function handleMomentCalculation() {
@@ -12,6 +12,10 @@ export async function handleMomentCalculation() {
     if (elements.mom0Toggle.checked) moments.push('0');
     if (elements.mom1Toggle.checked) moments.push('1');
     if (elements.mom2Toggle.checked) moments.push('2');
+    if (elements.mom8Toggle.checked) moments.push('8');
+    if (elements.mom9Toggle.checked) moments.push('9');
+    if (elements.momskewToggle.checked) moments.push('skew');
+    if (elements.momkurtToggle.checked) moments.push('kurt');
 
     if (moments.length === 0) {
         alert("Please select at least one moment to calculate.");
@@ -28,15 +32,24 @@ export async function handleMomentCalculation() {
                 startChan: start,
                 endChan: end,
                 moments: moments,
-                ...params
+                quickLook: elements.quickLookToggle.checked,
+                ...params,
+                ...getViewSize()
             })
         });
         const data = await response.json();
+        if (data.error) {
+            alert(data.error);
+            return;
+        }
 
-        if (data.images) {
-            Object.keys(data.images).forEach(key => {
+        if (data.moments) {
+            state.momentParams = { startChan: start, endChan: end, invertMask: params.invertMask, level: data.level || 1 };
+            data.moments.forEach(key => {
                 const tabId = `mom${key}`;
-                state.momentImages[key] = data.images[key];
+                // Rendered server-side already; the tab fetches it from the render cache
+                releaseImage(state.momentImages[key]);
+                state.momentImages[key] = `/render_moment?${api.toQuery({ momentType: key, ...params })}`;
                 // Initialize settings for the new moment tab
                 state.tabSettings[tabId] = getDefaultSettings();
 
@@ -1,6 +1,9 @@
 import { elements } from './dom.js';
 import { state } from './state.js';
 import { switchTab } from './tabs.js';
+import * as api from './api.js';
+import { getDefaultSettings } from './constants.js';
+import { releaseImage } from './render.js';
 // Coordinate helper is implemented locally
 
 // Assuming render.js might have coordinate helpers, or we write our own.
@@ -192,31 +195,24 @@ function updateInputs() {
 }
 
 export async function handleCalculatePV() {
-    // Gather inputs
-    // Priority: Coordinates vs Center/Angle
-    // Should we have a toggle? Or just check which is valid?
-    // Let's bias towards coords if they are non-empty and user didn't just type in CA.
-    // Actually, easiest is to send all, let backend decide, OR clearing one set when other is typed.
-    // For now, let's just send what is available.
-
+    // End points win when all four are filled in; otherwise the server uses centre, angle and length
+    const params = state.tabSettings['pv'] || getDefaultSettings();
     const payload = {
+        ...params,
         x1: elements.pvX1.value,
         y1: elements.pvY1.value,
         x2: elements.pvX2.value,
         y2: elements.pvY2.value,
-        centerX: elements.pvCenterX.value,
-        centerY: elements.pvCenterY.value,
+        pvCenterX: elements.pvCenterX.value,
+        pvCenterY: elements.pvCenterY.value,
         angle: elements.pvAngle.value,
         length: elements.pvLength.value,
+        width: elements.pvWidth ? elements.pvWidth.value : 1,
 
-        // Visuals
-        title: elements.plotTitleInput.value,
-        grid: elements.gridToggle.checked,
-        cbarUnit: elements.cbarUnit.value,
-        vmin: elements.vminInput.value,
-        vmax: elements.vmaxInput.value,
-        figWidth: elements.figWidthInput.value,
-        figHeight: elements.figHeightInput.value
+        // Spectral range of the slice: the slider selection
+        startChan: elements.valStart.value,
+        endChan: elements.valEnd.value,
+        invertMask: elements.invertMask ? elements.invertMask.checked : false
     };
 
     const btn = elements.calculatePVBtn;
@@ -235,8 +231,10 @@ export async function handleCalculatePV() {
 
         if (data.error) {
             alert("Error: " + data.error);
-        } else if (data.image) {
-            displayPVImage(data.image);
+        } else if (data.success) {
+            // Rendered server-side already; the tab fetches it from the render cache
+            state.tabSettings['pv'] = params;
+            displayPVImage(`/render_pv?${api.toQuery(params)}`);
         }
     } catch (e) {
         console.error(e);
@@ -247,9 +245,10 @@ export async function handleCalculatePV() {
     }
 }
 
-function displayPVImage(b64) {
+function displayPVImage(src) {
     // Store in State
-    state.pvImage = b64;
+    releaseImage(state.pvImage);
+    state.pvImage = src;
 
     // Switch to PV tab
     const pvTab = document.querySelector('.tab-item[data-tab="pv"]');
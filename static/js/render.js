@@ -8,8 +8,24 @@ export function getRenderParams() {
     return state.tabSettings[state.activeTab] || getDefaultSettings();
 }
 
+// Frees an object URL created for a fetched image
+export function releaseImage(src) {
+    if (src && src.startsWith('blob:')) URL.revokeObjectURL(src);
+}
+
+// Screen pixels available to the image; large cubes are served from a matching overview level
+export function getViewSize() {
+    const wrapper = elements.imageWrapper;
+    if (!wrapper) return {};
+    const scale = window.devicePixelRatio || 1;
+    return {
+        viewWidth: Math.round(wrapper.clientWidth * scale),
+        viewHeight: Math.round(wrapper.clientHeight * scale)
+    };
+}
+
 export async function renderView(index) {
-    if (state.isRendering || state.isSyncing) return;
+    if (state.isSyncing) return;
 
     // Ensure state is up to date with UI before rendering
     updateStateFromUI();
@@ -20,35 +36,53 @@ export async function renderView(index) {
     }
     const channelToRender = activeSettings.channel;
 
-    state.isRendering = true;
+    // Latest wins: every call is sent right away, and only the newest response is shown.
+    // The server drops (204) older requests for this view that are still queued.
+    const seq = ++state.renderSeq;
+    const view = state.activeTab;
+    const isCurrent = () => seq === state.renderSeq && view === state.activeTab;
     elements.spinner.style.display = 'block';
 
     const params = getRenderParams();
 
     try {
         let data;
-        if (state.activeTab === 'cube') {
+        if (view === 'cube') {
             state.lastRenderedChannel = channelToRender;
             data = await api.fetchRender({
                 channel: channelToRender,
-                ...params
+                ...params,
+                ...getViewSize()
             });
-            if (data && data.image) {
-                state.cubeImage = data.image;
-            }
+        } else if (view === 'pv') {
+            data = await api.fetchRenderPV(params);
         } else {
-            const momType = state.activeTab.replace('mom', '');
             data = await api.fetchRenderMoment({
-                momentType: momType,
+                momentType: view.replace('mom', ''),
                 ...params
             });
-            if (data && data.image) {
-                state.momentImages[momType] = data.image;
-            }
+        }
+
+        if (!isCurrent()) {
+            if (data && data.image) releaseImage(data.image);
+            return;
         }
 
         if (data && data.image) {
-            elements.imgElement.src = 'data:image/png;base64,' + data.image;
+            if (view === 'cube') {
+                releaseImage(state.cubeImage);
+                state.cubeImage = data.image;
+            } else if (view === 'pv') {
+                releaseImage(state.pvImage);
+                state.pvImage = data.image;
+            } else {
+                const momType = view.replace('mom', '');
+                releaseImage(state.momentImages[momType]);
+                state.momentImages[momType] = data.image;
+            }
+            elements.imgElement.src = data.image;
+            // Preview frames are one pixel per data pixel: scale them up without smoothing
+            elements.imgElement.classList.toggle('preview', data.mode === 'preview');
             elements.imgElement.style.display = 'block';
         } else if (data && data.error) {
             console.error("Server Error:", data.error);
@@ -56,7 +90,8 @@ export async function renderView(index) {
     } catch (error) {
         console.error("Render Error:", error);
     } finally {
-        elements.spinner.style.display = 'none';
-        state.isRendering = false;
+        if (seq === state.renderSeq) {
+            elements.spinner.style.display = 'none';
+        }
     }
 }
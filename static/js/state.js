@@ -1,10 +1,12 @@
 export const state = {
-    isRendering: false,
+    renderSeq: 0, // id of the newest renderView call
     maxChannels: 0,
     lastRenderedChannel: 0,
     momentImages: {},
+    momentParams: null, // channel range and mask of the current moment maps
     activeTab: 'cube',
     cubeImage: null,
+    pvImage: null,
     tabSettings: {},
     isSyncing: false
 };
\ No newline at end of file
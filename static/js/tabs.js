@@ -33,7 +33,7 @@ export function switchTab(tabName) {
 
         // Check if we have the image data
         if (state.momentImages && state.momentImages[momType]) {
-            elements.imgElement.src = `data:image/png;base64,${state.momentImages[momType]}`;
+            elements.imgElement.src = state.momentImages[momType];
             // We might want to trigger a render here if we want to support dynamic re-coloring
             renderView();
         } else {
@@ -41,5 +41,12 @@ export function switchTab(tabName) {
             elements.imgElement.style.display = 'none';
             if (elements.recalcOverlay) elements.recalcOverlay.style.display = 'flex';
         }
+    } else if (tabName === 'pv') {
+        if (state.pvImage) {
+            elements.imgElement.src = state.pvImage;
+            renderView();
+        } else {
+            elements.imgElement.style.display = 'none';
+        }
     }
 }
@@ -45,6 +45,7 @@ export function syncUIFromState(tabId) {
         if (elements.vminInput) elements.vminInput.disabled = !!s.normGlobal;
         if (elements.vmaxInput) elements.vmaxInput.disabled = !!s.normGlobal;
     }
+    if (elements.clipPercentInput) elements.clipPercentInput.value = s.clipPercent || '';
     if (elements.vminInput) elements.vminInput.value = s.vmin;
     if (elements.vmaxInput) elements.vmaxInput.value = s.vmax;
     if (elements.cbarUnit) elements.cbarUnit.value = s.cbarUnit;
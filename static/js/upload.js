@@ -4,7 +4,7 @@ import * as api from './api.js';
 import * as slider from './slider.js';
 import { getDefaultSettings } from './constants.js';
 import { switchTab } from './tabs.js';
-import { renderView } from './render.js';
+import { renderView, releaseImage } from './render.js';
 
 export function setFileData(data) {
     if (elements.sliderContainer) {
@@ -40,8 +40,12 @@ export function setFileData(data) {
     state.mask_path = data.mask_path;
 
     // Clear moments from previous file
+    Object.values(state.momentImages).forEach(releaseImage);
+    releaseImage(state.cubeImage);
+    releaseImage(state.pvImage);
     state.momentImages = {};
     state.cubeImage = null;
+    state.pvImage = null;
     state.tabSettings = {}; // Reset tab memory
     state.tabSettings['cube'] = getDefaultSettings();
 
@@ -2,6 +2,7 @@ import { state } from './state.js';
 import { elements } from './dom.js';
 import { setFileData } from './upload.js';
 import { switchTab } from './tabs.js';
+import * as api from './api.js';
 
 // No circular dependency with UI? setFileData uses UI...
 // workspace.js -> upload.js -> ui.js
@@ -17,7 +18,8 @@ export function saveWorkspace() {
         mask_path: state.mask_path || null,
         activeTab: state.activeTab,
         tabSettings: state.tabSettings,
-        moments: Object.keys(state.momentImages)
+        moments: Object.keys(state.momentImages),
+        momentParams: state.momentParams || null
     };
 
     const jsonStr = JSON.stringify(workspace, null, 2);
@@ -60,6 +62,7 @@ export function loadWorkspace(file) {
             elements.spinner.style.display = 'block';
 
             let loadSuccess = false;
+            let restored = [];
 
             // 1. Try to load from path if available
             if (workspace.file_path) {
@@ -71,13 +74,17 @@ export function loadWorkspace(file) {
                         body: JSON.stringify({
                             file_path: workspace.file_path,
                             mask_path: workspace.mask_path,
-                            mask_filename: workspace.mask_filename
+                            mask_filename: workspace.mask_filename,
+                            // Maps of these inputs are reused from the server's moment store
+                            moments: workspace.moments,
+                            momentParams: workspace.momentParams
                         })
                     });
 
                     if (loadResp.ok) {
                         const data = await loadResp.json();
                         setFileData(data);
+                        restored = data.moments || [];
                         loadSuccess = true;
                         console.log("Auto-load successful");
                     } else {
@@ -109,7 +116,13 @@ export function loadWorkspace(file) {
                     // Also check the toggle box so Recalculate works
                     const toggle = document.getElementById(`mom${m}Toggle`);
                     if (toggle) toggle.checked = true;
+
+                    // Restored from the moment store: viewable without recalculating
+                    if (restored.includes(m)) {
+                        state.momentImages[m] = `/render_moment?${api.toQuery({ momentType: m, ...(state.tabSettings[tabId] || {}) })}`;
+                    }
                 });
+                if (restored.length > 0) state.momentParams = workspace.momentParams;
             }
 
             // Switch to saved tab